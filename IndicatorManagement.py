@@ -3,11 +3,19 @@
 import os
 import argparse
 import coloredlogs
+import cProfile
+import datetime
+import json
 import logging
 import logging.config
 import sys
 
 from indicator_management import IndicatorManager
+from indicator_management.config import CONFIG, HOME_PATH, load_config
+from indicator_management.daemon import COMMANDS, DEFAULT_SOCKET_PATH, Daemon, request
+from indicator_management.rollups import DIMENSIONS
+from indicator_management.shards import REPORT, TUNE, Shard, default_shard_output, read_shard_result
+from indicator_management.sip import ANALYZED, INFORMATIONAL
 
 os.environ['NO_PROXY'] = '.local'
 
@@ -18,8 +26,115 @@ def reset_in_progress(args):
     im.reset_in_progress()
 
 def turn_off_indicators(args):
+    if args.plan_out and (args.shard or args.merge or args.processes or args.incremental or args.print_scope_only):
+        message = "ERROR: --plan-out can't be combined with --shard, --merge, --processes, --incremental or --print-scope-only"
+        sys.stderr.write(message + "\n")
+        LOGGER.error(message)
+        return False
+    im = IndicatorManager(dev=args.dev)
+    if args.shard:
+        return im.run_shard(TUNE, args.shard, args.shard_output or default_shard_output(TUNE, args.shard))
+    if args.incremental:
+        return im.turn_off_indicators_incrementally(dry_run=args.dry_run)
+    if args.plan_out:
+        return im.write_tune_plan(args.plan_out)
+    shard_results = [read_shard_result(path) for path in args.merge] if args.merge else None
+    return im.turn_off_indicators_according_to_tune_instructions(dry_run=args.dry_run, print_scope_only=args.print_scope_only,
+                                                                 processes=args.processes, shard_results=shard_results, scope_by_type=args.scope_by_type)
+
+def apply_plan(args):
+    im = IndicatorManager(dev=args.dev)
+    return im.apply_tune_plan(args.plan, check_stale=args.check_stale, dry_run=args.dry_run)
+
+def diff_plans(args):
+    im = IndicatorManager(dev=args.dev)
+    return im.print_plan_diff(args.old_plan, args.new_plan, show_ids=args.ids) is not None
+
+def type_report(args):
+    im = IndicatorManager(dev=args.dev)
+    if args.shard:
+        return im.run_shard(REPORT, args.shard, args.shard_output or default_shard_output(REPORT, args.shard), sip_query_filter=args.sip_query_filter)
+    shard_results = [read_shard_result(path) for path in args.merge] if args.merge else None
+    return im.get_indicator_type_report(args.sip_query_filter, processes=args.processes, shard_results=shard_results, from_rollups=args.rollups)
+
+def shard(value):
+    try:
+        return Shard.parse(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def add_shard_arguments(parser: argparse.ArgumentParser, kind):
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Split the indicators into this many shards by ID and evaluate each one in its own worker process.')
+    parser.add_argument('--shard', type=shard, default=None, metavar='INDEX/COUNT',
+                        help='Only evaluate shard INDEX of COUNT, like 0/4, and write its result to --shard-output. Nothing is changed in SIP. '
+                             'Merge the results of every shard with --merge.')
+    parser.add_argument('--shard-output', dest='shard_output', default=None,
+                        help=f'Where --shard writes its result. Defaults to {kind}_shard_INDEX_of_COUNT.json.gz')
+    parser.add_argument('--merge', nargs='+', default=None, metavar='SHARD_RESULT',
+                        help='Merge the results of every shard, written by --shard, and carry on as one unsharded run would.')
+
+def turn_indicators_on_for(args):
+    im = IndicatorManager(dev=args.dev)
+    im.set_status_for_recorded_indicators(args.recording_dir, ANALYZED)
+
+def turn_indicators_off_for(args):
     im = IndicatorManager(dev=args.dev)
-    im.turn_off_indicators_according_to_tune_instructions(dry_run=args.dry_run, print_scope_only=args.print_scope_only)
+    im.set_status_for_recorded_indicators(args.recording_dir, INFORMATIONAL)
+
+def set_status_for_records(args, status):
+    im = IndicatorManager(dev=args.dev)
+    return im.set_status_for_records(status, date=args.date, section=args.section, run=args.run, indicator_ids=args.indicator_ids)
+
+def undo(args):
+    return set_status_for_records(args, ANALYZED)
+
+def redo(args):
+    return set_status_for_records(args, INFORMATIONAL)
+
+def records(args):
+    im = IndicatorManager(dev=args.dev)
+    return im.print_records(date=args.date, section=args.section)
+
+def cleanup_records(args):
+    im = IndicatorManager(dev=args.dev)
+    im.cleanup_records(retention_days=args.retention_days)
+    return True
+
+def ace_cache(args):
+    im = IndicatorManager(dev=args.dev)
+    if args.action == 'status':
+        return not im.print_ace_cache_status()
+    im.sync_ace_cache(rebuild=args.action == 'rebuild')
+    return True
+
+def rollups(args):
+    im = IndicatorManager(dev=args.dev)
+    if args.action == 'status':
+        return im.print_rollup_status()
+    if args.action == 'query':
+        im.print_rollups(by=args.by or ['type'], output_format=args.format, output=args.output, types=args.types, sources=args.sources,
+                         ages=args.ages, dispositions=args.dispositions, since=args.since)
+        return True
+    im.refresh_rollups(rebuild=args.action == 'rebuild')
+    return True
+
+def serve(args):
+    im = IndicatorManager(dev=args.dev, keep_connections=True)
+    return Daemon.from_config(im, HOME_PATH, dry_run=args.dry_run).serve_forever()
+
+def ctl(args):
+    socket_path = os.path.join(HOME_PATH, CONFIG.get('serve', 'socket', fallback=DEFAULT_SOCKET_PATH))
+    try:
+        result = request(socket_path, args.command, sections=args.sections, filter=args.sip_query_filter, job=args.job,
+                         by_type=args.scope_by_type or None)
+    except (OSError, RuntimeError) as e:
+        message = f"ERROR: {args.command} request to {socket_path} failed: {e}"
+        sys.stderr.write(message + "\n")
+        LOGGER.error(message)
+        return False
+    print(json.dumps(result, indent=2))
+    return True
 
 def build_parser(parser: argparse.ArgumentParser):
     """Build the CLI Argument parser."""
@@ -35,6 +150,10 @@ def build_parser(parser: argparse.ArgumentParser):
 
     parser.add_argument('--dev', action='store_true', dest='dev', required=False, default=False,
         help='Interact with dev SIP instead of production.')
+    parser.add_argument('--profile', action='store_true', default=False,
+        help='Profile the command with cProfile. The stats are written to var/profiles/ unless --profile-output is given.')
+    parser.add_argument('--profile-output', dest='profile_output', default=None,
+        help='Where to write the cProfile stats of a --profile run. Read them with: python -m pstats FILE')
 
     subparsers = parser.add_subparsers(dest='cmd', help='Various commands for the Indicator Manager')
 
@@ -46,8 +165,105 @@ def build_parser(parser: argparse.ArgumentParser):
                                      help='Flag to not disable the indicators found.')
     find_fp_recon_parser.add_argument('--print-scope-only', help="Just print the number of indicators that would be in scope for each tune and exit.",
                                       action='store_true', dest='print_scope_only', default=False)
+    find_fp_recon_parser.add_argument('--scope-by-type', action='store_true', dest='scope_by_type', default=False,
+                                      help='With --print-scope-only, also print each tune\'s scope by indicator type.')
+    find_fp_recon_parser.add_argument('--incremental', action='store_true', default=False,
+                                      help='Only evaluate the indicators that changed in SIP or ACE, or aged, since the last incremental run. '
+                                           'The first incremental run evaluates every Analyzed indicator.')
+    find_fp_recon_parser.add_argument('--plan-out', dest='plan_out', default=None, metavar='FILE',
+                                      help='Evaluate the tune sections like a dry run and write what they would turn off, and why, to a plan '
+                                           'that apply turns off later.')
+    add_shard_arguments(find_fp_recon_parser, TUNE)
     find_fp_recon_parser.set_defaults(func=turn_off_indicators)
 
+    apply_parser = subparsers.add_parser('apply', help='Turn off the indicators of a plan written by tune_intel --plan-out.')
+    apply_parser.add_argument('--plan', required=True, help='The plan to apply.')
+    apply_parser.add_argument('--check-stale', action='store_true', dest='check_stale', default=False,
+                              help='Leave out the indicators that changed in SIP or got new ACE alerts since the plan was made.')
+    apply_parser.add_argument('-d', '--dry-run', action='store_true', dest='dry_run', default=False,
+                              help='Log what would be turned off without turning it off.')
+    apply_parser.set_defaults(func=apply_plan)
+
+    diff_parser = subparsers.add_parser('diff', help='Show what changed between two plans written by tune_intel --plan-out.')
+    diff_parser.add_argument('old_plan', help='The older plan.')
+    diff_parser.add_argument('new_plan', help='The newer plan.')
+    diff_parser.add_argument('--ids', action='store_true', default=False, help='List the indicator IDs that changed.')
+    diff_parser.set_defaults(func=diff_plans)
+
+    type_report_parser = subparsers.add_parser('type_report', help='Report how the indicators have alerted in ACE, by indicator type.')
+    type_report_parser.add_argument('--filter', dest='sip_query_filter', default='status=Analyzed',
+                                    help='SIP indicator query filter of the indicators to report on. Defaults to status=Analyzed')
+    type_report_parser.add_argument('--rollups', action='store_true', default=False,
+                                    help='Build the report of the Analyzed indicators from the rollups, refreshing them first, instead of scanning SIP and ACE.')
+    add_shard_arguments(type_report_parser, REPORT)
+    type_report_parser.set_defaults(func=type_report)
+
+    turn_on_parser = subparsers.add_parser('turn_indicators_on_for', help='Turn indicators recorded by a tune back on (Analyzed).')
+    turn_on_parser.add_argument('recording_dir', help='Path to the recorded indicators, like var/records/2022-02-10/tune_external_intel, or a run\'s record log.')
+    turn_on_parser.set_defaults(func=turn_indicators_on_for)
+
+    turn_off_parser = subparsers.add_parser('turn_indicators_off_for', help='Turn indicators recorded by a tune back off (Informational).')
+    turn_off_parser.add_argument('recording_dir', help='Path to the recorded indicators, like var/records/2022-02-10/tune_external_intel, or a run\'s record log.')
+    turn_off_parser.set_defaults(func=turn_indicators_off_for)
+
+    for name, func, description in [('undo', undo, 'Turn indicators turned off by tunes back on (Analyzed).'),
+                             ('redo', redo, 'Turn indicators turned back on by undo off again (Informational).')]:
+        record_parser = subparsers.add_parser(name, help=description)
+        record_parser.add_argument('--date', help='Only the indicators recorded on this date, like 2022-02-10.')
+        record_parser.add_argument('--section', help='Only the indicators recorded for this tune section, like tune_external_intel.')
+        record_parser.add_argument('--run', help='Only the indicators recorded by this tune run. See the records command.')
+        record_parser.add_argument('-i', '--indicator', type=int, action='append', dest='indicator_ids', help='Only this indicator ID, can be repeated.')
+        record_parser.set_defaults(func=func)
+
+    records_parser = subparsers.add_parser('records', help='List the recorded tune runs.')
+    records_parser.add_argument('--date', help='Only the runs recorded on this date, like 2022-02-10.')
+    records_parser.add_argument('--section', help='Only the runs of this tune section.')
+    records_parser.set_defaults(func=records)
+
+    cleanup_records_parser = subparsers.add_parser('cleanup_records', help='Delete old records.')
+    cleanup_records_parser.add_argument('--retention-days', type=int, dest='retention_days', default=None,
+                                        help='Delete records older than this many days. Defaults to [records] retention_days.')
+    cleanup_records_parser.set_defaults(func=cleanup_records)
+
+    ace_cache_parser = subparsers.add_parser('ace_cache', help='Manage the local cache of ACE alerts.')
+    ace_cache_parser.add_argument('action', choices=['sync', 'rebuild', 'status'],
+                                  help='sync: incrementally sync from ACE. rebuild: rebuild from scratch. status: show the cache state and whether it is stale.')
+    ace_cache_parser.set_defaults(func=ace_cache)
+
+    rollups_parser = subparsers.add_parser('rollups', help='Manage and query the indicator effectiveness rollups.')
+    rollups_parser.add_argument('action', choices=['refresh', 'rebuild', 'query', 'status'],
+                                help='refresh: count the indicators that changed since the last refresh. rebuild: count every indicator again. '
+                                     'query: print or export a slice. status: show the rollup state.')
+    rollups_parser.add_argument('--by', action='append', choices=DIMENSIONS, default=None,
+                                help='Group the query by this, can be repeated. month is the month alerts were inserted. Defaults to type.')
+    rollups_parser.add_argument('--type', action='append', dest='types', default=None, help='Only this indicator type, can be repeated.')
+    rollups_parser.add_argument('--source', action='append', dest='sources', default=None, help='Only indicators from this source, can be repeated.')
+    rollups_parser.add_argument('--age', action='append', dest='ages', default=None, help='Only this age bucket, like 30-90d, can be repeated.')
+    rollups_parser.add_argument('--disposition', action='append', dest='dispositions', default=None,
+                                help='Only alerts with this disposition, can be repeated.')
+    rollups_parser.add_argument('--since', default=None, help='Only alerts inserted in or after this month, like 2022-01.')
+    rollups_parser.add_argument('--format', choices=['table', 'json', 'csv'], default='table', help='How to print the query. Defaults to table.')
+    rollups_parser.add_argument('-o', '--output', default=None, help='Write the query to this file instead of printing it.')
+    rollups_parser.set_defaults(func=rollups)
+
+    serve_parser = subparsers.add_parser('serve', help='Keep running, run each tune section on its interval and answer ctl requests.')
+    serve_parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False,
+                              help='Run the scheduled tunes without turning any indicators off.')
+    serve_parser.set_defaults(func=serve)
+
+    ctl_parser = subparsers.add_parser('ctl', help='Send a request to the serve daemon and print the JSON result.')
+    ctl_parser.add_argument('command', choices=COMMANDS,
+                            help='status: the scheduled jobs. scope: tune scope counts. dry_run: a tune dry run. '
+                                 'report: the indicator type report. run: run a scheduled job now.')
+    ctl_parser.add_argument('--section', action='append', dest='sections', default=None,
+                            help='Only this tune section, for scope and dry_run. Can be repeated.')
+    ctl_parser.add_argument('--filter', dest='sip_query_filter', default=None,
+                            help='SIP indicator query filter of the report. Defaults to status=Analyzed')
+    ctl_parser.add_argument('--by-type', action='store_true', dest='scope_by_type', default=False,
+                            help='For scope, also count each tune section\'s scope by indicator type.')
+    ctl_parser.add_argument('--job', default=None, help='The job to run, a tune section, incremental, rollups, cleanup_records or ace_cache. See ctl status.')
+    ctl_parser.set_defaults(func=ctl)
+
     return True
 
 
@@ -61,6 +277,9 @@ def main(args=None):
     build_parser(parser)
     args = parser.parse_args(args)
 
+    # create the required directories and config file, and read the config
+    load_config()
+
     # initialize logging
     try:
         logging.config.fileConfig(args.logging_config)
@@ -76,7 +295,21 @@ def main(args=None):
     if args.debug:
         coloredlogs.install(level="DEBUG", logger=LOGGER, fmt=format)
     
-    args.func(args)
+    if args.profile:
+        profile_output = args.profile_output
+        if not profile_output:
+            profile_dir = os.path.join(HOME_PATH, "var", "profiles")
+            if not os.path.isdir(profile_dir):
+                os.makedirs(profile_dir)
+            profile_output = os.path.join(profile_dir, f"{args.cmd}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.prof")
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(args.func, args)
+        finally:
+            profiler.dump_stats(profile_output)
+            LOGGER.info(f"wrote cProfile stats to {profile_output}")
+    else:
+        args.func(args)
 
     return True
 
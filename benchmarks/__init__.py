@@ -0,0 +1,4 @@
+"""Offline benchmarks for the indicator manager.
+
+Run with: python -m benchmarks.run -h
+"""
@@ -0,0 +1,202 @@
+"""In-process stand-ins for the SIP API and the ACE database.
+
+FakeSipClient answers the pysip.Client calls IndicatorManager makes from an
+in-memory, column oriented copy of the indicators. FakeAceDatabase is a SQLite
+file with the parts of the ACE schema IndicatorManager queries (observables,
+observable_mapping and alerts) and hands out cursors that behave like the
+pymysql cursors IndicatorManager uses. Both can add latency to every call and
+count their round trips.
+"""
+
+import datetime
+import re
+import sqlite3
+import threading
+import time
+
+from collections import Counter
+
+import pysip
+
+# SQLite stores the ACE datetimes as ISO text.
+sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('timestamp', lambda value: datetime.datetime.fromisoformat(value.decode()))
+
+# SQLite only converts plain columns, so the MIN and MAX of a datetime column come back as ISO text.
+ISO_DATETIME = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(\.\d+)?$')
+
+ACE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS observables (
+    id INTEGER PRIMARY KEY,
+    type TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS observables_type_value ON observables (type, value);
+CREATE TABLE IF NOT EXISTS alerts (
+    id INTEGER PRIMARY KEY,
+    insert_date TIMESTAMP NOT NULL,
+    alert_type TEXT,
+    description TEXT,
+    disposition TEXT,
+    disposition_time TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS observable_mapping (
+    observable_id INTEGER NOT NULL,
+    alert_id INTEGER NOT NULL,
+    PRIMARY KEY (observable_id, alert_id)
+);
+CREATE INDEX IF NOT EXISTS observable_mapping_alert_id ON observable_mapping (alert_id);
+"""
+
+
+class CallStats:
+    """Thread safe counters of the calls made to a fake."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def as_dict(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+class FakeSipClient:
+    """Answers the SIP API calls IndicatorManager makes from in-memory indicators.
+
+    Indicators are stored as columns and only turned into dicts when a page of
+    them is returned. Searches support the query parameters IndicatorManager
+    uses: status, modified_before, modified_after, types, sources ([OR]),
+    not_sources, not_users, tags, not_tags, count, bulk and page/per_page. Like
+    SIP, pages are offsets into the current search results.
+    """
+
+    def __init__(self, dataset, latency=0.0):
+        self.dataset = dataset
+        self.latency = latency
+        self.stats = CallStats()
+        self.lock = threading.Lock()
+        self._searches = {}
+        self._searches_version = dataset.version
+
+    def _wait(self, method):
+        self.stats.add(method)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def indicator(self, index):
+        return self.dataset.indicator(index)
+
+    def search(self, params):
+        """Return the indexes of the indicators matching search params."""
+        key = tuple(sorted((name, value) for name, value in params.items() if name not in ('page', 'per_page', 'count', 'bulk')))
+        with self.lock:
+            # Like SIP, searches see status changes made since they were last run.
+            if self._searches_version != self.dataset.version:
+                self._searches.clear()
+                self._searches_version = self.dataset.version
+            if key not in self._searches:
+                self._searches[key] = self.dataset.search(params)
+            return self._searches[key]
+
+    def get(self, endpoint):
+        self._wait('get')
+        path, _, query = endpoint.partition('?')
+        path = path.rstrip('/')
+        params = {}
+        for param in query.split('&'):
+            if param:
+                name, _, value = param.partition('=')
+                params[name] = value
+
+        if path.endswith('/indicators/type'):
+            return [{'value': indicator_type} for indicator_type in self.dataset.types]
+
+        if not path.endswith('/indicators'):
+            index = self.dataset.index_of(int(path.rsplit('/', 1)[1]))
+            if index is None:
+                raise pysip.RequestError('{"message": "Indicator ID not found"}')
+            return self.indicator(index)
+
+        matches = self.search(params)
+        if 'count' in params:
+            return len(matches)
+        if 'page' not in params:
+            return [self.indicator(index) for index in matches]
+
+        page = int(params['page'])
+        per_page = int(params.get('per_page', 100))
+        items = [self.indicator(index) for index in matches[(page - 1) * per_page:page * per_page]]
+        self.stats.add('indicators_read', len(items))
+        more = page * per_page < len(matches)
+        return {'_links': {'next': f"{path}?{query.replace(f'page={page}', f'page={page + 1}')}" if more else None},
+                '_meta': {'page': page, 'per_page': per_page, 'total_items': len(matches)},
+                'items': items}
+
+    def put(self, endpoint, data):
+        self._wait('put')
+        index = self.dataset.index_of(int(endpoint.rstrip('/').rsplit('/', 1)[1]))
+        if index is None:
+            raise pysip.RequestError('{"message": "Indicator ID not found"}')
+        if 'status' in data:
+            self.dataset.set_status(index, data['status'])
+        return self.indicator(index)
+
+
+class FakeAceCursor:
+    """A cursor to the fake ACE database that behaves like a pymysql cursor.
+
+    pymysql's %s placeholders are turned into SQLite's and MySQL's case
+    sensitive LIKE BINARY into SQLite's GLOB, since SQLite's LIKE ignores case.
+    Rows are tuples, with datetimes for datetime aggregates like pymysql's.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.connection = sqlite3.connect(database.path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        self._cursor = None
+
+    def execute(self, query, params=()):
+        self.database.stats.add('queries')
+        if self.database.latency:
+            time.sleep(self.database.latency)
+        query = query.replace("LIKE BINARY %s", "GLOB replace(replace(%s, '*', '[*]'), '%', '*')")
+        self._cursor = self.connection.execute(query.replace('%s', '?'), list(params or ()))
+
+    @staticmethod
+    def convert(rows):
+        return [tuple(datetime.datetime.fromisoformat(value) if isinstance(value, str) and ISO_DATETIME.match(value) else value for value in row)
+                for row in rows]
+
+    def fetchmany(self, size=1):
+        rows = self.convert(self._cursor.fetchmany(size))
+        self.database.stats.add('rows', len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.convert(self._cursor.fetchall())
+        self.database.stats.add('rows', len(rows))
+        return rows
+
+    def close(self):
+        self.connection.close()
+
+
+class FakeAceDatabase:
+    """A SQLite file with the parts of the ACE schema IndicatorManager queries."""
+
+    def __init__(self, path, latency=0.0):
+        self.path = path
+        self.latency = latency
+        self.stats = CallStats()
+        with sqlite3.connect(path) as db:
+            db.executescript(ACE_SCHEMA)
+
+    def cursor(self):
+        """Open a new connection and return a cursor for it. Use as IndicatorManager's ace_cursor_factory."""
+        self.stats.add('connections')
+        return FakeAceCursor(self)
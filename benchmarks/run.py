@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""Run the indicator manager end to end against a fake SIP and a synthetic ACE database.
+
+Prints (or writes) a JSON document with the wall time, round trips, peak memory
+(also per 100k indicators) and indicators per second of each scenario so runs
+can be compared. The indicators scenario measures the memory every Analyzed
+indicator takes when held at once, as SIP JSON and as compact Indicators. Example:
+
+    python -m benchmarks.run --indicators 100000 --sip-latency-ms 2 --ace-latency-ms 1 --output before.json
+"""
+
+import argparse
+import configparser
+import datetime
+import hashlib
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.fakes import FakeAceDatabase, FakeSipClient
+from benchmarks.synthetic import SyntheticDataset
+
+from indicator_management import IndicatorManager
+from indicator_management.indicators import Indicator
+from indicator_management.sip import iter_indicators
+
+LOGGER = logging.getLogger("indicator_management.benchmarks")
+
+SCENARIOS = ['tune', 'report', 'indicators']
+
+# Settings the benchmarks run with unless a --config file overrides them.
+DEFAULT_CONFIG = """
+[ace_db]
+chunk_size = 1000
+fetch_size = 1000
+
+[sip_read]
+page_size = 1000
+prefetch_pages = 2
+
+[sip_write]
+workers = 8
+requests_per_second = 0
+max_retries = 0
+
+[pipeline]
+queue_size = 4
+correlation_workers = 1
+record_workers = 1
+
+[default_tune_settings]
+dispositions = FALSE_POSITIVE,RECONNAISSANCE,IGNORE,GRAYWARE
+days = 90
+
+[tune_osint]
+enabled = True
+sources = OSINT1
+days = 30
+
+[tune_internal_intel]
+enabled = True
+sources = Company1,Company2,Company3
+days = 90
+dispositions = FALSE_POSITIVE,RECONNAISSANCE,IGNORE
+good_analysts = analyst1,analyst2
+good_tags = manual_indicator,morningplease
+
+[tune_all_other_external_intel]
+enabled = True
+days = 360
+not_sources = OSINT1,Company1,Company2,Company3
+"""
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return None
+
+
+def build_config(args, workdir):
+    config = configparser.ConfigParser()
+    config.optionxform = str  # preserve case
+    config.read_string(DEFAULT_CONFIG)
+    config['metrics'] = {'enabled': 'True', 'directory': os.path.join(workdir, 'metrics')}
+    if args.ace_cache:
+        config['ace_cache'] = {'enabled': 'True', 'path': os.path.join(workdir, 'ace_cache.sqlite')}
+    if args.config:
+        config.read(args.config)
+    return config
+
+
+def run_scenario(name, func, sip, ace, indicators, trace_memory=True):
+    """Run func and measure it. Returns a dict of the measurements."""
+    sip_before = sip.stats.as_dict()
+    ace_before = ace.stats.as_dict()
+    if trace_memory:
+        tracemalloc.start()
+
+    started = time.perf_counter()
+    result = func()
+    wall_seconds = time.perf_counter() - started
+
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    def delta(after, before):
+        return {key: after.get(key, 0) - before.get(key, 0) for key in after}
+
+    measurements = {'scenario': name,
+                    'wall_seconds': round(wall_seconds, 3),
+                    'indicators': indicators,
+                    'indicators_per_second': round(indicators / wall_seconds, 1) if wall_seconds else None,
+                    'sip_calls': delta(sip.stats.as_dict(), sip_before),
+                    'ace_calls': delta(ace.stats.as_dict(), ace_before),
+                    'peak_traced_memory_bytes': peak_memory,
+                    'peak_memory_per_100k_indicators_bytes': round(peak_memory * 100000 / indicators) if peak_memory and indicators else None,
+                    'max_rss_kilobytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    measurements.update(result or {})
+    LOGGER.warning(f"{name}: {measurements['wall_seconds']} seconds, {measurements['indicators_per_second']} indicators/sec")
+    return measurements
+
+
+def held_memory(build):
+    """Return the bytes of memory held by what build() returns."""
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    held = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    del held
+    if not tracing:
+        tracemalloc.stop()
+    return size
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the SIP indicator manager.")
+    parser.add_argument('-n', '--indicators', type=int, default=10000, help='Number of synthetic SIP indicators. Defaults to 10000.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the synthetic data.')
+    parser.add_argument('--alert-rate', type=float, default=0.45, help='Fraction of indicators that have alerted in ACE.')
+    parser.add_argument('--mean-alerts', type=float, default=3.0, help='Mean number of alerts of the indicators that have alerted.')
+    parser.add_argument('--sip-latency-ms', type=float, default=0.0, help='Latency added to every SIP call.')
+    parser.add_argument('--ace-latency-ms', type=float, default=0.0, help='Latency added to every ACE query.')
+    parser.add_argument('-s', '--scenario', action='append', choices=SCENARIOS, dest='scenarios',
+                        help='Scenario to run, can be repeated. Defaults to all of them.')
+    parser.add_argument('--dry-run', action='store_true', default=False, help='Run the tunes as dry runs.')
+    parser.add_argument('--ace-cache', action='store_true', default=False, help='Read ACE alerts from a local ACE cache built before the scenarios run.')
+    parser.add_argument('--processes', type=int, default=None, help='Run the scenarios sharded across this many worker processes.')
+    parser.add_argument('--config', help='Config file overriding the benchmark settings, like [pipeline] or the tune_ sections.')
+    parser.add_argument('--workdir', help='Directory for the synthetic ACE database. Defaults to a temporary directory.')
+    parser.add_argument('--no-trace-memory', action='store_false', dest='trace_memory', default=True,
+                        help='Do not trace peak memory. Tracing slows the scenarios down.')
+    parser.add_argument('-o', '--output', help='Write the JSON results here instead of printing them.')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='Log what the indicator manager is doing.')
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(asctime)s - %(name)s - [%(levelname)s] %(message)s")
+    logging.getLogger('indicator_management').setLevel(logging.INFO if args.verbose else logging.WARNING)
+    LOGGER.setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = args.workdir or tmpdir
+        os.makedirs(workdir, exist_ok=True)
+
+        started = time.perf_counter()
+        dataset = SyntheticDataset(args.indicators, seed=args.seed)
+        ace_path = os.path.join(workdir, f"ace_{args.indicators}_{args.seed}.sqlite")
+        if os.path.exists(ace_path):
+            os.remove(ace_path)
+        ace = FakeAceDatabase(ace_path, latency=args.ace_latency_ms / 1000)
+        alerts = dataset.populate_ace(ace, alert_rate=args.alert_rate, mean_alerts=args.mean_alerts)
+        LOGGER.warning(f"generated {args.indicators} indicators and {alerts} alerts in {time.perf_counter() - started:.1f} seconds")
+
+        sip = FakeSipClient(dataset, latency=args.sip_latency_ms / 1000)
+        config = build_config(args, workdir)
+        analyzed = sip.get('/api/indicators?status=Analyzed&count')
+
+        results = {'benchmark': {'indicators': args.indicators,
+                                 'analyzed_indicators': analyzed,
+                                 'alerts': alerts,
+                                 'seed': args.seed,
+                                 'alert_rate': args.alert_rate,
+                                 'mean_alerts': args.mean_alerts,
+                                 'sip_latency_ms': args.sip_latency_ms,
+                                 'ace_latency_ms': args.ace_latency_ms,
+                                 'dry_run': args.dry_run,
+                                 'ace_cache': args.ace_cache,
+                                 'processes': args.processes,
+                                 'config': {section: dict(config[section]) for section in config.sections()}},
+                   'environment': {'python': platform.python_version(),
+                                   'platform': platform.platform(),
+                                   'git_commit': git_commit(),
+                                   'started': datetime.datetime.now().isoformat()},
+                   'scenarios': []}
+
+        def manager():
+            return IndicatorManager(config=config, sip=sip, ace_cursor_factory=ace.cursor)
+
+        if args.ace_cache:
+            manager().sync_ace_cache(rebuild=True)
+
+        for scenario in args.scenarios or SCENARIOS:
+            dataset.reset_statuses()
+
+            if scenario == 'tune':
+                def tune():
+                    im = manager()
+                    im.turn_off_indicators_according_to_tune_instructions(dry_run=args.dry_run, record_changes=False, processes=args.processes)
+                    metrics = im.metrics.summary()
+                    return {'turned_off': sum(summary.succeeded for summary in im.write_summaries),
+                            'failed': sum(len(summary.failed) for summary in im.write_summaries),
+                            'sections': metrics['sections'],
+                            'call_latency': {call: {key: value for key, value in histogram.items() if key != 'buckets'}
+                                             for call, histogram in metrics['calls'].items()}}
+                results['scenarios'].append(run_scenario(scenario, tune, sip, ace, analyzed, trace_memory=args.trace_memory))
+
+            elif scenario == 'report':
+                def report():
+                    im = manager()
+                    report = im.get_indicator_type_report(print_report=False, write_report=False, processes=args.processes)
+                    return {'report_sha256': hashlib.sha256(json.dumps(report, sort_keys=True).encode()).hexdigest()}
+                results['scenarios'].append(run_scenario(scenario, report, sip, ace, analyzed, trace_memory=args.trace_memory))
+
+            elif scenario == 'indicators':
+                def indicators():
+                    query = '/api/indicators?status=Analyzed'
+                    json_bytes = held_memory(lambda: list(iter_indicators(sip, query)))
+                    compact_bytes = held_memory(lambda: [Indicator.from_json(indicator) for indicator in iter_indicators(sip, query)])
+                    return {'json_bytes_per_100k_indicators': round(json_bytes * 100000 / analyzed) if analyzed else None,
+                            'compact_bytes_per_100k_indicators': round(compact_bytes * 100000 / analyzed) if analyzed else None}
+                results['scenarios'].append(run_scenario(scenario, indicators, sip, ace, analyzed, trace_memory=args.trace_memory))
+
+        dataset.reset_statuses()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output + "\n")
+        print(f"Wrote {args.output}")
+    else:
+        print(output)
+    return True
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,198 @@
+"""Synthetic SIP indicators and ACE alerts for the benchmarks.
+
+The distributions are loosely modelled on a production SIP/ACE pair: most
+indicators are Analyzed, about half of them have never alerted, alert counts
+have a long tail and most dispositions are false positives.
+"""
+
+import datetime
+import math
+import random
+import sqlite3
+
+from array import array
+
+INDICATOR_TYPES = [('Address - ipv4-addr', 12), ('Email - Address', 10), ('Email - Subject', 6), ('Hash - MD5', 14),
+                   ('Hash - SHA1', 6), ('Hash - SHA256', 14), ('URI - Domain Name', 16), ('URI - Path', 6),
+                   ('URI - URL', 10), ('Windows - FileName', 4), ('Windows - Mutex', 1), ('Windows - FilePath', 1)]
+SOURCES = [('OSINT1', 35), ('OSINT2', 15), ('Company1', 10), ('Company2', 8), ('Company3', 7), ('vendor_feed', 25)]
+USERS = [('analyst1', 20), ('analyst2', 20), ('analyst3', 10), ('automation', 50)]
+STATUSES = [('Analyzed', 80), ('New', 5), ('In Progress', 1), ('Informational', 12), ('Deprecated', 2)]
+# Tags are stored as a bit mask, tag i is bit i.
+TAGS = [('manual_indicator', 5), ('morningplease', 2), ('phish', 15), ('malware', 10)]
+DISPOSITIONS = [('FALSE_POSITIVE', 45), ('IGNORE', 15), ('RECONNAISSANCE', 8), ('GRAYWARE', 5), ('DELIVERY', 8),
+                ('APPROVED_BUSINESS', 4), ('WEAPONIZATION', 3), ('COMMAND_AND_CONTROL', 2), (None, 10)]
+
+# How far back indicator modification times and alert insert dates go.
+HISTORY_DAYS = 3 * 365
+
+
+def weighted(rng, choices):
+    """Return a function picking the index of a weighted choice."""
+    weights = [weight for value, weight in choices]
+    population = list(range(len(choices)))
+    return lambda: rng.choices(population, weights)[0]
+
+
+class SyntheticDataset:
+    """Column oriented synthetic SIP indicators with IDs 1 to size."""
+
+    types = [value for value, weight in INDICATOR_TYPES]
+    sources = [value for value, weight in SOURCES]
+    users = [value for value, weight in USERS]
+    statuses = [value for value, weight in STATUSES]
+    tags = [value for value, weight in TAGS]
+
+    def __init__(self, size, seed=0, now=None):
+        self.size = size
+        self.seed = seed
+        self.now = now or datetime.datetime.now().replace(microsecond=0)
+        rng = random.Random(seed)
+
+        pick_type = weighted(rng, INDICATOR_TYPES)
+        pick_source = weighted(rng, SOURCES)
+        pick_user = weighted(rng, USERS)
+        pick_status = weighted(rng, STATUSES)
+        oldest = self.now.timestamp() - HISTORY_DAYS * 86400
+
+        self.type_column = array('B', (pick_type() for _ in range(size)))
+        self.source_column = array('B', (pick_source() for _ in range(size)))
+        self.user_column = array('B', (pick_user() for _ in range(size)))
+        self.status_column = array('B', (pick_status() for _ in range(size)))
+        self.original_status_column = array('B', self.status_column)
+        self.tag_column = array('B', (sum(1 << i for i, (tag, percent) in enumerate(TAGS) if rng.random() * 100 < percent) for _ in range(size)))
+        self.modified_column = array('d', (rng.uniform(oldest, self.now.timestamp()) for _ in range(size)))
+        # Bumped on every status change so cached search results can tell they're stale.
+        self.version = 0
+
+    def __len__(self):
+        return self.size
+
+    def index_of(self, indicator_id):
+        return indicator_id - 1 if 0 < indicator_id <= self.size else None
+
+    def indicator(self, index):
+        """Return the SIP API representation of the indicator at index."""
+        # A NaN modified time is an indicator SIP has no modified time for.
+        modified = self.modified_column[index]
+        modified_time = datetime.datetime.fromtimestamp(modified).isoformat(' ') if not math.isnan(modified) else None
+        return {'id': index + 1,
+                'type': self.types[self.type_column[index]],
+                'value': f"indicator-{index + 1}",
+                'status': self.statuses[self.status_column[index]],
+                'sources': [self.sources[self.source_column[index]]],
+                'tags': [tag for i, tag in enumerate(self.tags) if self.tag_column[index] & (1 << i)],
+                'user': self.users[self.user_column[index]],
+                'created_time': modified_time,
+                'modified_time': modified_time}
+
+    def set_status(self, index, status):
+        self.status_column[index] = self.statuses.index(status)
+        self.version += 1
+
+    def reset_statuses(self):
+        """Undo any status changes, so every benchmark scenario starts from the same data."""
+        self.status_column = array('B', self.original_status_column)
+        self.version += 1
+
+    def search(self, params):
+        """Return the indexes of the indicators matching SIP search params."""
+
+        def values(name):
+            value = params.get(name, '')
+            if value.startswith('[OR]'):
+                value = value[4:]
+            return [v for v in value.split(',') if v]
+
+        checks = []
+        if params.get('status'):
+            status = self.statuses.index(params['status']) if params['status'] in self.statuses else -1
+            checks.append(lambda i: self.status_column[i] == status)
+        if params.get('modified_before'):
+            modified_before = datetime.datetime.fromisoformat(params['modified_before']).timestamp()
+            checks.append(lambda i: self.modified_column[i] < modified_before)
+        if params.get('modified_after'):
+            modified_after = datetime.datetime.fromisoformat(params['modified_after']).timestamp()
+            checks.append(lambda i: self.modified_column[i] > modified_after)
+        if values('types'):
+            types = {self.types.index(t) for t in values('types') if t in self.types}
+            checks.append(lambda i: self.type_column[i] in types)
+        # Every indicator has a single source, so [OR] and AND source searches are the same.
+        if values('sources'):
+            sources = {self.sources.index(s) for s in values('sources') if s in self.sources}
+            checks.append(lambda i: self.source_column[i] in sources)
+        if values('not_sources'):
+            not_sources = {self.sources.index(s) for s in values('not_sources') if s in self.sources}
+            checks.append(lambda i: self.source_column[i] not in not_sources)
+        if values('not_users'):
+            not_users = {self.users.index(u) for u in values('not_users') if u in self.users}
+            checks.append(lambda i: self.user_column[i] not in not_users)
+        if values('tags'):
+            tags = sum(1 << self.tags.index(t) if t in self.tags else 1 << 7 for t in values('tags'))
+            checks.append(lambda i: self.tag_column[i] & tags == tags)
+        if values('not_tags'):
+            not_tags = sum(1 << self.tags.index(t) for t in values('not_tags') if t in self.tags)
+            checks.append(lambda i: not self.tag_column[i] & not_tags)
+
+        return [i for i in range(self.size) if all(check(i) for check in checks)]
+
+    def populate_ace(self, database, alert_rate=0.45, mean_alerts=3.0, max_alerts=200, batch_size=50000):
+        """Fill a FakeAceDatabase with alerts for the indicators. Returns the number of alerts created.
+
+        alert_rate of the indicators have alerted. Their alert counts follow a
+        geometric distribution with a mean of mean_alerts, capped at max_alerts.
+        About one in ten alerts is from the faqueue and one in twenty came from
+        the FA Queue. Like ACE's auto-increment alert IDs, alert IDs increase
+        with the alerts' insert dates.
+        """
+        rng = random.Random(self.seed + 1)
+        pick_disposition = weighted(rng, DISPOSITIONS)
+        oldest = self.now.timestamp() - HISTORY_DAYS * 86400
+        observables, alerts, mappings = [], [], []
+
+        db = sqlite3.connect(database.path)
+
+        def flush():
+            db.executemany("INSERT INTO observables (id, type, value) VALUES (?, ?, ?)", observables)
+            db.executemany("INSERT INTO alerts (id, insert_date, alert_type, description, disposition, disposition_time) VALUES (?, ?, ?, ?, ?, ?)", alerts)
+            db.executemany("INSERT INTO observable_mapping (observable_id, alert_id) VALUES (?, ?)", mappings)
+            db.commit()
+            observables.clear()
+            alerts.clear()
+            mappings.clear()
+
+        # When each indicator alerted. The alerts are numbered once they're sorted by insert date.
+        alert_times = array('d')
+        alert_indicators = array('L')
+        for index in range(self.size):
+            indicator_id = index + 1
+            observables.append((indicator_id, 'indicator', f"sip:{indicator_id}"))
+            if len(observables) >= batch_size:
+                flush()
+            if rng.random() >= alert_rate:
+                continue
+
+            # Geometric distribution with the given mean.
+            count = 1
+            while count < max_alerts and rng.random() > 1.0 / mean_alerts:
+                count += 1
+
+            for _ in range(count):
+                alert_times.append(rng.uniform(oldest, self.now.timestamp()))
+                alert_indicators.append(indicator_id)
+
+        for alert_id, alert in enumerate(sorted(range(len(alert_times)), key=alert_times.__getitem__), start=1):
+            insert_date = datetime.datetime.fromtimestamp(alert_times[alert]).replace(microsecond=0)
+            disposition = DISPOSITIONS[pick_disposition()][0]
+            alert_type = 'faqueue' if rng.random() < 0.1 else 'manual'
+            description = 'ACE - FA Queue - Suspect Hash' if rng.random() < 0.05 else f"Alert {alert_id}"
+            disposition_time = insert_date + datetime.timedelta(hours=1) if disposition else None
+            alerts.append((alert_id, insert_date.isoformat(' '), alert_type, description, disposition,
+                           disposition_time.isoformat(' ') if disposition_time else None))
+            mappings.append((alert_indicators[alert], alert_id))
+            if len(alerts) >= batch_size:
+                flush()
+
+        flush()
+        db.close()
+        return len(alert_times)
@@ -7,53 +7,152 @@ import json
 import logging, logging.config
 import os
 import re
+import shutil
 import sys
-import pymysql
+import threading
 import time
 
-from tqdm import tqdm
-
 from collections import Counter
-from dateutil.parser import parse
 
-import pysip
+from indicator_management.config import HOME_PATH, load_config
+from indicator_management.cache import DEFAULT_MAX_AGE_MINUTES, AlertCache, to_text
+from indicator_management.correlation import (DEFAULT_CHUNK_SIZE, DEFAULT_FETCH_SIZE, AceAlertSource, FP_RECON, GOOD, NO_ALERTS, NO_MATCHING_ALERTS,
+                                              chunks, classify, disposition_summary, indicator_observable_value, iter_disposition_counts)
+from indicator_management.incremental import (DEFAULT_RESYNC_WINDOW_HOURS, IncrementalState, query_ace_watermarks, query_changed_indicator_ids,
+                                              recheck_time, rules_fingerprint)
+from indicator_management.indicators import Indicator, compact
+from indicator_management.metrics import ALL_SECTIONS, DEFAULT_METRICS_DIR, InstrumentedCursor, InstrumentedSipClient, RunMetrics
+from indicator_management.pipeline import DEFAULT_QUEUE_SIZE, Pipeline, Stage
+from indicator_management.plans import PlanEntry, TunePlan, diff_plans
+from indicator_management.records import DEFAULT_FULL_INDICATORS, LOG_SUFFIX as RECORD_LOG_SUFFIX, RecordStore
+from indicator_management.rollups import RollupStore
+from indicator_management.rules import TuneRule, parse_time, route, superset_query
+from indicator_management.shards import (REPORT, TUNE, Shard, merge_reports, merge_tune_results, read_shard_result, run_local_shards,
+                                         write_shard_result)
+from indicator_management.sip import (ANALYZED, DEFAULT_PAGE_SIZE, DEFAULT_PREFETCH_PAGES, DEFAULT_WORKERS, INFORMATIONAL, NEW,
+                                      SipWriteExecutor, WriteSummary, iter_indicators)
 
-from indicator_management.config import CONFIG, HOME_PATH
+# Defaults for the [pipeline] config section.
+DEFAULT_CORRELATION_WORKERS = 1
+DEFAULT_RECORD_WORKERS = 1
 
 class IndicatorManager:
-    def __init__(self, config: configparser.ConfigParser=CONFIG, dev=False):
+    def __init__(self, config: configparser.ConfigParser=None, dev=False, sip: 'pysip.Client'=None, ace_cursor_factory=None,
+                 keep_connections=False):
+        """Manage SIP indicators.
+
+        The config defaults to the one load_config() reads. Nothing connects to
+        SIP or ACE until it's first used.
+
+        sip and ace_cursor_factory replace the SIP client and the function that opens
+        ACE database cursors, like the benchmarks do with in-process fakes.
+
+        With keep_connections, the ACE connections of pipeline workers are kept open
+        between runs instead of being closed, like the serve daemon does.
+        """
         self.prod = not dev
 
         self.indicators = None
         # Save the config file.
-        self.config = config
+        self.config = config if config is not None else load_config()
 
         # Start logging.
         self.logger = logging.getLogger('indicator_management.IndicatorManager')
 
-        # Connect to SIP.
-        if self.prod:
-            verify = self.config['sip_prod'].getboolean('verify_ssl')
-            if verify:
-                if os.path.exists(self.config['sip_prod']['ca_bundle']):
-                    verify=self.config['sip_prod']['ca_bundle']
-            self.sip = pysip.Client(self.config['sip_prod']['host'], self.config['sip_prod']['api_key'], verify=verify)
-        else:
-            verify = self.config['sip_dev'].getboolean('verify_ssl')
-            if verify:
-                if os.path.exists(self.config['sip_dev']['ca_bundle']):
-                    verify=self.config['sip_dev']['ca_bundle']
-            self.sip = pysip.Client(self.config['sip_dev']['host'], self.config['sip_dev']['api_key'], verify=verify)
+        # Timings and counts of this run. Every SIP and ACE call is timed.
+        self.metrics = RunMetrics()
+
+        # The SIP client is connected when it's first used.
+        self._sip = sip
+        self._sip_client = None
+        self._sip_lock = threading.Lock()
 
         self.logger.info('self.prod = {}'.format(self.prod))
 
+        self._ace_cursor_factory = ace_cursor_factory
         self._ace_db_cursor = None
+        self._alert_source = None
+        self._worker_ace_cursors = []
+        self._keep_connections = keep_connections
+        self._idle_ace_cursors = []
+        self._writer = None
+        self._record_store = None
+        self._incremental_state = None
+        self._rollup_store = None
+        self.write_summaries = []
+
+    @property
+    def sip(self):
+        """The SIP client, connected the first time it's used. Every call is timed."""
+        with self._sip_lock:
+            if self._sip_client is None:
+                self._sip_client = InstrumentedSipClient(self._sip if self._sip is not None else self.connect_to_sip(), self.metrics)
+            return self._sip_client
+
+    def connect_to_sip(self):
+        """Connect to prod or dev SIP. Connections are kept open and reused by the status update workers."""
+        # pysip and requests are slow to import, so they're only imported when SIP is used.
+        from indicator_management.session import SessionClient
+
+        sip_section = self.config['sip_prod'] if self.prod else self.config['sip_dev']
+        verify = sip_section.getboolean('verify_ssl')
+        if verify:
+            if os.path.exists(sip_section['ca_bundle']):
+                verify=sip_section['ca_bundle']
+        sip_pool_size = self.config.getint('sip_write', 'workers', fallback=DEFAULT_WORKERS)
+        return SessionClient(sip_section['host'], sip_section['api_key'], verify=verify, pool_size=sip_pool_size)
+
+    @property
+    def alert_source(self):
+        """Where ACE alerts are read from: the local ACE cache if it's enabled, otherwise the ACE database.
+
+        A stale cache is synced before it's used.
+        """
+        if self._alert_source is not None:
+            return self._alert_source
+
+        if self.config.getboolean('ace_cache', 'enabled', fallback=False):
+            self._alert_source = self.get_alert_cache()
+            self.refresh_alert_source()
+        else:
+            self._alert_source = AceAlertSource(self.connect_to_ace(), fetch_size=self.ace_fetch_size)
+        return self._alert_source
+
+    @property
+    def ace_fetch_size(self):
+        return self.config.getint('ace_db', 'fetch_size', fallback=DEFAULT_FETCH_SIZE)
+
+    def get_alert_cache(self):
+        """Open the local ACE cache described by the [ace_cache] config section."""
+        return AlertCache.from_config(self.config, HOME_PATH)
 
     def connect_to_ace(self):
-        if isinstance(self._ace_db_cursor, pymysql.cursors.DictCursor):
+        """Return a cursor to the ACE database.
+
+        The cursor is an unbuffered SSCursor: rows are streamed from MySQL as
+        they are fetched instead of being read into memory up front, so every
+        query's results must be read before the next query is executed.
+        """
+        if self._ace_db_cursor is not None:
             self.logger.debug('Returning existing connection to ACE.')
             return self._ace_db_cursor
 
+        self._ace_db_cursor = self.open_ace_cursor()
+        return self._ace_db_cursor
+
+    def open_ace_cursor(self):
+        """Open a new connection to the ACE database and return an unbuffered cursor for it.
+
+        A connection kept open by an earlier run is reused if it's still alive.
+        """
+        while self._idle_ace_cursors:
+            ace_cursor = self._idle_ace_cursors.pop()
+            if self.check_ace_connection(ace_cursor):
+                return ace_cursor
+
+        if self._ace_cursor_factory is not None:
+            return InstrumentedCursor(self._ace_cursor_factory(), self.metrics)
+
         ace_host = self.config['ace_db']['host']
         ace_port = self.config['ace_db']['port']
         ace_user = self.config['ace_db']['user']
@@ -62,269 +161,1028 @@ class IndicatorManager:
         #ace_pass = getpass.getpass(prompt='ACE database password for user "{}": '.format(ace_user))
 
         self.logger.debug('Connecting to ACE database {}@{}:{}'.format(ace_user, ace_host, ace_port))
+        import pymysql
         ssl_settings = {'ca': self.config['ace_db']['ca_bundle']}
         ace_db = pymysql.connect(host=ace_host, port=int(ace_port), user=ace_user, password=ace_pass, database=ace_db, ssl=ssl_settings)
-        self._ace_db_cursor = ace_db.cursor(pymysql.cursors.DictCursor)
-        return self._ace_db_cursor
+        return InstrumentedCursor(ace_db.cursor(pymysql.cursors.SSCursor), self.metrics)
+
+    def create_alert_source(self):
+        """Return an alert source for a pipeline worker thread.
+
+        Queries can't run at the same time on one ACE connection, so each worker
+        gets its own. The ACE cache is shared, it serializes its own queries.
+        """
+        if not isinstance(self.alert_source, AceAlertSource):
+            return self.alert_source
+        ace_cursor = self.open_ace_cursor()
+        self._worker_ace_cursors.append(ace_cursor)
+        return AceAlertSource(ace_cursor, fetch_size=self.ace_fetch_size)
+
+    def close_worker_ace_connections(self):
+        while self._worker_ace_cursors:
+            ace_cursor = self._worker_ace_cursors.pop()
+            if self._keep_connections:
+                self._idle_ace_cursors.append(ace_cursor)
+            else:
+                self.close_ace_connection(ace_cursor)
+
+    def close_ace_connection(self, ace_cursor):
+        try:
+            ace_cursor.connection.close()
+        except Exception as e:
+            self.logger.debug(f"error closing ACE connection: {e}")
+
+    def check_ace_connection(self, ace_cursor):
+        """Ping an ACE connection, reconnecting if the server closed it. Returns False, after closing it, if it's unusable."""
+        ping = getattr(ace_cursor.connection, 'ping', None)
+        if ping is None:
+            return True
+        try:
+            ping(reconnect=True)
+            return True
+        except Exception as e:
+            self.logger.warning(f"ACE connection is unusable, opening a new one: {e}")
+            self.close_ace_connection(ace_cursor)
+            return False
+
+    def refresh_alert_source(self, force=False):
+        """Sync the ACE cache the alert source reads from if it's stale, or if force is True."""
+        alert_source = self.alert_source
+        if isinstance(alert_source, AlertCache):
+            max_age_minutes = self.config.getint('ace_cache', 'max_age_minutes', fallback=DEFAULT_MAX_AGE_MINUTES)
+            if force or alert_source.is_stale(max_age_minutes):
+                self.logger.info(f"ACE cache was last synced {alert_source.last_sync}, syncing it.")
+                alert_source.sync(self.connect_to_ace(), fetch_size=self.ace_fetch_size)
+        return alert_source
+
+    def prepare_run(self):
+        """Get a long lived IndicatorManager ready for its next run.
+
+        The run metrics and write summaries start over, the ACE connection is
+        checked, reconnecting if it has to, and a stale ACE cache is synced.
+        """
+        self.metrics.reset()
+        self.write_summaries = []
+        if self._ace_db_cursor is not None and not self.check_ace_connection(self._ace_db_cursor):
+            self._ace_db_cursor = None
+            if isinstance(self._alert_source, AceAlertSource):
+                self._alert_source = None
+        if self.config.getboolean('ace_cache', 'enabled', fallback=False):
+            self.refresh_alert_source()
+
+    def close(self):
+        """Close the ACE connections, the ACE cache, the record store, the incremental state, the rollups and the SIP session."""
+        self.close_worker_ace_connections()
+        while self._idle_ace_cursors:
+            self.close_ace_connection(self._idle_ace_cursors.pop())
+        if self._ace_db_cursor is not None:
+            self.close_ace_connection(self._ace_db_cursor)
+            self._ace_db_cursor = None
+        if isinstance(self._alert_source, AlertCache):
+            self._alert_source.close()
+        self._alert_source = None
+        if self._record_store is not None:
+            self._record_store.close()
+            self._record_store = None
+        if self._incremental_state is not None:
+            self._incremental_state.close()
+            self._incremental_state = None
+        if self._rollup_store is not None:
+            self._rollup_store.close()
+            self._rollup_store = None
+        close_sip = getattr(self._sip_client, 'close', None)
+        if close_sip is not None:
+            close_sip()
+
+    @property
+    def writer(self):
+        """The SipWriteExecutor used for indicator status updates."""
+        if self._writer is None:
+            self._writer = SipWriteExecutor.from_config(self.sip, self.config)
+        return self._writer
 
     def disable_indicator(self, indicator):
-        data = {'status': 'Informational'}
-        self.sip.put('/api/indicators/{}'.format(indicator['id']), data)
-        self.logger.debug('Disabled indicator "{}" ({})'.format(indicator['value'], indicator['id']))
-        return True
+        result = self.writer.set_status(indicator['id'], INFORMATIONAL)
+        if result.success:
+            self.logger.debug('Disabled indicator "{}" ({})'.format(indicator['value'], indicator['id']))
+        return result.success
 
     def enable_indicator(self, indicator):
-        data = {'status': 'New'}
-        self.sip.put('/api/indicators/{}'.format(indicator['id']), data)
-        self.logger.debug('Enabling indicator "{}" ({})'.format(indicator['value'], indicator['id']))
+        result = self.writer.set_status(indicator['id'], NEW)
+        if result.success:
+            self.logger.debug('Enabling indicator "{}" ({})'.format(indicator['value'], indicator['id']))
+        return result.success
+
+    def set_indicator_statuses(self, indicator_ids, status, description):
+        """Concurrently set the status of every indicator ID and log a summary of the results.
+
+        Returns the WriteSummary.
+        """
+        summary = WriteSummary(description)
+        for result in self.writer.set_statuses(indicator_ids, status):
+            summary.add(result)
+            if result.success:
+                self.logger.debug(f"Set indicator {result.indicator_id} to {status}")
+        summary.finish()
+        self.logger.info(str(summary))
+        for result in summary.failed:
+            self.logger.warning(f"Failed to set indicator {result.indicator_id} to {status}: {result.error}")
+        self.write_summaries.append(summary)
+        return summary
+
+    def iter_indicators(self, query):
+        """Yield the indicators matching a SIP query as compact Indicators, a page at a time, using the [sip_read] config section."""
+        return compact(iter_indicators(self.sip, query,
+                                       page_size=self.config.getint('sip_read', 'page_size', fallback=DEFAULT_PAGE_SIZE),
+                                       prefetch_pages=self.config.getint('sip_read', 'prefetch_pages', fallback=DEFAULT_PREFETCH_PAGES)))
+
+    @property
+    def record_store(self):
+        """The RecordStore of the indicators tunes have turned off, described by the [records] config section."""
+        if self._record_store is None:
+            self._record_store = RecordStore.from_config(self.config, HOME_PATH)
+        return self._record_store
+
+    def record_indicator_tunes(self, record_log, section, indicators):
+        """Record a batch of indicators being turned off in record_log, if there is one, and return their IDs.
+
+        If the batch can't be recorded none of them are turned off.
+        """
+        if record_log is not None:
+            try:
+                record_log.write(section, self.indicators_json(indicators), ANALYZED, INFORMATIONAL)
+            except Exception as e:
+                self.logger.warning(f"Failed to record {len(indicators)} indicators in {record_log.path}: {e}. Not turning them off.")
+                return []
+        return [indicator['id'] for indicator in indicators]
+
+    def indicators_json(self, indicators):
+        """Return the JSON of a batch of indicators to record.
+
+        The full indicators are fetched from SIP concurrently, like status updates. With
+        [records] full_indicators off, only the fields an Indicator keeps are recorded.
+        """
+        if self.config.getboolean('records', 'full_indicators', fallback=DEFAULT_FULL_INDICATORS):
+            return self.writer.get_indicators([indicator['id'] for indicator in indicators])
+        return [indicator.to_json() if isinstance(indicator, Indicator) else indicator for indicator in indicators]
+
+    def get_tune_rules(self, now=None, sections=None):
+        """Compile the enabled tune sections, or only the ones in sections, into TuneRules."""
+        return [TuneRule.from_config(self.config[section], self.config['default_tune_settings'], now=now) for section in self.get_tune_sections()
+                if sections is None or section in sections]
+
+    def find_indicators_to_turn_off(self, tune_rules, dry_run=True, record_log=None, shard: Shard=None,
+                                    bad_indicators: dict=None, indicators=None, on_classified=None, turned_off: dict=None):
+        """Find indicators to turn off based on the tune rules, searching SIP once for all of them.
+
+        Each indicator is evaluated by every rule whose scope it's in. One that's bad
+        by more than one rule is only turned off by the first, as if each rule had
+        searched SIP after the ones before it had turned their indicators off.
+
+        Only turn off indicators if dry_run is False.
+
+        If a record_log is given, record the indicators we turn off in it.
+
+        If a shard is given, only the indicators in the shard are evaluated. If a
+        bad_indicators dict is given, the bad indicators of each rule are added to
+        it instead of being turned off.
+
+        indicators replace the SIP search, like the changed indicators of an
+        incremental tune. on_classified(correlated, bad) is called with every
+        chunk of (indicator, matched rules, AlertSummary) and the (section, indicator)
+        found to be bad in it. If a turned_off dict is given, the IDs of the
+        indicators each rule turned off are added to it.
+        """
+        with self.metrics.phase(ALL_SECTIONS, 'total'):
+            return self._find_indicators_to_turn_off(tune_rules, dry_run, record_log, shard, bad_indicators, indicators,
+                                                     on_classified, turned_off)
+
+    def _find_indicators_to_turn_off(self, tune_rules, dry_run, record_log, shard, bad_indicators, indicators, on_classified,
+                                     turned_off):
+        if indicators is None:
+            # Search SIP once for the union of every rule's scope. The indicators are streamed a page at a time.
+            query = superset_query(tune_rules)
+            self.logger.info(f"querying sip for indicators matching any of {len(tune_rules)} tune sections: {query}")
+            indicators = self.iter_indicators(query)
+        matching_indicators = self.metrics.timed_iter(ALL_SECTIONS, 'sip_search', indicators)
+        if shard is not None:
+            self.logger.info(f"only evaluating the indicators in shard {shard}")
+            matching_indicators = shard.filter(matching_indicators)
+
+        # Route each indicator to the rules whose scope it's in.
+        overlaps = Counter()
+
+        def in_scope():
+            for indicator in matching_indicators:
+                matched = route(indicator, tune_rules)
+                if not matched:
+                    continue
+                if len(matched) > 1:
+                    sections = tuple(rule.name for rule in matched)
+                    overlaps[sections] += 1
+                    self.logger.debug(f"indicator {indicator['id']} is in the scope of {', '.join(sections)}")
+                yield indicator, matched
+
+        # The rest of the tune is a pipeline of stages connected by bounded queues:
+        # SIP pages -> ACE correlation -> classification -> recording, followed by
+        # SIP status updates. A dry run stops after classification.
+        chunk_size = self.config['ace_db'].getint('chunk_size', DEFAULT_CHUNK_SIZE)
+        correlation_workers = self.config.getint('pipeline', 'correlation_workers', fallback=DEFAULT_CORRELATION_WORKERS)
+        record_workers = self.config.getint('pipeline', 'record_workers', fallback=DEFAULT_RECORD_WORKERS)
+        alert_source = self.alert_source
+        worker_alert_sources = threading.local()
+        counts = {rule.name: Counter() for rule in tune_rules}
+        # ACE summarizes each indicator's alerts once for every distinct cutoff.
+        cutoffs = sorted({rule.cutoff for rule in tune_rules})
+
+        def correlate(routed):
+            # Each correlation worker after the first needs its own ACE connection.
+            source = alert_source
+            if correlation_workers > 1:
+                if not hasattr(worker_alert_sources, 'alert_source'):
+                    worker_alert_sources.alert_source = self.create_alert_source()
+                source = worker_alert_sources.alert_source
+
+            summaries = source.summaries([indicator.id for indicator, matched in routed], cutoffs)
+            yield [(indicator, matched, summaries[indicator.id]) for indicator, matched in routed]
+
+        def find_bad(correlated):
+            # Rules are evaluated in order, a bad indicator is left out of the later rules.
+            bad = []
+            found = set()
+            for rule in tune_rules:
+                summaries = [(indicator, disposition_summary(summary, rule.cutoff)) for indicator, matched, summary in correlated
+                             if rule in matched and indicator.id not in found]
+                for indicator in self.find_bad_indicators(summaries, rule.bad_dispositions, rule.cutoff, counts[rule.name]):
+                    found.add(indicator.id)
+                    bad.append((rule.name, indicator))
+            if on_classified is not None:
+                on_classified(correlated, bad)
+            yield bad
+
+        def record(bad):
+            by_section = {}
+            for section, indicator in bad:
+                by_section.setdefault(section, []).append(indicator)
+            yield [(section, indicator_id) for section, indicators in by_section.items()
+                   for indicator_id in self.record_indicator_tunes(record_log, section, indicators)]
+
+        stages = [Stage('correlate', self.metrics.timed_stage(ALL_SECTIONS, 'ace_correlation', correlate), workers=correlation_workers),
+                  Stage('classify', self.metrics.timed_stage(ALL_SECTIONS, 'classification', find_bad))]
+        collect = bad_indicators is not None
+        if not dry_run and not collect:
+            stages.append(Stage('record', self.metrics.timed_stage(ALL_SECTIONS, 'recording', record), workers=record_workers))
+
+        pipeline = Pipeline(stages, queue_size=self.config.getint('pipeline', 'queue_size', fallback=DEFAULT_QUEUE_SIZE))
+        try:
+            results = pipeline.run(chunks(in_scope(), chunk_size))
+            if collect:
+                for batch in results:
+                    for section, indicator in batch:
+                        bad_indicators.setdefault(section, []).append(indicator)
+            elif dry_run:
+                # Classify every indicator just to log and count them.
+                for batch in results:
+                    pass
+            else:
+                # SIP searches are paged by offset, so turning indicators off while the
+                # search is still being paged through would shift the pages after it and
+                # skip indicators. Only the IDs are kept until the search is done.
+                indicator_ids = {rule.name: [] for rule in tune_rules}
+                for batch in results:
+                    for section, indicator_id in batch:
+                        indicator_ids[section].append(indicator_id)
+                for rule in tune_rules:
+                    self.logger.info(f"Turning off these indicators for {rule.name}.")
+                    with self.metrics.phase(rule.name, 'sip_update'):
+                        summary = self.set_indicator_statuses(indicator_ids[rule.name], INFORMATIONAL, f"Turned off indicators for {rule.name}")
+                    if turned_off is not None:
+                        failed = {result.indicator_id for result in summary.failed}
+                        turned_off[rule.name] = [indicator_id for indicator_id in indicator_ids[rule.name] if indicator_id not in failed]
+        finally:
+            self.close_worker_ace_connections()
+
+        self.logger.info('Found {} Analyzed indicators'.format(self.sip.get('/api/indicators?status=Analyzed&count')))
+        for rule in tune_rules:
+            section_counts = counts[rule.name]
+            for category in ['matching', 'bad', FP_RECON, NO_MATCHING_ALERTS, NO_ALERTS, GOOD]:
+                self.metrics.count_indicators(rule.name, category, section_counts[category])
+            self.logger.info('{}: {} of them are older than {} and in scope'.format(rule.name, section_counts['matching'], str(rule.cutoff)))
+            self.logger.info('{}: {} of those were either FP/RECON/NO ALERTS'.format(rule.name, section_counts['bad']))
+        self.log_tune_overlaps(overlaps)
+
+        if collect:
+            self.logger.info(f"Not turning off these indicators until every shard's are merged.")
+        elif dry_run:
+            self.logger.info(f"Dry run, not turning off these indicators.")
+
         return True
 
-    def create_result_recording_dir(self, dir_name):
-        if not os.path.exists(dir_name):
-            os.makedirs(dir_name)
-        return dir_name
+    def log_tune_overlaps(self, overlaps: Counter):
+        """Log how many indicators were in the scope of more than one tune section."""
+        self.logger.info(f"{sum(overlaps.values())} indicators are in the scope of more than one tune section")
+        for sections, count in sorted(overlaps.items()):
+            self.logger.info(f"{count} indicators are in the scope of {', '.join(sections)}")
+        self.metrics.info['overlaps'] = {'+'.join(sections): count for sections, count in sorted(overlaps.items())}
+
+    def print_tune_scope(self, tune_rules, by_type=False):
+        """Print how many indicators are in each tune rule's scope, counted by SIP without fetching them.
+
+        With by_type, each rule's count is broken down by indicator type, one
+        count query per type. Returns the counts by section, and type if by_type.
+        """
+        indicator_types = None
+        scope = {}
+        for rule in tune_rules:
+            count = self.sip.get(f"{rule.query()}&count")
+            self.metrics.count_indicators(rule.name, 'matching', count)
+            self.logger.info(f"got {count} indicators matching {rule.name}")
+            print(f"\nAn execution of {rule.name} would have {count} indicators in scope for being potentially turned off.")
+            if not by_type:
+                scope[rule.name] = count
+                continue
+
+            if rule.types is None and indicator_types is None:
+                indicator_types = sorted(indicator_type['value'] for indicator_type in self.sip.get('/api/indicators/type'))
+            scope[rule.name] = {}
+            for indicator_type in sorted(rule.types) if rule.types is not None else indicator_types:
+                type_count = self.sip.get(f"{rule.query(types=[indicator_type])}&count")
+                if type_count:
+                    scope[rule.name][indicator_type] = type_count
+                    print(f"    {indicator_type}: {type_count}")
+        if by_type:
+            self.metrics.info['scope_by_type'] = scope
+        print()
+        return scope
+
+    def find_bad_indicators(self, summaries, bad_dispositions, indicator_alert_cutoff_time, counts: Counter):
+        """Classify (indicator, DispositionSummary) pairs and yield the bad indicators.
+
+        The number of indicators classified, bad indicators found and indicators of
+        each classification are kept in counts.
+        """
+        for indicator, summary in summaries:
+            counts['matching'] += 1
+            indicator_id_string = indicator_observable_value(indicator['id'])
+            description = " | ".join([indicator_id_string, indicator["type"], indicator["value"]])
+
+            classification = classify(summary, bad_dispositions)
+            counts[classification] += 1
+            if classification == GOOD:
+                self.logger.info("GOOD INDICATOR: " + description)
+                continue
+
+            counts['bad'] += 1
+            if classification == FP_RECON:
+                self.logger.info("FP/RECON: " + description)
+            elif classification == NO_MATCHING_ALERTS:
+                self.logger.info("NO MATCHING ALERTS AFTER {}: ".format(indicator_alert_cutoff_time) + description)
+            else:
+                self.logger.info("NO ALERTS: " + description)
+            yield indicator
+
+    def get_tune_sections(self):
+        """Return the names of the enabled tune sections."""
+        return [section for section in self.config.sections() if section.startswith('tune_') and self.config[section].getboolean('enabled')]
 
-    def record_indicator_tune(self, recording_dir, indicator):
-        fname = f"{indicator['id']}.json"
-        fpath = os.path.join(recording_dir, fname)
-        with open(fpath, 'w') as fp:
-            fp.write(json.dumps(indicator))
-        if os.path.exists(fpath):
-            self.logger.debug('Wrote indicator "{}" to {}'.format(indicator['id'], fpath))
-            return fpath
-        return False
+    def turn_off_indicators_according_to_tune_instructions(self, dry_run=True, record_changes=True, print_scope_only=False, processes=None,
+                                                           shard_results=None, sections=None, write_metrics=True, scope_by_type=False):
+        """Turn off indicators according to the configured tuning instructions.
 
-    def find_indicators_to_turn_off(self, tune_instructions: configparser.SectionProxy, dry_run=True, recording_dir=None, print_scope_only=False):
-        """Find indicators to turn off based on tuning instructions.
+        With print_scope_only, only print how many indicators are in each tune
+        section's scope, broken down by indicator type with scope_by_type.
 
-        Only turn off indicators if dry_run is True.
+        With more than one process, the indicators are split into that many shards,
+        each evaluated by a worker process, and the shards' bad indicators are
+        merged before any are turned off. shard_results from shard runs on other
+        hosts are merged and turned off the same way.
 
-        If recording_dir points to a directory that exists, record the indicators we turn off there.
+        If sections are given, only those tune sections are run.
         """
-        # Only consider indicators that are at least this old.
-        tuning_days = tune_instructions.getint('days') if 'days' in tune_instructions else self.config['default_tune_settings'].getint('days', 90)
-        min_age = datetime.datetime.now() - datetime.timedelta(days=tuning_days)
-
-        # Start building the sip query.
-        query = f"/api/indicators?&status=Analyzed&modified_before={min_age}"
-
-        # Only consider these indicator types.
-        bad_indicator_types = tune_instructions['indicator_types'].split(',') if tune_instructions.get('indicator_types') else []
-        if not bad_indicator_types:
-            # tune instructions didn't specify any indicator types, so use all of them.
-            bad_indicator_types = [i['value'] for i in self.sip.get('/api/indicators/type')]
-        query += '&types=' + ','.join(bad_indicator_types)
-        #query += f"&types={','.join(bad_indicator_types)}"
-
-        # Only consider these SIP intel sources.
-        sources_in_scope = tune_instructions['sources'].split(',') if tune_instructions.get('sources') else []
-        #if not sources_in_scope:
-        #    sources_in_scope = [s['value'] for s in self.sip.get('/api/intel/source')]
-        if sources_in_scope:
-            query += '&sources=[OR]' + ','.join(sources_in_scope)
-
-        not_sources_in_scope = tune_instructions['not_sources'].split(',') if tune_instructions.get('not_sources') else []
-        if not_sources_in_scope:
-            query += '&not_sources=' + ','.join(not_sources_in_scope)
-
-        # Do not tune intel from these analysts.
-        good_analysts = tune_instructions['good_analysts'].split(',') if tune_instructions.get('good_analysts') else []
-        query += '&not_users=' + ','.join(good_analysts)
-
-        # Do not tune indicators with these tags. 
-        good_tags = tune_instructions['good_tags'].split(',') if tune_instructions.get('good_tags') else []
-        query += '&not_tags=' + ','.join(good_tags)
-
-        # Search SIP for the indicators in scope.
-        self.logger.info(f"querying sip for indicators matching: {query}")
-        matching_indicators = self.sip.get(query)
-        self.logger.info(f"got {len(matching_indicators)} matching indicators")
-
-        if print_scope_only:
-            print(f"\nAn execution of this tuning config would have {len(matching_indicators)} indicators in scope for being potentially turned off.")
-            print()
+        tune_sections = self.get_tune_sections()
+        if sections:
+            unknown = [section for section in sections if section not in tune_sections]
+            if unknown:
+                self.logger.error(f"Not enabled tune sections: {', '.join(unknown)}")
+                return False
+            tune_sections = [section for section in tune_sections if section in sections]
+        if not tune_sections and shard_results is None:
+            self.logger.info("No tuning instructions found.")
+            return True
+
+        self.write_summaries = []
+
+        if shard_results is None and processes and processes > 1 and not print_scope_only:
+            shard_results = self.run_local_shards(TUNE, processes, sections=tune_sections)
+
+        # Every indicator this run turns off is recorded in one record log.
+        record_log = None
+        if record_changes and not dry_run and not print_scope_only:
+            record_log = self.record_store.open_run()
+
+        if shard_results is not None:
+            try:
+                merged_sections = merge_tune_results(shard_results, sections=tune_sections if sections else None)
+            except ValueError as e:
+                self.logger.error(f"Unable to merge tune shard results: {e}")
+                return False
+            tune_sections = list(merged_sections)
+            for section, indicators in merged_sections.items():
+                self.turn_off_merged_indicators(section, indicators, dry_run, record_log)
+        elif print_scope_only:
+            self.print_tune_scope(self.get_tune_rules(sections=tune_sections), by_type=scope_by_type)
+        else:
+            self.logger.info(f"Turning off indicators according to {', '.join(tune_sections)}")
+            self.find_indicators_to_turn_off(self.get_tune_rules(sections=tune_sections), dry_run, record_log=record_log)
+
+        self.log_turned_off(record_log)
+        self.metrics.info.update({'command': 'tune_intel',
+                                  'dry_run': dry_run,
+                                  'shards': len(shard_results) if shard_results is not None else None,
+                                  'print_scope_only': print_scope_only,
+                                  'sections': tune_sections,
+                                  'turned_off': sum(summary.succeeded for summary in self.write_summaries),
+                                  'failed': sum(len(summary.failed) for summary in self.write_summaries)})
+        if write_metrics:
+            self.write_metrics()
+
+        return True
+
+    def log_turned_off(self, record_log=None):
+        """Log how many indicators this run recorded and turned off."""
+        if record_log is not None and record_log.count:
+            self.logger.info(f"Recorded {record_log.count} indicators turned off in {record_log.path}")
+
+        if self.write_summaries:
+            updated = sum(summary.succeeded for summary in self.write_summaries)
+            failed = sum(len(summary.failed) for summary in self.write_summaries)
+            seconds = sum(summary.elapsed for summary in self.write_summaries)
+            rate = (updated + failed) / seconds if seconds else 0.0
+            self.logger.info(f"Turned off {updated} indicators in {seconds:.1f} seconds ({rate:.1f}/sec), {failed} failed")
+
+    @property
+    def incremental_state(self):
+        """The IncrementalState of incremental tunes, described by the [incremental] config section."""
+        if self._incremental_state is None:
+            self._incremental_state = IncrementalState.from_config(self.config, HOME_PATH)
+        return self._incremental_state
+
+    def turn_off_indicators_incrementally(self, dry_run=True, record_changes=True, write_metrics=True):
+        """Turn off indicators according to the tuning instructions, only evaluating the ones whose outcome can have changed.
+
+        Those are the indicators modified in SIP, the ones with new or newly
+        dispositioned ACE alerts and the ones aging into a tune section's scope
+        or out of its alert window since the last incremental run. The first
+        incremental run evaluates every Analyzed indicator. A dry run leaves the
+        incremental state as it was.
+        """
+        tune_sections = self.get_tune_sections()
+        if not tune_sections:
+            self.logger.info("No tuning instructions found.")
             return True
 
-        # Only consider these ACE alert dispositions.
-        bad_dispositions = tune_instructions['dispositions'].split(',') if tune_instructions.get('dispositions') else []
-        if not bad_dispositions:
-            bad_dispositions = self.config['default_tune_settings']['dispositions'].split(',')
-
-        # Search ACE for alerts from each indicator.
-        ace_cur = self.connect_to_ace()
-        bad_indicators = []
-        for indicator in matching_indicators:
-            good = True
-            indicator_id = indicator['id']
-            indicator_id_string = 'sip:{}'.format(indicator_id)
-            #indicator_alert_cutoff_time = indicator_created + datetime.timedelta(days=30)
-            indicator_alert_cutoff_time = min_age
-
-            # Query the ACE database for this indicator ID.
-            ace_cur.execute("""SELECT * FROM
-                                   observables o JOIN observable_mapping om ON o.id = om.observable_id
-                                   JOIN alerts a ON a.id = om.alert_id
-                               WHERE
-                                   o.type = 'indicator' AND o.value = '""" + indicator_id_string + "' AND a.alert_type != 'faqueue'")
-
-            # Get all of the results.
-            results = ace_cur.fetchall()
-
-            # If we have alerted on this indicator...
-            if results:
-
-                # Collect all of the dispositions for this indicator.
-                dispositions = []
-
-                for alert in results:
-
-                    # Skip this alert if it's from FA Queue.
-                    if 'FA Queue' in alert['description']:
-                        continue
-
-                    # Skip this alert if it's older than the cutoff time.
-                    alert_created_time = alert['insert_date']
-                    if alert_created_time < indicator_alert_cutoff_time:
-                        continue
-                    
-                    dispositions.append(alert['disposition'])
-
-                # Mark this as a bad indicator if all of the alerts were bad dispositions.
-                if dispositions:
-                    if all(dispo in bad_dispositions for dispo in dispositions):
-                        bad_indicators.append(indicator)
-                        self.logger.info("FP/RECON: " + " | ".join([indicator_id_string, indicator["type"], indicator["value"]]))
-                        good = False
+        self.write_summaries = []
+        now = datetime.datetime.now()
+        tune_rules = self.get_tune_rules(now=now)
+        state = self.incremental_state
+        fingerprint = rules_fingerprint(self.config, tune_sections)
+        changes = Counter()
+
+        # Take the new ACE watermarks before anything is read, so what changes during the run is picked up by the next one.
+        ace_cursor = self.connect_to_ace()
+        ace_alert_id, ace_disposition_time = query_ace_watermarks(ace_cursor)
+
+        sip_modified_time = state.get_state('sip_modified_time')
+        if sip_modified_time is None:
+            self.logger.info("First incremental tune, evaluating every Analyzed indicator.")
+            sip_query = f"/api/indicators?status={ANALYZED}"
+            affected_ids = set()
+        else:
+            sip_query = f"/api/indicators?modified_after={sip_modified_time}"
+            ace_changed_ids = query_changed_indicator_ids(ace_cursor, int(state.get_state('ace_alert_id', 0)), state.get_state('ace_disposition_time'),
+                                                          to_text(now - state.resync_window), fetch_size=self.ace_fetch_size)
+            affected_ids = state.known(ace_changed_ids)
+            changes['ace_changed'] = len(affected_ids)
+            due_ids = state.due(now)
+            changes['aged'] = len(due_ids - affected_ids)
+            affected_ids |= due_ids
+            if state.get_state('rules') != fingerprint:
+                self.logger.info("The tune sections changed since the last incremental tune, evaluating every known indicator again.")
+                affected_ids |= state.all_ids()
+
+        # The ACE cache has to have every alert up to the watermarks.
+        if self.config.getboolean('ace_cache', 'enabled', fallback=False):
+            self.refresh_alert_source(force=True)
+
+        sip_changed_ids = set()
+        removed_ids = []
+        latest = {'modified_time': sip_modified_time, 'parsed': parse_time(sip_modified_time) if sip_modified_time else None}
+
+        def changed_indicators():
+            self.logger.info(f"querying sip for changed indicators: {sip_query}")
+            for indicator in self.iter_indicators(sip_query):
+                sip_changed_ids.add(indicator.id)
+                modified_time = parse_time(indicator.modified_time)
+                if modified_time is not None and (latest['parsed'] is None or modified_time > latest['parsed']):
+                    latest.update(modified_time=indicator.modified_time, parsed=modified_time)
+                if indicator.status != ANALYZED:
+                    removed_ids.append(indicator.id)
+                    continue
+                yield indicator
+            changes['sip_changed'] = len(sip_changed_ids)
+            # The rest come from the state, they haven't changed in SIP.
+            yield from state.iter_indicators(affected_ids - sip_changed_ids)
+
+        def tracked(indicators):
+            # Out of scope indicators are only kept. The ones in scope are kept once they're classified.
+            for indicator in indicators:
+                changes['evaluated'] += 1
+                state.save(indicator, None, recheck_time(indicator, tune_rules, now), now)
+                yield indicator
+
+        def on_classified(correlated, bad):
+            bad_sections = {indicator.id: section for section, indicator in bad}
+            for indicator, matched, summary in correlated:
+                if indicator.id in bad_sections:
+                    # Evaluated again by the next run, unless it's turned off.
+                    state.save(indicator, bad_sections[indicator.id], now, now)
                 else:
-                    bad_indicators.append(indicator)
-                    self.logger.info("NO MATCHING ALERTS AFTER {}: ".format(indicator_alert_cutoff_time) + " | ".join([indicator_id_string, indicator["type"], indicator["value"]]))
-                    good = False
-            # Since we didn't alert on it, mark it as bad.
-            else:
-                bad_indicators.append(indicator)
-                self.logger.info("NO ALERTS: " + " | ".join([indicator_id_string, indicator["type"], indicator["value"]]))
-                good = False
+                    state.save(indicator, GOOD, recheck_time(indicator, tune_rules, now, summary=summary, good_rules=matched), now)
 
-            if good:
-                self.logger.info("GOOD INDICATOR: " + " | ".join([indicator_id_string, indicator["type"], indicator["value"]]))
+        record_log = None
+        if record_changes and not dry_run:
+            record_log = self.record_store.open_run()
 
-        self.logger.info('Found {} Analyzed indicators'.format(self.sip.get('/api/indicators?status=Analyzed&count')))
-        self.logger.info('{} of them are older than {}'.format(len(matching_indicators), str(min_age)))
-        self.logger.info('{} of those were either FP/RECON/NO ALERTS'.format(len(bad_indicators), str(min_age)))
+        turned_off = {}
+        try:
+            self.find_indicators_to_turn_off(tune_rules, dry_run, record_log=record_log, indicators=tracked(changed_indicators()),
+                                             on_classified=on_classified, turned_off=turned_off)
+        except Exception:
+            state.rollback()
+            raise
 
+        self.logger.info(f"Incremental tune evaluated {changes['evaluated']} indicators: {changes['sip_changed']} changed in SIP, "
+                         f"{changes['ace_changed']} with new ACE alerts or dispositions and {changes['aged']} aging into a tune section "
+                         f"or out of its alert window")
+        if dry_run:
+            state.rollback()
+            self.logger.info("Dry run, not keeping the incremental state.")
+        else:
+            state.delete(removed_ids)
+            state.delete([indicator_id for indicator_ids in turned_off.values() for indicator_id in indicator_ids])
+            state.set_state('sip_modified_time', latest['modified_time'] or now)
+            state.set_state('ace_alert_id', ace_alert_id)
+            state.set_state('ace_disposition_time', ace_disposition_time)
+            state.set_state('rules', fingerprint)
+            state.set_state('last_run', now)
+            state.commit()
+
+        self.log_turned_off(record_log)
+        self.metrics.info.update({'command': 'tune_intel',
+                                  'incremental': True,
+                                  'dry_run': dry_run,
+                                  'sections': tune_sections,
+                                  'changes': dict(changes),
+                                  'turned_off': sum(summary.succeeded for summary in self.write_summaries),
+                                  'failed': sum(len(summary.failed) for summary in self.write_summaries)})
+        if write_metrics:
+            self.write_metrics()
+        return True
+
+    def turn_off_merged_indicators(self, section, indicators, dry_run, record_log=None):
+        """Record and turn off the bad indicators a section found in every shard."""
+        self.logger.info(f"{len(indicators)} indicators from every shard of {section} are either FP/RECON/NO ALERTS")
+        self.metrics.count_indicators(section, 'bad', len(indicators))
         if dry_run:
             self.logger.info(f"Dry run, not turning off these indicators.")
             return True
 
+        chunk_size = self.config['ace_db'].getint('chunk_size', DEFAULT_CHUNK_SIZE)
+        indicator_ids = []
+        with self.metrics.phase(section, 'recording'):
+            for batch in chunks(indicators, chunk_size):
+                indicator_ids.extend(self.record_indicator_tunes(record_log, section, batch))
         self.logger.info("Turning off these indicators.")
-        for indicator in bad_indicators:
-            if os.path.exists(recording_dir):
-                if not self.record_indicator_tune(recording_dir, indicator):
-                    self.logger.warning(f'Failed to write indicator "{indicator["id"]}.json" to {recording_dir}. Not turning off.')
-                    continue
-            self.disable_indicator(indicator)
-
+        with self.metrics.phase(section, 'sip_update'):
+            self.set_indicator_statuses(indicator_ids, INFORMATIONAL, f"Turned off indicators for {section}")
         return True
 
-    def turn_off_indicators_according_to_tune_instructions(self, dry_run=True, record_changes=True, print_scope_only=False):
-        """Turn off indicators according to the configured tuning instructions.
+    def write_tune_plan(self, path, sections=None, write_metrics=True):
+        """Evaluate the tune sections, or only the given ones, like a dry run and write what they would turn off to a plan at path.
+
+        Nothing is turned off. apply_tune_plan turns off the plan's indicators later.
         """
-        tune_sections = [section for section in self.config.sections() if section.startswith('tune_') and self.config[section].getboolean('enabled')]
+        tune_sections = self.get_tune_sections()
+        if sections:
+            unknown = [section for section in sections if section not in tune_sections]
+            if unknown:
+                self.logger.error(f"Not enabled tune sections: {', '.join(unknown)}")
+                return False
+            tune_sections = [section for section in tune_sections if section in sections]
         if not tune_sections:
             self.logger.info("No tuning instructions found.")
-            return True
+            return False
+
+        now = datetime.datetime.now()
+        tune_rules = self.get_tune_rules(now=now, sections=tune_sections)
+        # Take the ACE watermarks before anything is read, so alerts during the evaluation count as changes when the plan is applied.
+        ace_alert_id, ace_disposition_time = query_ace_watermarks(self.connect_to_ace())
+        plan = TunePlan(now.isoformat(' '), 'production' if self.prod else 'dev', ace_alert_id=ace_alert_id, ace_disposition_time=ace_disposition_time)
+        rules = {rule.name: rule for rule in tune_rules}
+        for rule in tune_rules:
+            plan.add_section(rule.name, to_text(rule.cutoff), rule.bad_dispositions)
 
-        for section in tune_sections:
-            recording_dir = None
-            if record_changes:
-                recording_dir = os.path.join(HOME_PATH, "var", "records", f"{datetime.datetime.now().date()}", section)
-                self.create_result_recording_dir(recording_dir) 
+        def on_classified(correlated, bad):
+            summaries = {indicator.id: summary for indicator, matched, summary in correlated}
+            for section, indicator in bad:
+                rule = rules[section]
+                summary = summaries[indicator.id]
+                plan.sections[section].add(PlanEntry(indicator.id,
+                                                     classify(disposition_summary(summary, rule.cutoff), rule.bad_dispositions),
+                                                     indicator.modified_time,
+                                                     to_text(summary.last_alert_time)))
 
-            self.logger.info(f"Turning off indicators according to {section}")
-            self.find_indicators_to_turn_off(self.config[section], dry_run, recording_dir=recording_dir, print_scope_only=print_scope_only)
+        self.logger.info(f"Planning the tune of {', '.join(tune_sections)}")
+        self.find_indicators_to_turn_off(tune_rules, dry_run=True, on_classified=on_classified)
+        plan.write(path)
+        print(f"Wrote a plan to turn off {len(plan)} indicators to {path}")
 
+        self.metrics.info.update({'command': 'tune_intel',
+                                  'plan': path,
+                                  'sections': tune_sections,
+                                  'planned': {name: len(section) for name, section in plan.sections.items()}})
+        if write_metrics:
+            self.write_metrics()
         return True
 
+    def find_stale_plan_ids(self, plan: TunePlan):
+        """Return the IDs of the plan's indicators that changed in SIP or got new or newly dispositioned ACE alerts since it was made.
+
+        SIP is searched for the indicators modified since the plan was made,
+        less the [incremental] resync_window_hours to allow for clock skew, and
+        ACE is tailed past the plan's watermarks.
+        """
+        plan_ids = plan.ids()
+        resync_window = datetime.timedelta(hours=self.config.getfloat('incremental', 'resync_window_hours', fallback=DEFAULT_RESYNC_WINDOW_HOURS))
+        since = to_text(datetime.datetime.fromisoformat(plan.created) - resync_window)
+
+        entries = {indicator_id: entry for section in plan.sections.values() for indicator_id, entry in section.entries.items()}
+        stale_ids = set()
+        for indicator in self.iter_indicators(f"/api/indicators?modified_after={since}"):
+            if indicator.id not in plan_ids:
+                continue
+            if indicator.status != ANALYZED or parse_time(indicator.modified_time) != parse_time(entries[indicator.id].modified_time):
+                stale_ids.add(indicator.id)
+        sip_stale = len(stale_ids)
+
+        ace_changed_ids = query_changed_indicator_ids(self.connect_to_ace(), plan.ace_alert_id, plan.ace_disposition_time, since,
+                                                      fetch_size=self.ace_fetch_size)
+        stale_ids |= ace_changed_ids & plan_ids
+        self.logger.info(f"{sip_stale} planned indicators changed in SIP and {len(stale_ids) - sip_stale} more have new ACE alerts "
+                         f"since the plan was made {plan.created}")
+        return stale_ids
+
+    def apply_tune_plan(self, path, check_stale=False, dry_run=False, record_changes=True, write_metrics=True):
+        """Turn off the indicators of a plan written by write_tune_plan, section by section, without correlating them with ACE again.
+
+        With check_stale, the indicators that changed since the plan was made are left out.
+        """
+        try:
+            plan = TunePlan.read(path)
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Unable to read the plan {path}: {e}")
+            return False
+        environment = 'production' if self.prod else 'dev'
+        if plan.environment != environment:
+            self.logger.error(f"{path} is a plan for {plan.environment} SIP, not {environment}.")
+            return False
+
+        self.write_summaries = []
+        self.logger.info(f"Applying the plan {path} of {len(plan)} indicators, made {plan.created}")
+        stale = 0
+        if check_stale:
+            stale = plan.remove(self.find_stale_plan_ids(plan))
+            self.logger.info(f"Leaving {stale} indicators that changed since the plan was made out")
+
+        record_log = None
+        if record_changes and not dry_run:
+            record_log = self.record_store.open_run()
+
+        chunk_size = self.config['ace_db'].getint('chunk_size', DEFAULT_CHUNK_SIZE)
+        for name, section in plan.sections.items():
+            self.logger.info(f"{len(section)} indicators of {name} are either FP/RECON/NO ALERTS")
+            self.metrics.count_indicators(name, 'bad', len(section))
+            if dry_run:
+                continue
+            indicator_ids = []
+            with self.metrics.phase(name, 'recording'):
+                for batch in chunks(section.ids(), chunk_size):
+                    indicators = [{'id': indicator_id, 'modified_time': section.entries[indicator_id].modified_time} for indicator_id in batch]
+                    indicator_ids.extend(self.record_indicator_tunes(record_log, name, indicators))
+            self.logger.info(f"Turning off these indicators for {name}.")
+            with self.metrics.phase(name, 'sip_update'):
+                self.set_indicator_statuses(indicator_ids, INFORMATIONAL, f"Turned off indicators for {name}")
+        if dry_run:
+            self.logger.info(f"Dry run, not turning off these indicators.")
+
+        self.log_turned_off(record_log)
+        self.metrics.info.update({'command': 'apply',
+                                  'plan': path,
+                                  'dry_run': dry_run,
+                                  'sections': list(plan.sections),
+                                  'stale': stale,
+                                  'turned_off': sum(summary.succeeded for summary in self.write_summaries),
+                                  'failed': sum(len(summary.failed) for summary in self.write_summaries)})
+        if write_metrics:
+            self.write_metrics()
+        return True
+
+    def print_plan_diff(self, old_path, new_path, show_ids=False):
+        """Print how many indicators each tune section added, removed and classified differently from the old plan to the new one."""
+        try:
+            old, new = TunePlan.read(old_path), TunePlan.read(new_path)
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Unable to read the plans: {e}")
+            return None
+        diff = diff_plans(old, new)
+        print(f"{old_path} ({old.created}, {len(old)} indicators) -> {new_path} ({new.created}, {len(new)} indicators)")
+        for name, changes in diff.items():
+            print(f"{name}: +{len(changes['added'])} -{len(changes['removed'])} {len(changes['reason_changed'])} reasons changed")
+            if show_ids:
+                for change, indicator_ids in changes.items():
+                    if indicator_ids:
+                        print(f"  {change}: {' '.join(str(indicator_id) for indicator_id in indicator_ids)}")
+        return diff
+
+    def new_manager(self):
+        """Return a new IndicatorManager with the same settings and its own SIP client and ACE connection."""
+        return IndicatorManager(config=self.config, dev=not self.prod, sip=self._sip, ace_cursor_factory=self._ace_cursor_factory)
+
+    def run_shard(self, kind, shard: Shard, output_path, sip_query_filter='status=Analyzed', sections=None):
+        """Evaluate one shard of a tune or indicator type report and write its result to output_path.
+
+        Nothing is turned off, the shard results are merged first. A tune shard
+        only evaluates the tune sections in sections, if they're given.
+        """
+        if kind == TUNE:
+            tune_rules = self.get_tune_rules(sections=sections)
+            sections = {rule.name: [] for rule in tune_rules}
+            self.logger.info(f"Finding indicators to turn off according to {', '.join(sections)} in shard {shard}")
+            self.find_indicators_to_turn_off(tune_rules, dry_run=True, shard=shard, bad_indicators=sections)
+            return write_shard_result(output_path, TUNE, shard,
+                                      sections={section: [indicator.to_json() for indicator in indicators] for section, indicators in sections.items()})
+
+        report = self.build_indicator_type_report(sip_query_filter, shard=shard)
+        return write_shard_result(output_path, REPORT, shard, report=report)
+
+    def run_local_shards(self, kind, processes, sip_query_filter='status=Analyzed', sections=None):
+        """Run every shard of a tune or indicator type report in its own worker process and return their results."""
+        # Sync a stale ACE cache once, before the workers would each try to.
+        if self.config.getboolean('ace_cache', 'enabled', fallback=False):
+            self.alert_source
+
+        output_dir = os.path.join(HOME_PATH, "var", "shards", f"{kind}_{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}_{os.getpid()}")
+        self.logger.info(f"Running the {kind} in {processes} shards")
+
+        def run_shard(shard, output_path):
+            self.new_manager().run_shard(kind, shard, output_path, sip_query_filter=sip_query_filter, sections=sections)
+
+        try:
+            paths = run_local_shards(run_shard, processes, output_dir, kind)
+            return [read_shard_result(path) for path in paths]
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    def write_metrics(self):
+        """Write the run metrics as a Prometheus textfile and a JSON run summary, unless [metrics] is disabled."""
+        if not self.config.getboolean('metrics', 'enabled', fallback=True):
+            return None
+        directory = self.config.get('metrics', 'directory', fallback=DEFAULT_METRICS_DIR)
+        if not os.path.isabs(directory):
+            directory = os.path.join(HOME_PATH, directory)
+        try:
+            return self.metrics.write(directory)
+        except Exception as e:
+            self.logger.error(f"unable to write run metrics to {directory}: {e}")
+            return None
+
     def reset_in_progress(self):
-        # Get the initial list of In Progress indicators.
-        matching_indicators = self.sip.get('/api/indicators?status=In Progress&bulk=true')
-        self.logger.info(f'There are {len(matching_indicators)} In Progress indicators.')
-        for indicator in matching_indicators:
+        # Get the initial list of In Progress indicators. Only their IDs are kept.
+        indicator_ids = []
+        for indicator in self.iter_indicators('/api/indicators?status=In Progress'):
+            indicator_ids.append(indicator['id'])
             print(indicator['id'])
             print(indicator['value'])
             print()
+        self.logger.info(f'There are {len(indicator_ids)} In Progress indicators.')
 
-        print('Found {} indicators'.format(len(matching_indicators)))
+        print('Found {} indicators'.format(len(indicator_ids)))
         proceed = input('Proceed with enabling these indicators (y/n)? ')
         if proceed == 'y':
-            for indicator in matching_indicators:
-                self.enable_indicator(indicator)
+            self.set_indicator_statuses(indicator_ids, NEW, 'Reset In Progress indicators')
 
-    def get_indicator_type_report(self, sip_query_filter='status=Analyzed', print_report=True, write_report=True):
-        ace = self.connect_to_ace()
+    def set_status_for_records(self, status, date=None, section=None, run=None, indicator_ids=None):
+        """Set the status of every recorded indicator matching the filters.
 
-        if not self.indicators:
-            self.indicators = self.sip.get(f"/api/indicators?&{sip_query_filter}")
+        This is how a tune gets undone (status Analyzed) or redone (status Informational).
+        The records are streamed to the SIP status updates as they are read.
+        """
+        filters = {'date': date, 'section': section, 'run': run, 'indicator_ids': indicator_ids}
+        if not any(filters.values()):
+            self.logger.error("Refusing to set the status of every recorded indicator, give a date, section, run or indicator IDs.")
+            return False
 
-        total_analyzed_indicators = len(self.indicators)
-        # The report results.
-        # report = {'indicator_type': {'count': 53, 'dispo1': 17, 'dispo2': 484}}
-        report = {'sip_query_filter': sip_query_filter,
-                  'results': {}}
+        description = "Set indicators recorded for {} to {}".format(', '.join(f"{key}={value}" for key, value in filters.items() if value), status)
+        self.logger.info(description)
+        summary = self.set_indicator_statuses(self.record_store.iter_indicator_ids(**filters), status, description)
+        if not summary.total:
+            self.logger.warning("No recorded indicators matched.")
+        return not summary.failed
 
-        # Set up the report structure and count the indicators by their type.
-        for indicator in self.indicators:
-            if indicator['type'] in report:
-                report['results'][indicator['type']]['count'] += 1
-            else:
-                report['results'][indicator['type']] = {}
-                report['results'][indicator['type']]['count'] = 1
-                report['results'][indicator['type']]['total_alerts'] = 0
-                report['results'][indicator['type']]['no_alerts'] = 0
-                report['results'][indicator['type']]['manual_indicators'] = 0
+    def set_status_for_recorded_indicators(self, recording_dir, status):
+        """Set the status of every indicator recorded in a recording_dir, like var/records/2022-02-10/tune_external_intel.
 
-        # Now check each indicator to see if it has alerted.
-        desc = "Correlating SIP and ACE data"
-        for indicator in tqdm(self.indicators, desc=desc):
-            indicator_id = indicator['id']
-            indicator_id_string = f"sip:{indicator['id']}"
-            indicator_type = indicator['type']
-            idata = self.sip.get(f"/api/indicators/{indicator_id}")
-            if 'tags' in idata and 'manual_indicator' in idata['tags']:
-                report['results'][indicator['type']]['manual_indicators'] += 1
-    
-            # Query the ACE database for this indicator ID.
-            ace.execute("""SELECT * FROM
-                                   observables o JOIN observable_mapping om ON o.id = om.observable_id
-                                   JOIN alerts a ON a.id = om.alert_id
-                               WHERE
-                                   o.type = 'indicator' AND o.value = '""" + indicator_id_string + "' AND a.alert_type != 'faqueue'")
-    
-            # Get all of the results.
-            results = ace.fetchall()
-    
-            # If we have alerted on this indicator...
-            if results:
-                # Collect the dispositions from every alert.
-                dispositions = [alert['disposition'] for alert in results if alert['disposition']]
-
-                # Store the unique dispositions in the report for the indicator type.
-                for disposition in set(dispositions):
-                    if disposition:
-                        if disposition not in report['results'][indicator_type]:
-                            report['results'][indicator_type][disposition] = 0
+        The date and section of the directory are looked up in the record logs as well as
+        the per-indicator JSON files older versions wrote. A run's record log, like
+        var/records/2022-02-10/20220210T120000_1234.jsonl.gz, can be given too.
+        """
+        path = os.path.normpath(recording_dir)
+        name = os.path.basename(path)
+        if name.endswith(RECORD_LOG_SUFFIX):
+            return self.set_status_for_records(status, run=name[:-len(RECORD_LOG_SUFFIX)])
+        return self.set_status_for_records(status, date=os.path.basename(os.path.dirname(path)), section=name)
 
-                # Store the disposition counts in the report structure.
-                for disposition in dispositions:
-                    if disposition:
-                        report['results'][indicator_type][disposition] += 1
+    def print_records(self, date=None, section=None):
+        """Print the recorded tune runs."""
+        for date, run, section, count in self.record_store.runs(date=date, section=section):
+            print(f"{date} {run} {section}: {count} indicators")
+        return True
+
+    def cleanup_records(self, retention_days=None):
+        """Delete records older than retention_days, or the [records] retention_days."""
+        deleted = self.record_store.cleanup(retention_days)
+        self.logger.info(f"Deleted the records of {len(deleted)} days")
+        return deleted
+
+    def sync_ace_cache(self, rebuild=False):
+        """Sync the local ACE cache, or rebuild it from scratch."""
+        cache = self.get_alert_cache()
+        if rebuild:
+            self.logger.info(f"Rebuilding ACE cache {cache.path}")
+            return cache.rebuild(self.connect_to_ace(), fetch_size=self.ace_fetch_size)
+        return cache.sync(self.connect_to_ace(), fetch_size=self.ace_fetch_size)
+
+    def print_ace_cache_status(self):
+        """Print the state of the local ACE cache. Returns True if it's stale."""
+        cache = self.get_alert_cache()
+        max_age_minutes = self.config.getint('ace_cache', 'max_age_minutes', fallback=DEFAULT_MAX_AGE_MINUTES)
+        stale = cache.is_stale(max_age_minutes)
+        for key, value in cache.status().items():
+            print(f"{key}: {value}")
+        print(f"stale: {stale} (max age {max_age_minutes} minutes)")
+        return stale
+
+    @property
+    def rollup_store(self):
+        """The RollupStore of indicator effectiveness rollups, described by the [rollups] config section."""
+        if self._rollup_store is None:
+            self._rollup_store = RollupStore.from_config(self.config, HOME_PATH)
+        return self._rollup_store
+
+    def refresh_rollups(self, rebuild=False):
+        """Update the rollups with the indicators that changed in SIP or ACE since the last refresh, or rebuild them from scratch.
 
-                report['results'][indicator_type]['total_alerts'] += len(dispositions)
+        The first refresh counts every Analyzed indicator. Returns a Counter of what changed.
+        """
+        store = self.rollup_store
+        if rebuild:
+            self.logger.info(f"Rebuilding the rollups in {store.path}")
+            store.clear()
+        now = datetime.datetime.now()
+        changes = Counter()
+
+        # Take the new ACE watermarks before anything is read, so what changes during the refresh is picked up by the next one.
+        ace_cursor = self.connect_to_ace()
+        ace_alert_id, ace_disposition_time = query_ace_watermarks(ace_cursor)
+
+        sip_modified_time = store.get_state('sip_modified_time')
+        if sip_modified_time is None:
+            self.logger.info("First rollup refresh, counting every Analyzed indicator.")
+            sip_query = f"/api/indicators?status={ANALYZED}"
+            ace_changed_ids = set()
+        else:
+            sip_query = f"/api/indicators?modified_after={sip_modified_time}"
+            resync_window = datetime.timedelta(hours=self.config.getfloat('incremental', 'resync_window_hours', fallback=DEFAULT_RESYNC_WINDOW_HOURS))
+            ace_changed_ids = store.known(query_changed_indicator_ids(ace_cursor, int(store.get_state('ace_alert_id', 0)),
+                                                                      store.get_state('ace_disposition_time'), to_text(now - resync_window),
+                                                                      fetch_size=self.ace_fetch_size))
+
+        # The ACE cache has to have every alert up to the watermarks.
+        if self.config.getboolean('ace_cache', 'enabled', fallback=False):
+            self.refresh_alert_source(force=True)
+        alert_source = self.alert_source
+        chunk_size = self.config['ace_db'].getint('chunk_size', DEFAULT_CHUNK_SIZE)
+
+        sip_changed_ids = set()
+        latest = {'modified_time': sip_modified_time, 'parsed': parse_time(sip_modified_time) if sip_modified_time else None}
+        try:
+            self.logger.info(f"querying sip for changed indicators: {sip_query}")
+            for chunk in chunks(self.iter_indicators(sip_query), chunk_size):
+                for indicator in chunk:
+                    sip_changed_ids.add(indicator.id)
+                    modified_time = parse_time(indicator.modified_time)
+                    if modified_time is not None and (latest['parsed'] is None or modified_time > latest['parsed']):
+                        latest.update(modified_time=indicator.modified_time, parsed=modified_time)
+                analyzed = [indicator for indicator in chunk if indicator.status == ANALYZED]
+                store.delete([indicator.id for indicator in chunk if indicator.status != ANALYZED])
+                store.save(analyzed, alert_source.alerts([indicator.id for indicator in analyzed]))
+                changes['sip_changed'] += len(chunk)
+                changes['removed'] += len(chunk) - len(analyzed)
+
+            # The rest only have new alerts, they haven't changed in SIP.
+            for chunk in chunks(sorted(ace_changed_ids - sip_changed_ids), chunk_size):
+                store.save_alerts(alert_source.alerts(chunk))
+                changes['ace_changed'] += len(chunk)
+        except Exception:
+            store.rollback()
+            raise
+
+        if latest['modified_time'] is not None:
+            store.set_state('sip_modified_time', latest['modified_time'])
+        store.set_state('ace_alert_id', ace_alert_id)
+        store.set_state('ace_disposition_time', ace_disposition_time)
+        store.set_state('last_refresh', now)
+        store.commit()
+        self.logger.info(f"Refreshed the rollups in {store.path}: {dict(changes)}")
+        return changes
+
+    def print_rollups(self, by=('type',), output_format='table', output=None, **filters):
+        """Print the rollups grouped by the dimensions in by as a table, JSON or CSV, or write them to output.
+
+        filters are the RollupStore.query filters, like sources or since.
+        """
+        rows = self.rollup_store.query(by=by, **filters)
+        columns = []
+        for row in rows:
+            columns.extend(column for column in row if column not in columns)
+        # The alerts of each disposition go last, in order.
+        columns = [column for column in columns if not column.isupper()] + sorted(column for column in columns if column.isupper())
+
+        fp = open(output, 'w', newline='') if output else sys.stdout
+        try:
+            if output_format == 'json':
+                fp.write(json.dumps(rows, indent=2) + "\n")
+            elif output_format == 'csv':
+                writer = csv.DictWriter(fp, fieldnames=columns, restval=0)
+                writer.writeheader()
+                writer.writerows(rows)
             else:
-                report['results'][indicator['type']]['no_alerts'] += 1
+                widths = {column: max([len(column)] + [len(str(row.get(column, 0))) for row in rows]) for column in columns}
+                fp.write("  ".join(column.ljust(widths[column]) for column in columns).rstrip() + "\n")
+                for row in rows:
+                    fp.write("  ".join(str(row.get(column, 0)).ljust(widths[column]) for column in columns).rstrip() + "\n")
+        finally:
+            if output:
+                fp.close()
+        if output:
+            print(f"Wrote {output}")
+        return rows
+
+    def print_rollup_status(self):
+        """Print the state of the rollups."""
+        for key, value in self.rollup_store.status().items():
+            print(f"{key}: {value}")
+        return True
+
+    def get_indicator_type_report(self, sip_query_filter='status=Analyzed', print_report=True, write_report=True, processes=None, shard_results=None,
+                                  from_rollups=False):
+        """Report how the indicators matching sip_query_filter have alerted in ACE, by indicator type.
+
+        With more than one process, the indicators are split into that many shards,
+        each reported on by a worker process, and the shard reports are added up.
+        shard_results from shard runs on other hosts are added up the same way.
+
+        from_rollups builds the report of the Analyzed indicators from the rollups
+        instead, refreshing them first.
+        """
+        if shard_results is None and processes and processes > 1 and not from_rollups:
+            shard_results = self.run_local_shards(REPORT, processes, sip_query_filter=sip_query_filter)
+
+        if from_rollups:
+            if sip_query_filter != f"status={ANALYZED}":
+                self.logger.error(f"The rollups only count Analyzed indicators, not: {sip_query_filter}")
+                return None
+            self.refresh_rollups()
+            report = self.rollup_store.type_report()
+        elif shard_results is not None:
+            try:
+                report = merge_reports(shard_results)
+            except ValueError as e:
+                self.logger.error(f"Unable to merge indicator type report shard results: {e}")
+                return None
+        else:
+            report = self.build_indicator_type_report(sip_query_filter)
 
-        self.logger.info(f"This report scanned {len(self.indicators)} indicators that matched: {sip_query_filter}")
-       
         # write the report
         if write_report:
             report_name = f"indicator_report_{time.time()}.json"
@@ -335,6 +1193,61 @@ class IndicatorManager:
         if print_report:
             self.print_indicator_report_summary(report)
 
+        return report
+
+    def build_indicator_type_report(self, sip_query_filter='status=Analyzed', shard: Shard=None):
+        """Build the indicator type report, of only the indicators in shard if one is given.
+
+        The report is built in a single pass over the indicators. Manual indicators
+        come from one tag filtered SIP query and ACE dispositions are queried in chunks.
+        """
+        from tqdm import tqdm
+
+        # Use self.indicators if they were already loaded, otherwise stream them from SIP.
+        if self.indicators:
+            indicators = self.indicators
+            total_indicators = len(self.indicators)
+        else:
+            indicators = self.iter_indicators(f"/api/indicators?&{sip_query_filter}")
+            total_indicators = self.sip.get(f"/api/indicators?&{sip_query_filter}&count")
+        if shard is not None:
+            indicators = shard.filter(indicators)
+            total_indicators = None
+
+        # The indicators tagged as manual, from one query instead of fetching every indicator.
+        manual_indicator_ids = {indicator['id'] for indicator in self.iter_indicators(f"/api/indicators?&{sip_query_filter}&tags=manual_indicator")}
+
+        # The report results.
+        # report = {'indicator_type': {'count': 53, 'dispo1': 17, 'dispo2': 484}}
+        report = {'sip_query_filter': sip_query_filter,
+                  'results': {}}
+
+        # Count the indicators by their type and how they have alerted.
+        chunk_size = self.config['ace_db'].getint('chunk_size', DEFAULT_CHUNK_SIZE)
+        desc = "Correlating SIP and ACE data"
+        scanned = 0
+        for indicator, disposition_counts in tqdm(iter_disposition_counts(self.alert_source, indicators, chunk_size=chunk_size), desc=desc, total=total_indicators):
+            scanned += 1
+            if indicator['type'] not in report['results']:
+                report['results'][indicator['type']] = {'count': 0, 'total_alerts': 0, 'no_alerts': 0, 'manual_indicators': 0}
+            results = report['results'][indicator['type']]
+
+            results['count'] += 1
+            if indicator['id'] in manual_indicator_ids:
+                results['manual_indicators'] += 1
+
+            # If we have alerted on this indicator, count the alerts that have a disposition.
+            if disposition_counts:
+                for disposition, alerts in disposition_counts.items():
+                    if disposition:
+                        results[disposition] = results.get(disposition, 0) + alerts
+                        results['total_alerts'] += alerts
+            else:
+                results['no_alerts'] += 1
+
+        self.logger.info(f"This report scanned {scanned} indicators that matched: {sip_query_filter}")
+        return report
+
     def print_indicator_report_summary(self, report):
         # Print the report. Start by getting a sorted list of the
         # different indicator types.
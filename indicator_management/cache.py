@@ -0,0 +1,241 @@
+"""Local SQLite cache of the ACE alerts SIP indicators were observed in.
+
+The cache maps SIP indicator IDs (the 'sip:<id>' indicator observables in ACE)
+to the insert_date, disposition and FA Queue flag of each of their non-faqueue
+alerts. It is synced incrementally from ACE:
+
+  - new alerts and their indicator observables are read past a high-water mark
+    on the alert id. Alerts inserted within the last resync_window_hours are
+    read again to pick up observables added while the alert was analyzed.
+  - disposition changes are read from a high-water mark on disposition_time,
+    ACE's latest disposition_time when the previous sync started.
+
+The cache is an alert source, so it can be used anywhere the ACE database is.
+"""
+
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+
+from indicator_management.correlation import (DEFAULT_FETCH_SIZE, FA_QUEUE_ALERT, FA_QUEUE_PATTERN, chunks, count_dispositions, iter_rows,
+                                              summarize_alerts)
+
+LOGGER = logging.getLogger("indicator_management.cache")
+
+# Defaults for the [ace_cache] config section.
+DEFAULT_CACHE_PATH = os.path.join("var", "ace_cache.sqlite")
+DEFAULT_MAX_AGE_MINUTES = 60
+DEFAULT_RESYNC_WINDOW_HOURS = 24
+DEFAULT_SYNC_BATCH_SIZE = 10000
+
+# SQLite limits the number of parameters in a statement.
+MAX_SQLITE_PARAMETERS = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS alerts (
+    id INTEGER PRIMARY KEY,
+    insert_date TEXT NOT NULL,
+    disposition TEXT,
+    disposition_time TEXT,
+    fa_queue INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS alerts_insert_date ON alerts (insert_date);
+CREATE TABLE IF NOT EXISTS indicator_alerts (
+    indicator_id INTEGER NOT NULL,
+    alert_id INTEGER NOT NULL,
+    PRIMARY KEY (indicator_id, alert_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sync_state (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+NEW_ALERTS_QUERY = f"""SELECT a.id AS id,
+                          a.insert_date AS insert_date,
+                          a.disposition AS disposition,
+                          a.disposition_time AS disposition_time,
+                          CASE WHEN {FA_QUEUE_ALERT} THEN 1 ELSE 0 END AS fa_queue
+                      FROM alerts a
+                      WHERE a.id > %s AND a.alert_type != 'faqueue'
+                      ORDER BY a.id
+                      LIMIT %s"""
+
+NEW_INDICATOR_MAPPINGS_QUERY = """SELECT o.value AS indicator,
+                                      om.alert_id AS alert_id
+                                  FROM observables o JOIN observable_mapping om ON o.id = om.observable_id
+                                  WHERE o.type = 'indicator' AND om.alert_id >= %s AND om.alert_id <= %s"""
+
+MAX_DISPOSITION_TIME_QUERY = "SELECT MAX(disposition_time) FROM alerts"
+
+DISPOSITION_CHANGES_QUERY = """SELECT a.id AS id,
+                                   a.disposition AS disposition,
+                                   a.disposition_time AS disposition_time
+                               FROM alerts a
+                               WHERE a.disposition_time >= %s AND a.id <= %s AND a.alert_type != 'faqueue'"""
+
+
+def to_text(value):
+    """Store datetimes as ISO formatted text."""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    return value
+
+
+def indicator_id_from_observable_value(value):
+    """Return the SIP indicator ID of a 'sip:<id>' observable value, or None if it isn't one."""
+    if not value or not value.startswith('sip:'):
+        return None
+    try:
+        return int(value[4:])
+    except ValueError:
+        return None
+
+
+class AlertCache:
+    """SQLite cache of SIP indicator ACE alerts."""
+
+    def __init__(self, path, resync_window_hours=DEFAULT_RESYNC_WINDOW_HOURS, sync_batch_size=DEFAULT_SYNC_BATCH_SIZE):
+        self.path = path
+        self.resync_window = datetime.timedelta(hours=resync_window_hours)
+        self.sync_batch_size = sync_batch_size
+        self.lock = threading.RLock()
+
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    @classmethod
+    def from_config(cls, config, home_path):
+        """Create the cache described by the [ace_cache] config section. Relative paths are relative to home_path."""
+        path = config.get('ace_cache', 'path', fallback=DEFAULT_CACHE_PATH)
+        return cls(os.path.join(home_path, path),
+                   resync_window_hours=config.getfloat('ace_cache', 'resync_window_hours', fallback=DEFAULT_RESYNC_WINDOW_HOURS),
+                   sync_batch_size=config.getint('ace_cache', 'sync_batch_size', fallback=DEFAULT_SYNC_BATCH_SIZE))
+
+    def close(self):
+        self.db.close()
+
+    def get_state(self, name, default=None):
+        row = self.db.execute("SELECT value FROM sync_state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row and row[0] is not None else default
+
+    def set_state(self, name, value):
+        self.db.execute("INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)", (name, to_text(value)))
+
+    @property
+    def last_sync(self):
+        last_sync = self.get_state('last_sync')
+        return datetime.datetime.fromisoformat(last_sync) if last_sync else None
+
+    def is_stale(self, max_age_minutes=DEFAULT_MAX_AGE_MINUTES):
+        """Return True if the cache has never been synced or was last synced more than max_age_minutes ago."""
+        last_sync = self.last_sync
+        if last_sync is None:
+            return True
+        return datetime.datetime.now() - last_sync > datetime.timedelta(minutes=max_age_minutes)
+
+    def status(self):
+        """Return a dict describing the cache."""
+        with self.lock:
+            return {'path': self.path,
+                    'last_sync': self.get_state('last_sync'),
+                    'max_alert_id': int(self.get_state('max_alert_id', 0)),
+                    'max_disposition_time': self.get_state('max_disposition_time'),
+                    'alerts': self.db.execute("SELECT COUNT(*) FROM alerts").fetchone()[0],
+                    'indicators': self.db.execute("SELECT COUNT(DISTINCT indicator_id) FROM indicator_alerts").fetchone()[0]}
+
+    def sync(self, ace_cursor, fetch_size=DEFAULT_FETCH_SIZE):
+        """Incrementally sync the cache from ACE. Returns a dict of what changed."""
+        with self.lock:
+            started = datetime.datetime.now()
+            max_alert_id = int(self.get_state('max_alert_id', 0))
+            max_disposition_time = self.get_state('max_disposition_time')
+            changes = {'alerts': 0, 'indicator_alerts': 0, 'dispositions': 0}
+
+            # Take the new disposition watermark before anything is read, so alerts
+            # dispositioned during the sync are picked up by the next one.
+            ace_cursor.execute(MAX_DISPOSITION_TIME_QUERY)
+            rows = ace_cursor.fetchall()
+            ace_disposition_time = to_text(rows[0][0]) if rows else None
+
+            # Start from the first cached alert inserted within the resync window, so
+            # observables added while those alerts were being analyzed get picked up.
+            window_start = to_text(started - self.resync_window)
+            row = self.db.execute("SELECT MIN(id) FROM alerts WHERE insert_date >= ?", (window_start,)).fetchone()
+            after_alert_id = min(max_alert_id, row[0] - 1) if row[0] else max_alert_id
+
+            # New alerts and their indicators, a batch of alerts at a time.
+            while True:
+                ace_cursor.execute(NEW_ALERTS_QUERY, (FA_QUEUE_PATTERN, after_alert_id, self.sync_batch_size))
+                alerts = [(alert_id, to_text(insert_date), disposition, to_text(disposition_time), int(fa_queue))
+                          for alert_id, insert_date, disposition, disposition_time, fa_queue in iter_rows(ace_cursor, fetch_size)]
+                if not alerts:
+                    break
+
+                self.db.executemany("INSERT OR REPLACE INTO alerts (id, insert_date, disposition, disposition_time, fa_queue) VALUES (?, ?, ?, ?, ?)", alerts)
+                changes['alerts'] += len(alerts)
+
+                alert_ids = {alert[0] for alert in alerts}
+                ace_cursor.execute(NEW_INDICATOR_MAPPINGS_QUERY, (alerts[0][0], alerts[-1][0]))
+                mappings = []
+                for indicator, alert_id in iter_rows(ace_cursor, fetch_size):
+                    indicator_id = indicator_id_from_observable_value(indicator)
+                    if indicator_id is not None and alert_id in alert_ids:
+                        mappings.append((indicator_id, alert_id))
+                self.db.executemany("INSERT OR IGNORE INTO indicator_alerts (indicator_id, alert_id) VALUES (?, ?)", mappings)
+                changes['indicator_alerts'] += len(mappings)
+
+                after_alert_id = alerts[-1][0]
+                max_alert_id = max(max_alert_id, after_alert_id)
+                self.set_state('max_alert_id', max_alert_id)
+                self.db.commit()
+                LOGGER.debug(f"synced ACE alerts up to {after_alert_id}")
+
+            # Disposition changes to alerts already in the cache, since the watermark of the last sync.
+            if max_disposition_time:
+                ace_cursor.execute(DISPOSITION_CHANGES_QUERY, (max_disposition_time, max_alert_id))
+                for alert_id, disposition, disposition_time in iter_rows(ace_cursor, fetch_size):
+                    cursor = self.db.execute("UPDATE alerts SET disposition = ?, disposition_time = ? "
+                                             "WHERE id = ? AND (disposition IS NOT ? OR disposition_time IS NOT ?)",
+                                             (disposition, to_text(disposition_time), alert_id, disposition, to_text(disposition_time)))
+                    changes['dispositions'] += cursor.rowcount
+
+            self.set_state('max_disposition_time', ace_disposition_time or max_disposition_time)
+            self.set_state('last_sync', started)
+            self.db.commit()
+
+        LOGGER.info(f"synced ACE cache {self.path}: {changes['alerts']} alerts, {changes['indicator_alerts']} indicator observables, "
+                    f"{changes['dispositions']} disposition changes")
+        return changes
+
+    def rebuild(self, ace_cursor, fetch_size=DEFAULT_FETCH_SIZE):
+        """Throw away everything in the cache and sync it from ACE from scratch."""
+        with self.lock:
+            self.db.executescript("DELETE FROM indicator_alerts; DELETE FROM alerts; DELETE FROM sync_state;")
+            self.db.commit()
+        return self.sync(ace_cursor, fetch_size=fetch_size)
+
+    # The alert source interface.
+
+    def alerts(self, indicator_ids):
+        """Return a dict of indicator ID to a list of its (insert_date, disposition, fa_queue) alerts."""
+        alerts = {indicator_id: [] for indicator_id in indicator_ids}
+        with self.lock:
+            for chunk in chunks(alerts.keys(), MAX_SQLITE_PARAMETERS):
+                query = f"""SELECT ia.indicator_id, a.insert_date, a.disposition, a.fa_queue
+                            FROM indicator_alerts ia JOIN alerts a ON a.id = ia.alert_id
+                            WHERE ia.indicator_id IN ({', '.join(['?'] * len(chunk))})"""
+                for indicator_id, insert_date, disposition, fa_queue in self.db.execute(query, chunk):
+                    alerts[indicator_id].append((datetime.datetime.fromisoformat(insert_date), disposition, bool(fa_queue)))
+        return alerts
+
+    def summaries(self, indicator_ids, cutoffs):
+        """Return a dict of indicator ID to its AlertSummary for the cutoffs."""
+        return {indicator_id: summarize_alerts(indicator_id, alerts, cutoffs) for indicator_id, alerts in self.alerts(indicator_ids).items()}
+
+    def disposition_counts(self, indicator_ids):
+        return {indicator_id: count_dispositions(alerts) for indicator_id, alerts in self.alerts(indicator_ids).items()}
@@ -1,14 +1,16 @@
 """Configuration related items.
+
+Importing this module doesn't touch the file system. load_config() creates the
+required directories and the config file, and reads the config, the first time
+it's called.
 """
 
 import os
 import sys
-import stat
+import shutil
 import logging
-import tzlocal
-
+import threading
 
-from datetime import datetime
 from configparser import ConfigParser
 
 LOGGER = logging.getLogger("indicator_management.config")
@@ -21,21 +23,10 @@ HOME_PATH = os.path.dirname(PROJECT_PATH)
 
 # Required directories
 REQUIRED_DIRS = ["logs", "var", "etc"]
-for path in [os.path.join(HOME_PATH, x) for x in REQUIRED_DIRS]:
-    if not os.path.isdir(path):
-        try:
-            os.mkdir(path)
-        except Exception as e:
-            sys.stderr.write("ERROR: cannot create directory {0}: {1}\n".format(path, str(e)))
-            sys.exit(1)
-
 
-# Create the config file from template if it does not already exist
+# The config file is created from the template if it does not already exist
 default_config_path = os.path.join(HOME_PATH, "etc", "config.ini")
 template_config_path = os.path.join(PROJECT_PATH, "etc", "template.config.ini")
-if not os.path.exists(default_config_path):
-    import shutil
-    shutil.copyfile(template_config_path, default_config_path)
 
 # Allow for additional config flexibility
 user_config_path = os.path.join(os.path.expanduser("~"), ".config", "sip", "indicator_management.ini")
@@ -45,6 +36,34 @@ CONFIG_SEARCH_PATHS = [
     user_config_path,
 ]
 
+# Empty until load_config() reads it.
 CONFIG = ConfigParser()
 CONFIG.optionxform = str  # preserve case
-CONFIG.read(CONFIG_SEARCH_PATHS)
+
+_config_loaded = False
+_config_lock = threading.Lock()
+
+
+def setup_home():
+    """Create the required directories, and the config file from the template, if they do not exist."""
+    for path in [os.path.join(HOME_PATH, x) for x in REQUIRED_DIRS]:
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path, exist_ok=True)
+            except Exception as e:
+                sys.stderr.write("ERROR: cannot create directory {0}: {1}\n".format(path, str(e)))
+                sys.exit(1)
+
+    if not os.path.exists(default_config_path):
+        shutil.copyfile(template_config_path, default_config_path)
+
+
+def load_config():
+    """Set up the home directory and read the config files into CONFIG, the first time it's called. Returns CONFIG."""
+    global _config_loaded
+    with _config_lock:
+        if not _config_loaded:
+            setup_home()
+            CONFIG.read(CONFIG_SEARCH_PATHS)
+            _config_loaded = True
+    return CONFIG
@@ -0,0 +1,271 @@
+"""Correlate SIP indicators with ACE alert dispositions.
+
+ACE stores SIP indicators as observables of type 'indicator' with a value of
+'sip:<indicator id>'. Rather than pulling every alert row back for every
+indicator, indicators are sent to ACE in chunks and MySQL returns one summary
+row per indicator. The row has a set of conditional aggregates for each
+distinct cutoff of the tune sections, so every section an indicator is routed
+to classifies it from the same row. The indicator type report only needs one
+row per indicator and disposition.
+"""
+
+import functools
+import logging
+
+from collections import Counter, namedtuple
+
+LOGGER = logging.getLogger("indicator_management.correlation")
+
+# Default number of indicator IDs sent to ACE per query.
+DEFAULT_CHUNK_SIZE = 1000
+
+# Default number of rows read from ACE at a time. ACE queries are read with an
+# unbuffered cursor, so this bounds how many rows are held in memory.
+DEFAULT_FETCH_SIZE = 1000
+
+# Alerts with this in their description came from the FA Queue and are ignored.
+FA_QUEUE_PATTERN = '%FA Queue%'
+
+# Whether an alert came from the FA Queue, case sensitively: LIKE ignores case
+# under MySQL's default collation, LIKE BINARY doesn't.
+FA_QUEUE_ALERT = "COALESCE(a.description, '') LIKE BINARY %s"
+
+# Indicator classifications.
+FP_RECON = 'FP/RECON'
+NO_MATCHING_ALERTS = 'NO MATCHING ALERTS'
+NO_ALERTS = 'NO ALERTS'
+GOOD = 'GOOD'
+
+# What ACE knows about a single indicator.
+#   total_alerts: every non-faqueue alert the indicator was observed in.
+#   alerts_after_cutoff: the alerts that are not from the FA Queue and were inserted on or after the cutoff.
+#   dispositions: the distinct dispositions of those alerts. None is included for alerts without a disposition.
+DispositionSummary = namedtuple('DispositionSummary', ['indicator_id', 'total_alerts', 'alerts_after_cutoff', 'dispositions'])
+
+# What ACE knows about a single indicator for every cutoff of the tune sections.
+#   total_alerts: every non-faqueue alert the indicator was observed in.
+#   last_alert_time: the insert date of the newest of those alerts, or None.
+#   cutoffs: a dict of cutoff to the CutoffAlerts counted toward it.
+AlertSummary = namedtuple('AlertSummary', ['indicator_id', 'total_alerts', 'last_alert_time', 'cutoffs'])
+
+# The alerts of an indicator counted toward a cutoff: how many there are, the
+# insert date of the oldest, or None, and their distinct dispositions.
+CutoffAlerts = namedtuple('CutoffAlerts', ['alerts', 'first_alert_time', 'dispositions'])
+
+ALERT_SUMMARY_QUERY = """SELECT o.value AS indicator,
+                            COUNT(*) AS total_alerts,
+                            MAX(a.insert_date) AS last_alert_time{cutoff_columns}
+                        FROM
+                            observables o JOIN observable_mapping om ON o.id = om.observable_id
+                            JOIN alerts a ON a.id = om.alert_id
+                        WHERE
+                            o.type = 'indicator' AND o.value IN ({values}) AND a.alert_type != 'faqueue'
+                        GROUP BY o.value"""
+
+# The aggregates of the alerts counted toward one cutoff. The summary query has
+# them once for every distinct cutoff.
+CUTOFF_COLUMNS = """,
+                            SUM(CASE WHEN {counted} THEN 1 ELSE 0 END) AS alerts_after_cutoff_{index},
+                            MIN(CASE WHEN {counted} THEN a.insert_date END) AS first_alert_time_{index},
+                            SUM(CASE WHEN {counted} AND a.disposition IS NULL THEN 1 ELSE 0 END) AS undispositioned_{index},
+                            GROUP_CONCAT(DISTINCT CASE WHEN {counted} THEN a.disposition END) AS dispositions_{index}"""
+
+# An alert counts toward a cutoff if it was inserted on or after it and didn't come from the FA Queue.
+COUNTED_ALERT = f"a.insert_date >= %s AND NOT ({FA_QUEUE_ALERT})"
+
+ALERTS_QUERY = """SELECT o.value AS indicator,
+                     a.insert_date AS insert_date,
+                     a.disposition AS disposition,
+                     CASE WHEN {fa_queue} THEN 1 ELSE 0 END AS fa_queue
+                 FROM
+                     observables o JOIN observable_mapping om ON o.id = om.observable_id
+                     JOIN alerts a ON a.id = om.alert_id
+                 WHERE
+                     o.type = 'indicator' AND o.value IN ({values}) AND a.alert_type != 'faqueue'"""
+
+DISPOSITION_COUNT_QUERY = """SELECT o.value AS indicator,
+                                a.disposition AS disposition,
+                                COUNT(*) AS alerts
+                            FROM
+                                observables o JOIN observable_mapping om ON o.id = om.observable_id
+                                JOIN alerts a ON a.id = om.alert_id
+                            WHERE
+                                o.type = 'indicator' AND o.value IN ({values}) AND a.alert_type != 'faqueue'
+                            GROUP BY o.value, a.disposition"""
+
+
+def indicator_observable_value(indicator_id):
+    """Return the ACE observable value for a SIP indicator ID."""
+    return f"sip:{indicator_id}"
+
+
+@functools.lru_cache(maxsize=64)
+def build_query(template, values):
+    """Build the query text of a template for a number of observable values.
+
+    Queries are parameterised, so every chunk of the same size reuses the same
+    statement text.
+    """
+    return template.format(fa_queue=FA_QUEUE_ALERT, values=', '.join(['%s'] * values))
+
+
+@functools.lru_cache(maxsize=64)
+def build_summary_query(cutoffs, values):
+    """Build the text of the summary query for a number of distinct cutoffs and observable values."""
+    cutoff_columns = ''.join(CUTOFF_COLUMNS.format(counted=COUNTED_ALERT, index=index) for index in range(cutoffs))
+    return ALERT_SUMMARY_QUERY.format(cutoff_columns=cutoff_columns, values=', '.join(['%s'] * values))
+
+
+def iter_rows(cursor, fetch_size=DEFAULT_FETCH_SIZE):
+    """Yield the result rows of the last query executed by cursor, fetch_size rows at a time."""
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def chunks(items, chunk_size):
+    """Yield lists of at most chunk_size items."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def query_disposition_counts(ace_cursor, indicator_ids, fetch_size=DEFAULT_FETCH_SIZE):
+    """Query ACE for how many non-faqueue alerts of each disposition every indicator ID has.
+
+    Returns a dict of indicator ID to a Counter of disposition to alert count.
+    Alerts without a disposition are counted under None. Indicators that ACE
+    has never alerted on get an empty Counter.
+    """
+    observable_values = {indicator_observable_value(indicator_id): indicator_id for indicator_id in indicator_ids}
+    counts = {indicator_id: Counter() for indicator_id in indicator_ids}
+    if not observable_values:
+        return counts
+
+    ace_cursor.execute(build_query(DISPOSITION_COUNT_QUERY, len(observable_values)), list(observable_values.keys()))
+    for indicator, disposition, alerts in iter_rows(ace_cursor, fetch_size):
+        counts[observable_values[indicator]][disposition] += int(alerts)
+
+    return counts
+
+
+def iter_disposition_counts(alert_source, indicators, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield (indicator, Counter of disposition to alert count) for SIP indicators, querying the alert source one chunk at a time."""
+    for chunk in chunks(indicators, chunk_size):
+        counts = alert_source.disposition_counts([indicator['id'] for indicator in chunk])
+        for indicator in chunk:
+            yield indicator, counts[indicator['id']]
+
+
+def query_alerts(ace_cursor, indicator_ids, fetch_size=DEFAULT_FETCH_SIZE):
+    """Query ACE for the (insert_date, disposition, fa_queue) of every non-faqueue alert of each indicator ID.
+
+    Returns a dict of indicator ID to a list of alerts.
+    """
+    observable_values = {indicator_observable_value(indicator_id): indicator_id for indicator_id in indicator_ids}
+    alerts = {indicator_id: [] for indicator_id in indicator_ids}
+    if not observable_values:
+        return alerts
+
+    ace_cursor.execute(build_query(ALERTS_QUERY, len(observable_values)), [FA_QUEUE_PATTERN] + list(observable_values.keys()))
+    for indicator, insert_date, disposition, fa_queue in iter_rows(ace_cursor, fetch_size):
+        alerts[observable_values[indicator]].append((insert_date, disposition, bool(fa_queue)))
+
+    return alerts
+
+
+def query_alert_summaries(ace_cursor, indicator_ids, cutoffs, fetch_size=DEFAULT_FETCH_SIZE):
+    """Query ACE for an AlertSummary of each indicator ID for the cutoffs, one row per indicator.
+
+    Returns a dict of indicator ID to AlertSummary. Indicators that ACE has
+    never alerted on get a summary with zero alerts.
+    """
+    cutoffs = sorted(set(cutoffs))
+    observable_values = {indicator_observable_value(indicator_id): indicator_id for indicator_id in indicator_ids}
+    summaries = {indicator_id: summarize_alerts(indicator_id, [], cutoffs) for indicator_id in indicator_ids}
+    if not observable_values:
+        return summaries
+
+    # Every cutoff's four aggregates each take the cutoff and the FA Queue pattern.
+    params = [param for cutoff in cutoffs for param in [cutoff, FA_QUEUE_PATTERN] * 4] + list(observable_values.keys())
+    ace_cursor.execute(build_summary_query(len(cutoffs), len(observable_values)), params)
+    for row in iter_rows(ace_cursor, fetch_size):
+        indicator, total_alerts, last_alert_time = row[:3]
+        counted = {}
+        for index, cutoff in enumerate(cutoffs):
+            alerts_after_cutoff, first_alert_time, undispositioned, disposition_list = row[3 + 4 * index:7 + 4 * index]
+            dispositions = set(disposition_list.split(',')) if disposition_list else set()
+            if undispositioned:
+                dispositions.add(None)
+            counted[cutoff] = CutoffAlerts(int(alerts_after_cutoff or 0), first_alert_time, frozenset(dispositions))
+        indicator_id = observable_values[indicator]
+        summaries[indicator_id] = AlertSummary(indicator_id, int(total_alerts), last_alert_time, counted)
+
+    return summaries
+
+
+def summarize_alerts(indicator_id, alerts, cutoffs):
+    """Return the AlertSummary of an indicator for the cutoffs from its list of (insert_date, disposition, fa_queue) alerts."""
+    counted = {}
+    for cutoff in cutoffs:
+        cutoff_alerts = [(insert_date, disposition) for insert_date, disposition, fa_queue in alerts if not fa_queue and insert_date >= cutoff]
+        counted[cutoff] = CutoffAlerts(len(cutoff_alerts),
+                                       min(insert_date for insert_date, disposition in cutoff_alerts) if cutoff_alerts else None,
+                                       frozenset(disposition for insert_date, disposition in cutoff_alerts))
+    return AlertSummary(indicator_id, len(alerts), max(insert_date for insert_date, disposition, fa_queue in alerts) if alerts else None, counted)
+
+
+def disposition_summary(summary: AlertSummary, cutoff):
+    """Return the DispositionSummary of an indicator for one of the cutoffs of its AlertSummary."""
+    counted = summary.cutoffs[cutoff]
+    return DispositionSummary(summary.indicator_id, summary.total_alerts, counted.alerts, counted.dispositions)
+
+
+def count_dispositions(alerts):
+    """Return a Counter of disposition to alert count from a list of (insert_date, disposition, fa_queue) alerts."""
+    return Counter(disposition for insert_date, disposition, fa_queue in alerts)
+
+
+class AceAlertSource:
+    """Alert source that queries the ACE database directly.
+
+    An alert source answers three questions about a list of indicator IDs:
+    their AlertSummary for the tune cutoffs, their disposition counts and
+    their individual alerts. The local AlertCache is the other alert source.
+    """
+
+    def __init__(self, ace_cursor, fetch_size=DEFAULT_FETCH_SIZE):
+        self.ace_cursor = ace_cursor
+        self.fetch_size = fetch_size
+
+    def summaries(self, indicator_ids, cutoffs):
+        return query_alert_summaries(self.ace_cursor, indicator_ids, cutoffs, fetch_size=self.fetch_size)
+
+    def disposition_counts(self, indicator_ids):
+        return query_disposition_counts(self.ace_cursor, indicator_ids, fetch_size=self.fetch_size)
+
+    def alerts(self, indicator_ids):
+        return query_alerts(self.ace_cursor, indicator_ids, fetch_size=self.fetch_size)
+
+
+def classify(summary: DispositionSummary, bad_dispositions):
+    """Classify an indicator from its DispositionSummary.
+
+    An indicator is bad (FP/RECON, NO MATCHING ALERTS or NO ALERTS) if it
+    never alerted, if none of its alerts count toward the cutoff, or if every
+    counted alert has a bad disposition. Otherwise it's GOOD.
+    """
+    if not summary.total_alerts:
+        return NO_ALERTS
+    if not summary.alerts_after_cutoff:
+        return NO_MATCHING_ALERTS
+    if all(dispo in bad_dispositions for dispo in summary.dispositions):
+        return FP_RECON
+    return GOOD
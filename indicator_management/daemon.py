@@ -0,0 +1,322 @@
+"""The serve daemon: a long running indicator manager with a scheduler and a local API.
+
+Instead of cron starting the tool cold for every run, the daemon keeps one
+IndicatorManager, and with it the SIP session, the ACE connections and the ACE
+cache, warm between runs. Each tune section runs on its own interval, and a
+Unix socket takes requests for scope counts, dry runs and indicator type
+reports, one JSON object per line, answered with one JSON object per line:
+
+    {"command": "scope", "sections": ["tune_osint"]}
+    {"ok": true, "result": {...}}
+
+Runs never overlap. A request that comes in during a scheduled tune waits for it.
+"""
+
+import datetime
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+
+from indicator_management.cache import DEFAULT_MAX_AGE_MINUTES
+from indicator_management.metrics import ALL_SECTIONS
+
+LOGGER = logging.getLogger("indicator_management.daemon")
+
+# Defaults for the [serve] config section.
+DEFAULT_SOCKET_PATH = os.path.join("var", "indicator_management.sock")
+DEFAULT_STATE_PATH = os.path.join("var", "serve_state.json")
+DEFAULT_INTERVAL_MINUTES = 1440
+DEFAULT_CLEANUP_INTERVAL_MINUTES = 1440
+
+# Jobs that aren't tune sections.
+CLEANUP_RECORDS = 'cleanup_records'
+ACE_CACHE = 'ace_cache'
+INCREMENTAL = 'incremental'
+ROLLUPS = 'rollups'
+
+COMMANDS = ['status', 'scope', 'dry_run', 'report', 'run']
+
+
+class Job:
+    """Something the scheduler runs every interval seconds.
+
+    A job that has run before is next run an interval after its last run, one
+    that never has is run right away.
+    """
+
+    def __init__(self, name, interval, func, last_run=None):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.last_run = last_run
+        self.last_seconds = None
+        self.last_error = None
+        self.running = False
+        self.next_run = last_run + datetime.timedelta(seconds=interval) if last_run else datetime.datetime.now()
+
+    def as_dict(self):
+        return {'name': self.name,
+                'interval_minutes': self.interval / 60,
+                'last_run': self.last_run.isoformat(' ') if self.last_run else None,
+                'last_seconds': self.last_seconds,
+                'last_error': self.last_error,
+                'next_run': self.next_run.isoformat(' '),
+                'running': self.running}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Answer each JSON request line on a connection."""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = {'ok': True, 'result': self.server.daemon.handle(json.loads(line))}
+            except Exception as e:
+                LOGGER.warning(f"request failed: {e}")
+                response = {'ok': False, 'error': str(e)}
+            self.wfile.write((json.dumps(response, default=str) + "\n").encode())
+            self.wfile.flush()
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon:
+    """Run the tune sections on their intervals and answer API requests with one warm IndicatorManager."""
+
+    def __init__(self, manager, socket_path=DEFAULT_SOCKET_PATH, state_path=DEFAULT_STATE_PATH, dry_run=False):
+        self.manager = manager
+        self.socket_path = socket_path
+        self.state_path = state_path
+        self.dry_run = dry_run
+        self.started = datetime.datetime.now()
+        # Only one run at a time, scheduled or requested.
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.jobs = self.build_jobs()
+
+    @classmethod
+    def from_config(cls, manager, home_path, dry_run=False):
+        """Create a daemon from the [serve] config section. Relative paths are relative to home_path."""
+        config = manager.config
+        return cls(manager,
+                   socket_path=os.path.join(home_path, config.get('serve', 'socket', fallback=DEFAULT_SOCKET_PATH)),
+                   state_path=os.path.join(home_path, config.get('serve', 'state', fallback=DEFAULT_STATE_PATH)),
+                   dry_run=dry_run)
+
+    def load_state(self):
+        """Return when each job last ran."""
+        if not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path) as fp:
+                return {name: datetime.datetime.fromisoformat(value) for name, value in json.load(fp).items()}
+        except Exception as e:
+            LOGGER.warning(f"unable to read the serve state in {self.state_path}: {e}")
+            return {}
+
+    def save_state(self):
+        state = {job.name: job.last_run.isoformat(' ') for job in self.jobs.values() if job.last_run}
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w') as fp:
+            json.dump(state, fp, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def build_jobs(self):
+        """Schedule every enabled tune section, record cleanup and, if they're enabled, incremental tunes, rollup refreshes and the ACE cache sync."""
+        config = self.manager.config
+        last_runs = self.load_state()
+        default_interval = config.getfloat('serve', 'interval_minutes', fallback=DEFAULT_INTERVAL_MINUTES)
+
+        jobs = {}
+        for section in self.manager.get_tune_sections():
+            interval = config[section].getfloat('interval_minutes', default_interval)
+            jobs[section] = Job(section, interval * 60, self.tune_job(section), last_runs.get(section))
+
+        # Incremental tunes between the full ones.
+        incremental_interval = config.getfloat('incremental', 'interval_minutes', fallback=0)
+        if incremental_interval > 0:
+            jobs[INCREMENTAL] = Job(INCREMENTAL, incremental_interval * 60, self.incremental_job, last_runs.get(INCREMENTAL))
+
+        rollups_interval = config.getfloat('rollups', 'interval_minutes', fallback=0)
+        if rollups_interval > 0:
+            jobs[ROLLUPS] = Job(ROLLUPS, rollups_interval * 60, lambda: dict(self.manager.refresh_rollups()), last_runs.get(ROLLUPS))
+
+        cleanup_interval = config.getfloat('serve', 'cleanup_interval_minutes', fallback=DEFAULT_CLEANUP_INTERVAL_MINUTES)
+        if cleanup_interval > 0:
+            jobs[CLEANUP_RECORDS] = Job(CLEANUP_RECORDS, cleanup_interval * 60, self.manager.cleanup_records, last_runs.get(CLEANUP_RECORDS))
+
+        # Keep the ACE cache synced so tunes and requests never wait on a stale one.
+        if config.getboolean('ace_cache', 'enabled', fallback=False):
+            interval = config.getfloat('ace_cache', 'max_age_minutes', fallback=DEFAULT_MAX_AGE_MINUTES)
+            jobs[ACE_CACHE] = Job(ACE_CACHE, interval * 60, lambda: self.manager.refresh_alert_source(force=True).status(), last_runs.get(ACE_CACHE))
+
+        for job in jobs.values():
+            LOGGER.info(f"scheduled {job.name} every {job.interval / 60:g} minutes, next at {job.next_run}")
+        return jobs
+
+    def tune_job(self, section):
+        def tune():
+            if not self.manager.turn_off_indicators_according_to_tune_instructions(dry_run=self.dry_run, sections=[section]):
+                raise RuntimeError(f"tune of {section} failed")
+            return self.section_counts()
+        return tune
+
+    def incremental_job(self):
+        if not self.manager.turn_off_indicators_incrementally(dry_run=self.dry_run):
+            raise RuntimeError("incremental tune failed")
+        return dict(self.section_counts(), changes=self.manager.metrics.info.get('changes', {}))
+
+    def call(self, func, *args, **kwargs):
+        """Run func with the IndicatorManager ready for a new run, after any other run is done."""
+        with self.lock:
+            self.manager.prepare_run()
+            return func(*args, **kwargs)
+
+    def run_job(self, job):
+        """Run a job now and schedule its next run."""
+        LOGGER.info(f"running {job.name}")
+        started = time.perf_counter()
+        job.running = True
+        try:
+            result = self.call(job.func)
+            job.last_error = None
+            return result
+        except Exception as e:
+            LOGGER.exception(f"{job.name} failed: {e}")
+            job.last_error = str(e)
+            raise
+        finally:
+            job.running = False
+            job.last_run = datetime.datetime.now()
+            job.last_seconds = round(time.perf_counter() - started, 3)
+            job.next_run = job.last_run + datetime.timedelta(seconds=job.interval)
+            LOGGER.info(f"{job.name} took {job.last_seconds} seconds, next at {job.next_run}")
+            try:
+                self.save_state()
+            except Exception as e:
+                LOGGER.error(f"unable to save the serve state to {self.state_path}: {e}")
+
+    def section_counts(self):
+        """Return the indicator counts of each tune section in the last run."""
+        summary = self.manager.metrics.summary()
+        return {'sections': {section: data['indicators'] for section, data in summary['sections'].items() if section != ALL_SECTIONS},
+                'overlaps': summary['info'].get('overlaps', {}),
+                'duration_seconds': summary['duration_seconds']}
+
+    def status(self):
+        return {'started': self.started.isoformat(' '),
+                'dry_run': self.dry_run,
+                'busy': self.lock.locked(),
+                'jobs': [job.as_dict() for job in sorted(self.jobs.values(), key=lambda job: job.next_run)]}
+
+    def scope(self, sections=None, by_type=False):
+        if not self.manager.turn_off_indicators_according_to_tune_instructions(print_scope_only=True, sections=sections, write_metrics=False,
+                                                                               scope_by_type=by_type):
+            raise ValueError("unable to count the tune scope, see the daemon's log")
+        counts = self.section_counts()
+        if by_type:
+            counts['types'] = self.manager.metrics.info.get('scope_by_type', {})
+        return counts
+
+    def tune_dry_run(self, sections=None):
+        if not self.manager.turn_off_indicators_according_to_tune_instructions(dry_run=True, sections=sections, write_metrics=False):
+            raise ValueError("unable to dry run the tune, see the daemon's log")
+        return self.section_counts()
+
+    def report(self, sip_query_filter='status=Analyzed'):
+        return self.manager.get_indicator_type_report(sip_query_filter, print_report=False, write_report=False)
+
+    def handle(self, request):
+        """Answer an API request. Raises a ValueError if it's not a valid request."""
+        if not isinstance(request, dict):
+            raise ValueError("requests must be JSON objects")
+        command = request.get('command')
+        if command == 'status':
+            return self.status()
+        if command == 'scope':
+            return self.call(self.scope, request.get('sections'), bool(request.get('by_type')))
+        if command == 'dry_run':
+            return self.call(self.tune_dry_run, request.get('sections'))
+        if command == 'report':
+            return self.call(self.report, request.get('filter') or 'status=Analyzed')
+        if command == 'run':
+            if request.get('job') not in self.jobs:
+                raise ValueError(f"unknown job {request.get('job')}, one of: {', '.join(self.jobs)}")
+            return self.run_job(self.jobs[request['job']])
+        raise ValueError(f"unknown command {command}, one of: {', '.join(COMMANDS)}")
+
+    def bind(self):
+        """Listen on the Unix socket. Only the user running the daemon can connect to it."""
+        if os.path.exists(self.socket_path):
+            # A socket file left behind by a daemon that died can be removed, a live one can't.
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(self.socket_path)
+                raise RuntimeError(f"another daemon is already listening on {self.socket_path}")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(self.socket_path)
+        if not os.path.isdir(os.path.dirname(self.socket_path)):
+            os.makedirs(os.path.dirname(self.socket_path))
+
+        server = UnixServer(self.socket_path, RequestHandler)
+        os.chmod(self.socket_path, 0o600)
+        server.daemon = self
+        return server
+
+    def stop(self, *args):
+        LOGGER.info("stopping after the current run")
+        self.stopped.set()
+
+    def serve_forever(self):
+        """Answer API requests in the background and run the scheduled jobs until stopped by SIGTERM or SIGINT."""
+        server = self.bind()
+        server_thread = threading.Thread(target=server.serve_forever, name='api', daemon=True)
+        server_thread.start()
+        LOGGER.info(f"listening on {self.socket_path}")
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        try:
+            while not self.stopped.is_set():
+                job = min(self.jobs.values(), key=lambda job: job.next_run, default=None)
+                wait_seconds = (job.next_run - datetime.datetime.now()).total_seconds() if job else 60
+                if wait_seconds > 0:
+                    # Wake up at least once a minute, in case a requested run rescheduled the job.
+                    self.stopped.wait(min(wait_seconds, 60))
+                    continue
+                try:
+                    self.run_job(job)
+                except Exception:
+                    pass
+        finally:
+            server.shutdown()
+            server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self.manager.close()
+            LOGGER.info("stopped")
+        return True
+
+
+def request(socket_path, command, **arguments):
+    """Send a request to a serve daemon and return its result. Raises a RuntimeError if the request failed."""
+    message = {'command': command}
+    message.update({key: value for key, value in arguments.items() if value is not None})
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile('rwb') as fp:
+            fp.write((json.dumps(message) + "\n").encode())
+            fp.flush()
+            response = json.loads(fp.readline())
+    if not response['ok']:
+        raise RuntimeError(response['error'])
+    return response['result']
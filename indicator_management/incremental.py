@@ -0,0 +1,232 @@
+"""Incremental tunes: only re-evaluate the indicators whose outcome can have changed.
+
+An indicator's outcome only changes when:
+
+  - it changes in SIP, like its status, sources or tags. These are found with a
+    SIP search for the indicators modified since the last incremental run.
+  - one of its ACE alerts is new or gets a new disposition. ACE is tailed past
+    the last alert id and disposition time seen, and the alerts' 'sip:<id>'
+    indicator observables are mapped back to indicator IDs.
+  - it ages into a tune section's scope, or one of the alerts its
+    classification counted ages out of the section's window. When the next of
+    these happens is worked out when the indicator is evaluated.
+
+The Analyzed indicators, their outcome and when they need to be evaluated again
+are kept in an SQLite database, var/incremental.sqlite, so indicators nothing
+happened to are never searched for or correlated again. The first incremental
+run evaluates every Analyzed indicator.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from indicator_management.cache import indicator_id_from_observable_value, to_text
+from indicator_management.correlation import DEFAULT_FETCH_SIZE, AlertSummary, chunks, iter_rows
+from indicator_management.indicators import Indicator
+from indicator_management.rules import parse_time
+
+LOGGER = logging.getLogger("indicator_management.incremental")
+
+# Defaults for the [incremental] config section.
+DEFAULT_STATE_PATH = os.path.join("var", "incremental.sqlite")
+DEFAULT_RESYNC_WINDOW_HOURS = 24
+
+# SQLite limits the number of parameters in a statement.
+MAX_SQLITE_PARAMETERS = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS indicators (
+    id INTEGER PRIMARY KEY,
+    indicator TEXT NOT NULL,
+    outcome TEXT,
+    evaluated_time TEXT NOT NULL,
+    recheck_time TEXT
+);
+CREATE INDEX IF NOT EXISTS indicators_recheck_time ON indicators (recheck_time);
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+ACE_WATERMARK_QUERY = "SELECT MAX(id), MAX(disposition_time) FROM alerts"
+
+FIRST_ALERT_SINCE_QUERY = "SELECT MIN(id) FROM alerts WHERE insert_date >= %s"
+
+NEW_ALERT_INDICATORS_QUERY = """SELECT DISTINCT o.value AS indicator
+                                FROM observables o JOIN observable_mapping om ON o.id = om.observable_id
+                                    JOIN alerts a ON a.id = om.alert_id
+                                WHERE o.type = 'indicator' AND a.id > %s AND a.alert_type != 'faqueue'"""
+
+DISPOSITION_CHANGE_INDICATORS_QUERY = """SELECT DISTINCT o.value AS indicator
+                                         FROM observables o JOIN observable_mapping om ON o.id = om.observable_id
+                                             JOIN alerts a ON a.id = om.alert_id
+                                         WHERE o.type = 'indicator' AND a.disposition_time >= %s AND a.alert_type != 'faqueue'"""
+
+
+def rules_fingerprint(config, sections):
+    """Return a hash of the settings of the tune sections. Outcomes worked out with other settings are evaluated again."""
+    settings = {section: dict(config[section]) for section in ['default_tune_settings'] + list(sections)}
+    for section_settings in settings.values():
+        section_settings.pop('interval_minutes', None)
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def scope_time(rule, indicator, modified_time, now):
+    """When an indicator that's only out of the rule's scope because it was modified too recently ages into it."""
+    if modified_time is None or modified_time < rule.cutoff or not rule.matches(indicator, datetime.datetime.min):
+        return None
+    return modified_time + (now - rule.cutoff)
+
+
+def window_time(rule, summary: AlertSummary, now):
+    """When the oldest of the alerts the rule's classification counts ages out of its window."""
+    first_alert_time = summary.cutoffs[rule.cutoff].first_alert_time
+    return first_alert_time + (now - rule.cutoff) if first_alert_time is not None else None
+
+
+def recheck_time(indicator, rules, now, summary: AlertSummary=None, good_rules=()):
+    """Return when aging can next change the outcome of an indicator, or None if only a change in SIP or ACE can.
+
+    good_rules are the rules that found the indicator to be good from its AlertSummary.
+    """
+    modified_time = parse_time(indicator.modified_time)
+    times = [scope_time(rule, indicator, modified_time, now) for rule in rules]
+    if summary is not None:
+        times += [window_time(rule, summary, now) for rule in good_rules]
+    times = [time for time in times if time is not None]
+    return min(times) if times else None
+
+
+def query_changed_indicator_ids(ace_cursor, after_alert_id, disposition_time, resync_since, fetch_size=DEFAULT_FETCH_SIZE):
+    """Return the IDs of the indicators observed in ACE alerts that are new or got a disposition since the watermarks.
+
+    Alerts inserted since resync_since are read again, to pick up indicator
+    observables added while they were being analyzed.
+    """
+    ace_cursor.execute(FIRST_ALERT_SINCE_QUERY, (resync_since,))
+    rows = ace_cursor.fetchall()
+    if rows and rows[0][0] is not None:
+        after_alert_id = min(after_alert_id, rows[0][0] - 1)
+
+    queries = [(NEW_ALERT_INDICATORS_QUERY, after_alert_id)]
+    if disposition_time:
+        queries.append((DISPOSITION_CHANGE_INDICATORS_QUERY, disposition_time))
+
+    indicator_ids = set()
+    for query, watermark in queries:
+        ace_cursor.execute(query, (watermark,))
+        for indicator, in iter_rows(ace_cursor, fetch_size):
+            indicator_id = indicator_id_from_observable_value(indicator)
+            if indicator_id is not None:
+                indicator_ids.add(indicator_id)
+    return indicator_ids
+
+
+def query_ace_watermarks(ace_cursor):
+    """Return the highest alert id and disposition time in ACE."""
+    ace_cursor.execute(ACE_WATERMARK_QUERY)
+    rows = ace_cursor.fetchall()
+    max_alert_id, max_disposition_time = rows[0] if rows else (None, None)
+    return int(max_alert_id or 0), to_text(max_disposition_time)
+
+
+class IncrementalState:
+    """The Analyzed indicators known to incremental tunes and when each needs to be evaluated again.
+
+    Changes are only kept once they're committed, so a dry run, or a run that
+    fails part way through, is rolled back and the next run sees the same changes.
+    """
+
+    def __init__(self, path, resync_window_hours=DEFAULT_RESYNC_WINDOW_HOURS):
+        self.path = path
+        self.resync_window = datetime.timedelta(hours=resync_window_hours)
+        self.lock = threading.RLock()
+
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    @classmethod
+    def from_config(cls, config, home_path):
+        """Open the state described by the [incremental] config section. Relative paths are relative to home_path."""
+        path = config.get('incremental', 'path', fallback=DEFAULT_STATE_PATH)
+        return cls(os.path.join(home_path, path),
+                   resync_window_hours=config.getfloat('incremental', 'resync_window_hours', fallback=DEFAULT_RESYNC_WINDOW_HOURS))
+
+    def close(self):
+        self.db.close()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def rollback(self):
+        with self.lock:
+            self.db.rollback()
+
+    def get_state(self, name, default=None):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row and row[0] is not None else default
+
+    def set_state(self, name, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)", (name, to_text(value)))
+
+    def save(self, indicator, outcome, recheck_time, evaluated_time):
+        """Keep an indicator, its outcome and when it needs to be evaluated again."""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO indicators (id, indicator, outcome, evaluated_time, recheck_time) VALUES (?, ?, ?, ?, ?)",
+                            (indicator.id, json.dumps(indicator.to_json()), outcome, to_text(evaluated_time), to_text(recheck_time)))
+
+    def delete(self, indicator_ids):
+        with self.lock:
+            self.db.executemany("DELETE FROM indicators WHERE id = ?", ((indicator_id,) for indicator_id in indicator_ids))
+
+    def known(self, indicator_ids):
+        """Return the indicator IDs that are being kept."""
+        known = set()
+        with self.lock:
+            for chunk in chunks(indicator_ids, MAX_SQLITE_PARAMETERS):
+                query = f"SELECT id FROM indicators WHERE id IN ({', '.join(['?'] * len(chunk))})"
+                known.update(row[0] for row in self.db.execute(query, chunk))
+        return known
+
+    def due(self, now):
+        """Return the IDs of the indicators that need to be evaluated again by now."""
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT id FROM indicators WHERE recheck_time <= ?", (to_text(now),))}
+
+    def all_ids(self):
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT id FROM indicators")}
+
+    def iter_indicators(self, indicator_ids):
+        """Yield the kept SIP indicators with the given IDs as Indicators, a chunk at a time."""
+        for chunk in chunks(sorted(indicator_ids), MAX_SQLITE_PARAMETERS):
+            query = f"SELECT indicator FROM indicators WHERE id IN ({', '.join(['?'] * len(chunk))}) ORDER BY id"
+            with self.lock:
+                rows = self.db.execute(query, chunk).fetchall()
+            for row in rows:
+                yield Indicator.from_json(json.loads(row[0]))
+
+    def status(self):
+        """Return a dict describing the state."""
+        with self.lock:
+            outcomes = dict(self.db.execute("SELECT COALESCE(outcome, 'out of scope'), COUNT(*) FROM indicators GROUP BY outcome").fetchall())
+            next_recheck = self.db.execute("SELECT MIN(recheck_time) FROM indicators").fetchone()[0]
+        return {'path': self.path,
+                'last_run': self.get_state('last_run'),
+                'sip_modified_time': self.get_state('sip_modified_time'),
+                'ace_alert_id': int(self.get_state('ace_alert_id', 0)),
+                'ace_disposition_time': self.get_state('ace_disposition_time'),
+                'indicators': sum(outcomes.values()),
+                'outcomes': outcomes,
+                'next_recheck': next_recheck}
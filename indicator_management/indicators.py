@@ -0,0 +1,87 @@
+"""Compact in-memory SIP indicators.
+
+SIP returns every indicator as a JSON object with many more fields than tunes
+and reports look at. Indicators are kept as Indicator records instead: only
+the fields they use, in __slots__, with the type, status, user, sources and
+tags interned so the millions of indicators sharing them share one copy.
+"""
+
+import sys
+
+# Fields kept from the SIP indicator JSON.
+FIELDS = ('id', 'type', 'value', 'status', 'sources', 'tags', 'user', 'modified_time')
+
+# One shared tuple per distinct list of sources or tags.
+_interned_tuples = {}
+
+
+def intern_string(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def intern_tuple(values):
+    values = tuple(intern_string(value) for value in values or ())
+    return _interned_tuples.setdefault(values, values)
+
+
+class Indicator:
+    """The fields of a SIP indicator tunes and reports use.
+
+    Fields can be read like attributes or like the keys of the SIP JSON, so an
+    Indicator can be used anywhere the JSON was.
+    """
+
+    __slots__ = FIELDS
+
+    def __init__(self, id, type, value, status=None, sources=(), tags=(), user=None, modified_time=None):
+        self.id = int(id)
+        self.type = intern_string(type)
+        self.value = value
+        self.status = intern_string(status)
+        self.sources = intern_tuple(sources)
+        self.tags = intern_tuple(tags)
+        self.user = intern_string(user)
+        self.modified_time = modified_time
+
+    @classmethod
+    def from_json(cls, data):
+        """Make an Indicator from SIP indicator JSON. An Indicator is returned as is."""
+        if isinstance(data, cls):
+            return data
+        return cls(data['id'], data['type'], data['value'], status=data.get('status'), sources=data.get('sources'), tags=data.get('tags'),
+                   user=data.get('user'), modified_time=data.get('modified_time'))
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def __eq__(self, other):
+        return isinstance(other, Indicator) and all(getattr(self, field) == getattr(other, field) for field in FIELDS)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"Indicator({self.id}, {self.type!r}, {self.value!r})"
+
+    def to_json(self):
+        """Return the kept fields as SIP indicator JSON."""
+        return {'id': self.id,
+                'type': self.type,
+                'value': self.value,
+                'status': self.status,
+                'sources': list(self.sources),
+                'tags': list(self.tags),
+                'user': self.user,
+                'modified_time': self.modified_time}
+
+
+def compact(indicators):
+    """Yield each SIP indicator JSON as an Indicator."""
+    for indicator in indicators:
+        yield Indicator.from_json(indicator)
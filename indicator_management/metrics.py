@@ -0,0 +1,264 @@
+"""Timing and metrics for tuning runs.
+
+RunMetrics records, per tune section, how long each phase of the tune took and
+how many indicators were classified into each category. It also keeps latency
+histograms of SIP GET/PUT calls and ACE queries and counts the rows they
+returned. The SIP client and ACE cursors are wrapped so every call is timed.
+
+At the end of a run the metrics are written as a Prometheus textfile collector
+file and a JSON run summary.
+"""
+
+import contextlib
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import Counter, defaultdict
+
+LOGGER = logging.getLogger("indicator_management.metrics")
+
+# Defaults for the [metrics] config section.
+DEFAULT_METRICS_DIR = os.path.join("var", "metrics")
+PROMETHEUS_FILE_NAME = "indicator_management.prom"
+RUN_SUMMARY_FILE_NAME = "run_summary.json"
+
+# Section label of the phases every tune section shares, like the SIP search.
+ALL_SECTIONS = 'all'
+
+# Prometheus metric name prefix.
+PREFIX = "sip_indicator_management"
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class Histogram:
+    """A latency histogram with fixed buckets."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative_counts(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+    def as_dict(self):
+        return {'count': self.count,
+                'total_seconds': round(self.sum, 6),
+                'mean_seconds': round(self.sum / self.count, 6) if self.count else 0.0,
+                'max_seconds': round(self.max, 6),
+                'buckets': {('+Inf' if bound == float('inf') else str(bound)): count for bound, count in self.cumulative_counts()}}
+
+
+class RunMetrics:
+    """Thread safe metrics of a single run."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Start over for a new run."""
+        with self.lock:
+            self.started = datetime.datetime.now()
+            self.phase_seconds = defaultdict(float)
+            self.indicators = defaultdict(Counter)
+            self.calls = defaultdict(Histogram)
+            self.rows = Counter()
+            self.info = {}
+
+    def add_phase_time(self, section, phase, seconds):
+        with self.lock:
+            self.phase_seconds[(section, phase)] += seconds
+
+    @contextlib.contextmanager
+    def phase(self, section, phase):
+        """Time a phase of a tune section. Time spent in the same phase more than once is added up."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase_time(section, phase, time.perf_counter() - started)
+
+    def timed_iter(self, section, phase, iterable):
+        """Yield from iterable, timing how long is spent waiting on it as a phase."""
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_phase_time(section, phase, time.perf_counter() - started)
+                return
+            self.add_phase_time(section, phase, time.perf_counter() - started)
+            yield item
+
+    def timed_stage(self, section, phase, func):
+        """Wrap a pipeline stage function so the time spent in it is recorded as a phase."""
+        def stage(item):
+            with self.phase(section, phase):
+                return list(func(item))
+        return stage
+
+    def count_indicators(self, section, category, amount=1):
+        with self.lock:
+            self.indicators[section][category] += amount
+
+    def observe_call(self, call, seconds):
+        with self.lock:
+            self.calls[call].observe(seconds)
+
+    @contextlib.contextmanager
+    def time_call(self, call):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_call(call, time.perf_counter() - started)
+
+    def count_rows(self, source, amount):
+        with self.lock:
+            self.rows[source] += amount
+
+    def summary(self):
+        """Return the metrics as a JSON serializable dict."""
+        with self.lock:
+            finished = datetime.datetime.now()
+            sections = defaultdict(lambda: {'phases': {}, 'indicators': {}})
+            for (section, phase), seconds in sorted(self.phase_seconds.items()):
+                sections[section]['phases'][phase] = round(seconds, 6)
+            for section, counts in sorted(self.indicators.items()):
+                sections[section]['indicators'] = dict(counts)
+            return {'started': self.started.isoformat(),
+                    'finished': finished.isoformat(),
+                    'duration_seconds': round((finished - self.started).total_seconds(), 3),
+                    'info': dict(self.info),
+                    'sections': dict(sections),
+                    'calls': {call: histogram.as_dict() for call, histogram in sorted(self.calls.items())},
+                    'rows': dict(self.rows)}
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        summary = self.summary()
+        lines = [f"# HELP {PREFIX}_last_run_timestamp_seconds When the last run finished.",
+                 f"# TYPE {PREFIX}_last_run_timestamp_seconds gauge",
+                 f"{PREFIX}_last_run_timestamp_seconds {datetime.datetime.fromisoformat(summary['finished']).timestamp():.3f}",
+                 f"# HELP {PREFIX}_run_duration_seconds How long the last run took.",
+                 f"# TYPE {PREFIX}_run_duration_seconds gauge",
+                 f"{PREFIX}_run_duration_seconds {summary['duration_seconds']}",
+                 f"# HELP {PREFIX}_phase_seconds Time spent in each phase of each tune section.",
+                 f"# TYPE {PREFIX}_phase_seconds gauge"]
+        for section, data in summary['sections'].items():
+            for phase, seconds in data['phases'].items():
+                lines.append(f'{PREFIX}_phase_seconds{{section="{section}",phase="{phase}"}} {seconds}')
+
+        lines += [f"# HELP {PREFIX}_indicators Indicators classified into each category by each tune section.",
+                  f"# TYPE {PREFIX}_indicators gauge"]
+        for section, data in summary['sections'].items():
+            for category, count in data['indicators'].items():
+                lines.append(f'{PREFIX}_indicators{{section="{section}",category="{category}"}} {count}')
+
+        lines += [f"# HELP {PREFIX}_call_seconds Latency of SIP and ACE calls.",
+                  f"# TYPE {PREFIX}_call_seconds histogram"]
+        with self.lock:
+            for call, histogram in sorted(self.calls.items()):
+                for bound, count in histogram.cumulative_counts():
+                    le = '+Inf' if bound == float('inf') else str(bound)
+                    lines.append(f'{PREFIX}_call_seconds_bucket{{call="{call}",le="{le}"}} {count}')
+                lines.append(f'{PREFIX}_call_seconds_sum{{call="{call}"}} {histogram.sum:.6f}')
+                lines.append(f'{PREFIX}_call_seconds_count{{call="{call}"}} {histogram.count}')
+
+        lines += [f"# HELP {PREFIX}_rows Rows read from SIP and ACE.",
+                  f"# TYPE {PREFIX}_rows gauge"]
+        for source, count in sorted(summary['rows'].items()):
+            lines.append(f'{PREFIX}_rows{{source="{source}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory):
+        """Write the Prometheus textfile and the JSON run summary to directory. Returns their paths."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        paths = []
+        for file_name, content in [(PROMETHEUS_FILE_NAME, self.prometheus()),
+                                   (RUN_SUMMARY_FILE_NAME, json.dumps(self.summary(), indent=2) + "\n")]:
+            path = os.path.join(directory, file_name)
+            # Write then rename so the textfile collector never reads a partial file.
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as fp:
+                fp.write(content)
+            os.replace(tmp_path, path)
+            paths.append(path)
+
+        LOGGER.info(f"wrote run metrics to {', '.join(paths)}")
+        return paths
+
+
+class InstrumentedSipClient:
+    """Wraps a pysip.Client to time its GET and PUT calls and count the indicators returned."""
+
+    def __init__(self, sip, metrics: RunMetrics):
+        self._sip = sip
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self._sip, name)
+
+    def get(self, endpoint):
+        with self._metrics.time_call('sip_get'):
+            result = self._sip.get(endpoint)
+        if isinstance(result, dict) and 'items' in result:
+            self._metrics.count_rows('sip', len(result['items']))
+        elif isinstance(result, list):
+            self._metrics.count_rows('sip', len(result))
+        return result
+
+    def put(self, endpoint, data):
+        with self._metrics.time_call('sip_put'):
+            return self._sip.put(endpoint, data)
+
+
+class InstrumentedCursor:
+    """Wraps an ACE database cursor to time its queries and fetches and count the rows returned."""
+
+    def __init__(self, cursor, metrics: RunMetrics):
+        self._cursor = cursor
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, query, params=None):
+        with self._metrics.time_call('ace_query'):
+            return self._cursor.execute(query, params)
+
+    def fetchmany(self, size=None):
+        with self._metrics.time_call('ace_fetch'):
+            rows = self._cursor.fetchmany(size) if size else self._cursor.fetchmany()
+        self._metrics.count_rows('ace', len(rows))
+        return rows
+
+    def fetchall(self):
+        with self._metrics.time_call('ace_fetch'):
+            rows = self._cursor.fetchall()
+        self._metrics.count_rows('ace', len(rows))
+        return rows
@@ -0,0 +1,125 @@
+"""Staged producer/consumer pipelines connected by bounded queues.
+"""
+
+import logging
+import queue
+import threading
+
+LOGGER = logging.getLogger("indicator_management.pipeline")
+
+# Default number of items that can wait between two stages.
+DEFAULT_QUEUE_SIZE = 4
+
+# Seconds to wait on a queue before checking if the pipeline was stopped.
+POLL_INTERVAL = 0.1
+
+# Put on a queue when everything before it is done.
+DONE = object()
+
+
+class Stage:
+    """A pipeline stage: func is called with each item from the previous stage by
+    workers threads and returns an iterable of items for the next stage.
+    """
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(int(workers), 1)
+
+
+class Pipeline:
+    """Run items from a source through stages connected by bounded queues.
+
+    Every stage runs in its own worker threads, so the stages overlap. A full
+    queue blocks the stage feeding it, so a slow stage slows everything
+    upstream of it down instead of letting items pile up in memory. Iterating
+    over run() yields what the last stage produces. The first exception raised
+    by the source or a stage stops the pipeline and is raised from run().
+    """
+
+    def __init__(self, stages, queue_size=DEFAULT_QUEUE_SIZE):
+        self.stages = stages
+        self.queue_size = max(int(queue_size), 1)
+        self.stop = threading.Event()
+        self.errors = []
+
+    def put(self, q, item):
+        """Put an item on a queue unless the pipeline is stopped. Returns True if it was put."""
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, q):
+        """Get an item from a queue, or DONE if the pipeline is stopped."""
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return DONE
+
+    def fail(self, name, error):
+        LOGGER.error(f"pipeline stage {name} failed: {error}")
+        self.errors.append(error)
+        self.stop.set()
+
+    def produce(self, source, outbox):
+        try:
+            for item in source:
+                if not self.put(outbox, item):
+                    return
+        except Exception as e:
+            self.fail('source', e)
+        finally:
+            self.put(outbox, DONE)
+
+    def work(self, stage, inbox, outbox, remaining, lock):
+        try:
+            while True:
+                item = self.get(inbox)
+                if item is DONE:
+                    # Let the other workers of this stage know too.
+                    self.put(inbox, DONE)
+                    return
+                for output in stage.func(item):
+                    if not self.put(outbox, output):
+                        return
+        except Exception as e:
+            self.fail(stage.name, e)
+        finally:
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.put(outbox, DONE)
+
+    def run(self, source):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self.produce, args=(source, queues[0]), name='pipeline_source', daemon=True)]
+        for i, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            for n in range(stage.workers):
+                threads.append(threading.Thread(target=self.work, args=(stage, queues[i], queues[i + 1], remaining, lock),
+                                                name=f"pipeline_{stage.name}_{n}", daemon=True))
+
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self.get(queues[-1])
+                if item is DONE:
+                    break
+                yield item
+        finally:
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+
+        if self.errors:
+            raise self.errors[0]
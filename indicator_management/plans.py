@@ -0,0 +1,176 @@
+"""Tune plans: what a tune would turn off, evaluated once and applied later.
+
+tune_intel --plan-out evaluates the tune sections like a dry run and writes
+each section's bad indicators, why they're bad and the evidence it was based on
+to a compressed, versioned JSON plan. apply --plan turns them off without
+correlating with ACE again. Before it does, it can check which of them changed
+in SIP or got new ACE alerts since the plan was made and leave those out.
+
+Each section's indicators are kept in columns sorted by ID, so two plans are
+diffed in a single pass over their IDs.
+"""
+
+import datetime
+import gzip
+import json
+import logging
+import os
+
+from collections import namedtuple
+
+from indicator_management.correlation import FP_RECON, NO_ALERTS, NO_MATCHING_ALERTS
+
+LOGGER = logging.getLogger("indicator_management.plans")
+
+# Bumped when the plan format changes. Plans of other versions aren't applied.
+PLAN_VERSION = 1
+
+# The classification reasons, stored in plans by their index.
+REASONS = [FP_RECON, NO_MATCHING_ALERTS, NO_ALERTS]
+
+# An indicator a plan turns off. modified_time is when it was last modified in
+# SIP and last_alert_time when its last ACE alert was inserted, if it has any.
+PlanEntry = namedtuple('PlanEntry', ['id', 'reason', 'modified_time', 'last_alert_time'])
+
+
+class PlanSection:
+    """The bad indicators of a tune section, and the cutoff and bad dispositions they were found with."""
+
+    def __init__(self, name, cutoff, dispositions, entries=None):
+        self.name = name
+        self.cutoff = cutoff
+        self.dispositions = list(dispositions)
+        self.entries = entries or {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry: PlanEntry):
+        self.entries[entry.id] = entry
+
+    def ids(self):
+        """Return the indicator IDs, sorted."""
+        return sorted(self.entries)
+
+    def to_json(self):
+        entries = [self.entries[indicator_id] for indicator_id in self.ids()]
+        return {'cutoff': self.cutoff,
+                'dispositions': self.dispositions,
+                'ids': [entry.id for entry in entries],
+                'reasons': [REASONS.index(entry.reason) for entry in entries],
+                'modified_times': [entry.modified_time for entry in entries],
+                'last_alert_times': [entry.last_alert_time for entry in entries]}
+
+    @classmethod
+    def from_json(cls, name, data):
+        entries = {}
+        for indicator_id, reason, modified_time, last_alert_time in zip(data['ids'], data['reasons'], data['modified_times'], data['last_alert_times']):
+            entries[indicator_id] = PlanEntry(indicator_id, REASONS[reason], modified_time, last_alert_time)
+        return cls(name, data['cutoff'], data['dispositions'], entries)
+
+
+class TunePlan:
+    """The bad indicators of every tune section of a tune, in the order the sections are applied.
+
+    ace_alert_id and ace_disposition_time are the ACE watermarks from before
+    the plan was evaluated, so alerts since then can be found.
+    """
+
+    def __init__(self, created, environment, ace_alert_id=0, ace_disposition_time=None, sections=None):
+        self.created = created
+        self.environment = environment
+        self.ace_alert_id = ace_alert_id
+        self.ace_disposition_time = ace_disposition_time
+        self.sections = sections or {}
+
+    def __len__(self):
+        return sum(len(section) for section in self.sections.values())
+
+    def add_section(self, name, cutoff, dispositions):
+        self.sections[name] = PlanSection(name, cutoff, dispositions)
+        return self.sections[name]
+
+    def ids(self):
+        """Return every indicator ID in the plan."""
+        return {indicator_id for section in self.sections.values() for indicator_id in section.entries}
+
+    def remove(self, indicator_ids):
+        """Leave indicator IDs out of the plan. Returns how many were."""
+        removed = 0
+        for section in self.sections.values():
+            for indicator_id in indicator_ids:
+                if section.entries.pop(indicator_id, None) is not None:
+                    removed += 1
+        return removed
+
+    def to_json(self):
+        return {'version': PLAN_VERSION,
+                'created': self.created,
+                'environment': self.environment,
+                'ace_alert_id': self.ace_alert_id,
+                'ace_disposition_time': self.ace_disposition_time,
+                'reasons': REASONS,
+                'sections': [dict(section.to_json(), name=name) for name, section in self.sections.items()]}
+
+    def write(self, path):
+        """Write the plan to a compressed JSON file, replacing it only once it's complete."""
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, 'wt') as fp:
+            json.dump(self.to_json(), fp, separators=(',', ':'))
+        os.replace(tmp_path, path)
+        LOGGER.info(f"wrote a plan of {len(self)} indicators in {len(self.sections)} tune sections to {path}")
+        return path
+
+    @classmethod
+    def read(cls, path):
+        """Read a plan. Raises ValueError if it isn't a plan of this version."""
+        with gzip.open(path, 'rt') as fp:
+            data = json.load(fp)
+        if not isinstance(data, dict) or data.get('version') != PLAN_VERSION:
+            raise ValueError(f"{path} is not a version {PLAN_VERSION} tune plan")
+        sections = {section['name']: PlanSection.from_json(section['name'], section) for section in data['sections']}
+        return cls(data['created'], data['environment'], ace_alert_id=data['ace_alert_id'], ace_disposition_time=data['ace_disposition_time'],
+                   sections=sections)
+
+    def age(self, now=None):
+        return (now or datetime.datetime.now()) - datetime.datetime.fromisoformat(self.created)
+
+
+def diff_sorted(old_ids, new_ids):
+    """Return the (added, removed, common) IDs of two sorted ID lists, in one pass over both."""
+    added, removed, common = [], [], []
+    i = j = 0
+    while i < len(old_ids) and j < len(new_ids):
+        if old_ids[i] == new_ids[j]:
+            common.append(old_ids[i])
+            i += 1
+            j += 1
+        elif old_ids[i] < new_ids[j]:
+            removed.append(old_ids[i])
+            i += 1
+        else:
+            added.append(new_ids[j])
+            j += 1
+    removed.extend(old_ids[i:])
+    added.extend(new_ids[j:])
+    return added, removed, common
+
+
+def diff_plans(old: TunePlan, new: TunePlan):
+    """Return what changed from the old plan to the new one, by tune section.
+
+    Each section has the IDs the new plan added and removed and the IDs in
+    both whose classification reason changed.
+    """
+    diff = {}
+    for name in list(old.sections) + [name for name in new.sections if name not in old.sections]:
+        old_section = old.sections.get(name) or PlanSection(name, None, [])
+        new_section = new.sections.get(name) or PlanSection(name, None, [])
+        added, removed, common = diff_sorted(old_section.ids(), new_section.ids())
+        diff[name] = {'added': added,
+                      'removed': removed,
+                      'reason_changed': [indicator_id for indicator_id in common
+                                         if old_section.entries[indicator_id].reason != new_section.entries[indicator_id].reason]}
+    return diff
@@ -0,0 +1,238 @@
+"""Records of the indicators tunes have turned off, so the tunes can be undone.
+
+Every tune run appends the indicators it turns off to one compressed record
+log, var/records/<date>/<run>.jsonl.gz. Each batch of records is written as
+its own gzip member of JSON lines, so the log is only ever appended to and a
+run that dies part way through leaves every batch before it readable.
+
+An SQLite index, var/records/index.sqlite, maps each recorded indicator ID to
+its section, date, run and log, so undoing a section, a date, a run or single
+indicators only streams the logs holding them.
+
+Older versions wrote one var/records/<date>/<section>/<id>.json file per
+indicator. Those are still found when undoing by date and section.
+"""
+
+import datetime
+import gzip
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+
+LOGGER = logging.getLogger("indicator_management.records")
+
+# Defaults for the [records] config section.
+DEFAULT_RECORDS_DIR = os.path.join("var", "records")
+DEFAULT_RETENTION_DAYS = 14
+# Record each indicator as SIP returns it, not only the fields tunes keep.
+DEFAULT_FULL_INDICATORS = True
+
+INDEX_FILE_NAME = "index.sqlite"
+LOG_SUFFIX = ".jsonl.gz"
+LEGACY_SUFFIX = ".json"
+
+# SQLite limits the number of parameters in a statement.
+MAX_SQLITE_PARAMETERS = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    indicator_id INTEGER NOT NULL,
+    section TEXT NOT NULL,
+    date TEXT NOT NULL,
+    run TEXT NOT NULL,
+    log TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_indicator_id ON records (indicator_id);
+CREATE INDEX IF NOT EXISTS records_date_section ON records (date, section);
+CREATE INDEX IF NOT EXISTS records_run ON records (run);
+"""
+
+
+class RecordLog:
+    """The append-only record log of a single tune run.
+
+    The log file is created on the first write, so runs that turn nothing off
+    leave nothing behind.
+    """
+
+    def __init__(self, store, run, date):
+        self.store = store
+        self.run = run
+        self.date = date
+        self.path = os.path.join(store.directory, date, run + LOG_SUFFIX)
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def write(self, section, indicators, status_from, status_to):
+        """Append a batch of records of indicators going from status_from to status_to and index them.
+
+        Returns the number of records written.
+        """
+        if not indicators:
+            return 0
+
+        recorded_time = datetime.datetime.now().isoformat(' ')
+        lines = [json.dumps({'id': indicator['id'],
+                             'section': section,
+                             'recorded_time': recorded_time,
+                             'status_from': status_from,
+                             'status_to': status_to,
+                             'indicator': indicator}) for indicator in indicators]
+        data = gzip.compress(("\n".join(lines) + "\n").encode())
+
+        with self.lock:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path, 'ab') as fp:
+                fp.write(data)
+                fp.flush()
+                os.fsync(fp.fileno())
+            self.store.index(((indicator['id'], section, self.date, self.run, os.path.relpath(self.path, self.store.directory))
+                              for indicator in indicators))
+            self.count += len(indicators)
+
+        LOGGER.debug(f"recorded {len(indicators)} indicators for {section} in {self.path}")
+        return len(indicators)
+
+
+class RecordStore:
+    """The record logs and their index."""
+
+    def __init__(self, directory, retention_days=DEFAULT_RETENTION_DAYS):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.lock = threading.RLock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(os.path.join(directory, INDEX_FILE_NAME), check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    @classmethod
+    def from_config(cls, config, home_path):
+        """Create the record store described by the [records] config section. Relative paths are relative to home_path."""
+        directory = config.get('records', 'directory', fallback=DEFAULT_RECORDS_DIR)
+        return cls(os.path.join(home_path, directory),
+                   retention_days=config.getint('records', 'retention_days', fallback=DEFAULT_RETENTION_DAYS))
+
+    def close(self):
+        self.db.close()
+
+    def open_run(self, now=None):
+        """Start the record log of a new tune run."""
+        now = now or datetime.datetime.now()
+        return RecordLog(self, f"{now.strftime('%Y%m%dT%H%M%S')}_{os.getpid()}", str(now.date()))
+
+    def index(self, rows):
+        with self.lock, self.db:
+            self.db.executemany("INSERT INTO records (indicator_id, section, date, run, log) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def where(self, date=None, section=None, run=None, indicator_ids=None):
+        clauses, params = [], []
+        for column, value in [('date', date), ('section', section), ('run', run)]:
+            if value:
+                clauses.append(f"{column} = ?")
+                params.append(str(value))
+        # Too many IDs for one statement are only filtered on when the logs are read.
+        if indicator_ids and len(indicator_ids) <= MAX_SQLITE_PARAMETERS:
+            indicator_ids = [int(indicator_id) for indicator_id in indicator_ids]
+            clauses.append(f"indicator_id IN ({','.join('?' * len(indicator_ids))})")
+            params.extend(indicator_ids)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def runs(self, date=None, section=None):
+        """Return (date, run, section, records) of the recorded runs, oldest first."""
+        where, params = self.where(date=date, section=section)
+        with self.lock:
+            return self.db.execute(f"SELECT date, run, section, COUNT(*) FROM records{where} GROUP BY date, run, section ORDER BY date, run, section",
+                                   params).fetchall()
+
+    def iter_log(self, log):
+        """Yield every record in a log."""
+        with gzip.open(os.path.join(self.directory, log), 'rt') as fp:
+            for line in fp:
+                if line.strip():
+                    yield json.loads(line)
+
+    def iter_records(self, date=None, section=None, run=None, indicator_ids=None):
+        """Stream the records matching the filters from the logs holding them."""
+        where, params = self.where(date=date, section=section, run=run, indicator_ids=indicator_ids)
+        with self.lock:
+            logs = [row[0] for row in self.db.execute(f"SELECT DISTINCT log FROM records{where} ORDER BY log", params)]
+
+        indicator_ids = {int(indicator_id) for indicator_id in indicator_ids} if indicator_ids else None
+        for log in logs:
+            for record in self.iter_log(log):
+                if section and record['section'] != section:
+                    continue
+                if indicator_ids and record['id'] not in indicator_ids:
+                    continue
+                yield record
+
+    def iter_legacy_indicator_ids(self, date=None, section=None, indicator_ids=None):
+        """Yield (indicator ID, date, section) of the legacy per-indicator JSON records matching the filters.
+
+        The IDs come from the file names, the files aren't read.
+        """
+        indicator_ids = {int(indicator_id) for indicator_id in indicator_ids} if indicator_ids else None
+        for date_dir in sorted(os.listdir(self.directory)):
+            if date and date_dir != str(date):
+                continue
+            date_path = os.path.join(self.directory, date_dir)
+            if not os.path.isdir(date_path):
+                continue
+            for section_dir in sorted(os.listdir(date_path)):
+                if section and section_dir != section:
+                    continue
+                section_path = os.path.join(date_path, section_dir)
+                if not os.path.isdir(section_path):
+                    continue
+                for fname in os.listdir(section_path):
+                    if not fname.endswith(LEGACY_SUFFIX) or not fname[:-len(LEGACY_SUFFIX)].isdigit():
+                        continue
+                    indicator_id = int(fname[:-len(LEGACY_SUFFIX)])
+                    if indicator_ids and indicator_id not in indicator_ids:
+                        continue
+                    yield indicator_id, date_dir, section_dir
+
+    def iter_indicator_ids(self, date=None, section=None, run=None, indicator_ids=None):
+        """Yield the distinct IDs of the indicators recorded in the logs and legacy records matching the filters."""
+        seen = set()
+        for record in self.iter_records(date=date, section=section, run=run, indicator_ids=indicator_ids):
+            if record['id'] not in seen:
+                seen.add(record['id'])
+                yield record['id']
+
+        # Legacy records don't belong to a run.
+        if run:
+            return
+        for indicator_id, _, _ in self.iter_legacy_indicator_ids(date=date, section=section, indicator_ids=indicator_ids):
+            if indicator_id not in seen:
+                seen.add(indicator_id)
+                yield indicator_id
+
+    def cleanup(self, retention_days=None, today=None):
+        """Delete the records, logs and legacy records older than retention_days. Returns the dates deleted."""
+        retention_days = self.retention_days if retention_days is None else retention_days
+        today = today or datetime.date.today()
+        oldest = today - datetime.timedelta(days=retention_days)
+
+        deleted = []
+        for date_dir in sorted(os.listdir(self.directory)):
+            try:
+                date = datetime.date.fromisoformat(date_dir)
+            except ValueError:
+                continue
+            if date >= oldest:
+                continue
+
+            LOGGER.info(f"deleting old records in {os.path.join(self.directory, date_dir)}")
+            shutil.rmtree(os.path.join(self.directory, date_dir))
+            deleted.append(date_dir)
+
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM records WHERE date < ?", (str(oldest),))
+        return deleted
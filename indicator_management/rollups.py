@@ -0,0 +1,369 @@
+"""Indicator effectiveness rollups.
+
+How the Analyzed indicators have alerted in ACE, counted by indicator type,
+intel sources, age and alert disposition, and kept in an SQLite database,
+var/rollups.sqlite. The counts are updated incrementally, the same way
+incremental tunes find what changed: only the indicators modified in SIP and
+the ones with new or newly dispositioned ACE alerts are correlated again. Any
+slice of the rollups can then be queried without scanning SIP or ACE.
+
+Each indicator is counted under the month it was last modified in SIP, and its
+alerts under the month they were inserted. Ages are worked out from the
+modified month when the rollups are queried, so the counts never go stale as
+indicators age. Indicators without a modified time are counted under an
+unknown month and age.
+
+The indicator type report is the rollups by type, in the report's format.
+"""
+
+import bisect
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+
+from collections import Counter, defaultdict
+
+from indicator_management.cache import to_text
+from indicator_management.correlation import chunks
+from indicator_management.incremental import MAX_SQLITE_PARAMETERS
+from indicator_management.rules import parse_time
+
+LOGGER = logging.getLogger("indicator_management.rollups")
+
+# Defaults for the [rollups] config section.
+DEFAULT_ROLLUP_PATH = os.path.join("var", "rollups.sqlite")
+DEFAULT_AGE_BUCKETS = [30, 90, 180, 365]
+
+# What the rollups can be grouped by.
+TYPE = 'type'
+SOURCE = 'source'
+AGE = 'age'
+DISPOSITION = 'disposition'
+MONTH = 'month'
+DIMENSIONS = [TYPE, SOURCE, AGE, DISPOSITION, MONTH]
+
+# The month and age of indicators without a modified time.
+UNKNOWN = 'unknown'
+
+# Indicators with this tag are counted as manual indicators.
+MANUAL_INDICATOR_TAG = 'manual_indicator'
+
+# The counts of each indicator and its alerts are kept so they can be taken
+# back out of the rollups when the indicator changes.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS indicators (
+    id INTEGER PRIMARY KEY,
+    type TEXT NOT NULL,
+    sources TEXT NOT NULL,
+    month TEXT NOT NULL,
+    manual INTEGER NOT NULL,
+    no_alerts INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS indicator_alerts (
+    id INTEGER NOT NULL,
+    disposition TEXT NOT NULL,
+    alert_month TEXT NOT NULL,
+    alerts INTEGER NOT NULL,
+    PRIMARY KEY (id, disposition, alert_month)
+);
+CREATE TABLE IF NOT EXISTS indicator_rollups (
+    type TEXT NOT NULL,
+    sources TEXT NOT NULL,
+    month TEXT NOT NULL,
+    indicators INTEGER NOT NULL,
+    manual_indicators INTEGER NOT NULL,
+    no_alerts INTEGER NOT NULL,
+    PRIMARY KEY (type, sources, month)
+);
+CREATE TABLE IF NOT EXISTS alert_rollups (
+    type TEXT NOT NULL,
+    sources TEXT NOT NULL,
+    month TEXT NOT NULL,
+    disposition TEXT NOT NULL,
+    alert_month TEXT NOT NULL,
+    alerts INTEGER NOT NULL,
+    indicators INTEGER NOT NULL,
+    PRIMARY KEY (type, sources, month, disposition, alert_month)
+);
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+INDICATOR_KEY = ('type', 'sources', 'month')
+ALERT_KEY = ('type', 'sources', 'month', 'disposition', 'alert_month')
+
+
+def month_of(value):
+    """Return the YYYY-MM month of a SIP or ACE time, or UNKNOWN if there isn't one."""
+    parsed = parse_time(value)
+    return parsed.strftime('%Y-%m') if parsed is not None else UNKNOWN
+
+
+def age_labels(age_buckets=DEFAULT_AGE_BUCKETS):
+    """Return the labels of the age buckets, youngest first, like ['0-30d', '30-90d', '90d+']."""
+    lowers = [0] + list(age_buckets)
+    return [f"{lower}-{upper}d" for lower, upper in zip(lowers, age_buckets)] + [f"{lowers[-1]}d+"]
+
+
+def age_bucket(month, now, age_buckets=DEFAULT_AGE_BUCKETS):
+    """Return the age bucket label of the indicators last modified in a month, or UNKNOWN for the UNKNOWN month."""
+    if month == UNKNOWN:
+        return UNKNOWN
+    age = (now - datetime.datetime.strptime(month, '%Y-%m')).days
+    return age_labels(age_buckets)[bisect.bisect_right(age_buckets, age)]
+
+
+def alert_counts(indicator_id, alerts):
+    """Return the indicator_alerts rows of an indicator's (insert_date, disposition, fa_queue) alerts.
+
+    Alerts without a disposition only count toward the indicator having alerted.
+    """
+    dispositions = Counter((disposition, month_of(insert_date)) for insert_date, disposition, fa_queue in alerts if disposition)
+    return [(indicator_id, disposition, alert_month, count) for (disposition, alert_month), count in dispositions.items()]
+
+
+def indicator_counts(indicator, alerts):
+    """Return what an Analyzed Indicator and its alerts add to the rollups: its indicators row and its indicator_alerts rows."""
+    row = (indicator.id, indicator.type, ','.join(sorted(indicator.sources)), month_of(indicator.modified_time),
+           int(MANUAL_INDICATOR_TAG in indicator.tags), int(not alerts))
+    return row, alert_counts(indicator.id, alerts)
+
+
+class RollupStore:
+    """The rollups of how the Analyzed indicators have alerted in ACE.
+
+    Changes are only kept once they're committed, so a refresh that fails part
+    way through is rolled back and the next one sees the same changes.
+    """
+
+    def __init__(self, path, age_buckets=DEFAULT_AGE_BUCKETS):
+        self.path = path
+        self.age_buckets = sorted(age_buckets)
+        self.lock = threading.RLock()
+
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    @classmethod
+    def from_config(cls, config, home_path):
+        """Open the rollups described by the [rollups] config section. Relative paths are relative to home_path."""
+        path = config.get('rollups', 'path', fallback=DEFAULT_ROLLUP_PATH)
+        age_buckets = config.get('rollups', 'age_buckets', fallback=None)
+        return cls(os.path.join(home_path, path),
+                   age_buckets=[int(days) for days in age_buckets.split(',')] if age_buckets else DEFAULT_AGE_BUCKETS)
+
+    def close(self):
+        self.db.close()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def rollback(self):
+        with self.lock:
+            self.db.rollback()
+
+    def clear(self):
+        """Forget every indicator, count and watermark."""
+        with self.lock:
+            for table in ['indicators', 'indicator_alerts', 'indicator_rollups', 'alert_rollups', 'state']:
+                self.db.execute(f"DELETE FROM {table}")
+
+    def get_state(self, name, default=None):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row and row[0] is not None else default
+
+    def set_state(self, name, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)", (name, to_text(value)))
+
+    def known(self, indicator_ids):
+        """Return the indicator IDs that are counted."""
+        known = set()
+        with self.lock:
+            for chunk in chunks(indicator_ids, MAX_SQLITE_PARAMETERS):
+                query = f"SELECT id FROM indicators WHERE id IN ({', '.join(['?'] * len(chunk))})"
+                known.update(row[0] for row in self.db.execute(query, chunk))
+        return known
+
+    def save(self, indicators, alerts):
+        """Count Analyzed Indicators, replacing what was counted for them before.
+
+        alerts is a dict of indicator ID to its (insert_date, disposition, fa_queue) alerts.
+        """
+        self.replace([indicator.id for indicator in indicators],
+                     [indicator_counts(indicator, alerts[indicator.id]) for indicator in indicators])
+
+    def save_alerts(self, alerts):
+        """Count the new alerts of indicators that are already counted. alerts is a dict of indicator ID to its alerts."""
+        with self.lock:
+            rows = self.select("SELECT id, type, sources, month, manual, no_alerts FROM indicators WHERE id IN ({})", list(alerts))
+            counts = [((indicator_id, indicator_type, sources, month, manual, int(not alerts[indicator_id])),
+                       alert_counts(indicator_id, alerts[indicator_id]))
+                      for indicator_id, indicator_type, sources, month, manual, no_alerts in rows]
+            self.replace([row[0] for row in rows], counts)
+
+    def delete(self, indicator_ids):
+        """Stop counting indicators, like the ones that are no longer Analyzed."""
+        self.replace(indicator_ids, [])
+
+    def select(self, query, indicator_ids):
+        """Run a query with an 'IN ({})' of indicator IDs a chunk at a time and return every row."""
+        rows = []
+        for chunk in chunks(indicator_ids, MAX_SQLITE_PARAMETERS):
+            rows.extend(self.db.execute(query.format(', '.join(['?'] * len(chunk))), chunk).fetchall())
+        return rows
+
+    def replace(self, indicator_ids, counts):
+        """Take what was counted for indicator_ids out of the rollups and add counts, a list of (indicators row, indicator_alerts rows), in."""
+        indicator_deltas = Counter()
+        alert_deltas = Counter()
+
+        def add(row, alert_rows, sign):
+            indicator_id, indicator_type, sources, month, manual, no_alerts = row
+            indicator_deltas[(indicator_type, sources, month, 'indicators')] += sign
+            indicator_deltas[(indicator_type, sources, month, 'manual_indicators')] += sign * manual
+            indicator_deltas[(indicator_type, sources, month, 'no_alerts')] += sign * no_alerts
+            for indicator_id, disposition, alert_month, alerts in alert_rows:
+                alert_deltas[(indicator_type, sources, month, disposition, alert_month, 'alerts')] += sign * alerts
+                alert_deltas[(indicator_type, sources, month, disposition, alert_month, 'indicators')] += sign
+
+        with self.lock:
+            old_alert_rows = defaultdict(list)
+            for row in self.select("SELECT id, disposition, alert_month, alerts FROM indicator_alerts WHERE id IN ({})", indicator_ids):
+                old_alert_rows[row[0]].append(row)
+            for row in self.select("SELECT id, type, sources, month, manual, no_alerts FROM indicators WHERE id IN ({})", indicator_ids):
+                add(row, old_alert_rows[row[0]], -1)
+            for row, alert_rows in counts:
+                add(row, alert_rows, 1)
+
+            for chunk in chunks(indicator_ids, MAX_SQLITE_PARAMETERS):
+                placeholders = ', '.join(['?'] * len(chunk))
+                self.db.execute(f"DELETE FROM indicators WHERE id IN ({placeholders})", chunk)
+                self.db.execute(f"DELETE FROM indicator_alerts WHERE id IN ({placeholders})", chunk)
+            self.db.executemany("INSERT INTO indicators (id, type, sources, month, manual, no_alerts) VALUES (?, ?, ?, ?, ?, ?)",
+                                (row for row, alert_rows in counts))
+            self.db.executemany("INSERT INTO indicator_alerts (id, disposition, alert_month, alerts) VALUES (?, ?, ?, ?)",
+                                (alert_row for row, alert_rows in counts for alert_row in alert_rows))
+
+            self.apply('indicator_rollups', INDICATOR_KEY, ('indicators', 'manual_indicators', 'no_alerts'), indicator_deltas)
+            self.apply('alert_rollups', ALERT_KEY, ('alerts', 'indicators'), alert_deltas)
+
+    def apply(self, table, key, columns, deltas):
+        """Add deltas, a Counter of (*key, column) to how much it changed, to the rollups in table."""
+        changes = defaultdict(lambda: dict.fromkeys(columns, 0))
+        for (*values, column), delta in deltas.items():
+            if delta:
+                changes[tuple(values)][column] += delta
+
+        where = ' AND '.join(f"{name} = ?" for name in key)
+        update = f"UPDATE {table} SET {', '.join(f'{column} = {column} + ?' for column in columns)} WHERE {where}"
+        insert = f"INSERT INTO {table} ({', '.join(key + columns)}) VALUES ({', '.join(['?'] * len(key + columns))})"
+        # Nothing is counted under a key once every indicator it counted has changed.
+        delete = f"DELETE FROM {table} WHERE {where} AND indicators <= 0"
+        for values, change in changes.items():
+            counts = [change[column] for column in columns]
+            if not self.db.execute(update, counts + list(values)).rowcount:
+                self.db.execute(insert, list(values) + counts)
+            self.db.execute(delete, values)
+
+    def query(self, by=(TYPE,), types=None, sources=None, ages=None, dispositions=None, since=None, now=None):
+        """Return the rollups grouped by the DIMENSIONS in by, as a list of dicts sorted by them.
+
+        Indicators are counted under each of their sources when grouped by
+        source, and only those with one of the sources are counted when
+        filtered by source. since, a YYYY-MM month, leaves out older alerts.
+
+        Grouped by disposition or month, each row has the number of alerts
+        and of the indicators that had them. Otherwise each row has the number
+        of indicators, manual_indicators and no_alerts, the total_alerts with a
+        disposition and the alerts of each disposition, like the type report.
+        """
+        now = now or datetime.datetime.now()
+        by = [dimension for dimension in DIMENSIONS if dimension in by]
+        by_alert = DISPOSITION in by or MONTH in by
+        ages_of = {}
+
+        def groups(row_type, row_sources, month, disposition=None, alert_month=None):
+            """Yield the group keys a rollup row counts toward, if it isn't filtered out."""
+            if month not in ages_of:
+                ages_of[month] = age_bucket(month, now, self.age_buckets)
+            row_sources = row_sources.split(',') if row_sources else ['']
+            if types and row_type not in types:
+                return
+            if sources and not any(source in sources for source in row_sources):
+                return
+            if ages and ages_of[month] not in ages:
+                return
+            if disposition is not None and ((dispositions and disposition not in dispositions) or (since and (alert_month == UNKNOWN or alert_month < since))):
+                return
+            values = {TYPE: [row_type], SOURCE: row_sources, AGE: [ages_of[month]], DISPOSITION: [disposition], MONTH: [alert_month]}
+            keys = [()]
+            for dimension in by:
+                keys = [key + (value,) for key in keys for value in values[dimension]]
+            yield from keys
+
+        results = defaultdict(Counter)
+        with self.lock:
+            alert_rows = self.db.execute("SELECT type, sources, month, disposition, alert_month, alerts, indicators FROM alert_rollups").fetchall()
+            indicator_rows = [] if by_alert else self.db.execute("SELECT type, sources, month, indicators, manual_indicators, no_alerts "
+                                                                 "FROM indicator_rollups").fetchall()
+
+        for row_type, row_sources, month, indicators, manual_indicators, no_alerts in indicator_rows:
+            for key in groups(row_type, row_sources, month):
+                results[key].update(indicators=indicators, manual_indicators=manual_indicators, no_alerts=no_alerts)
+        for row_type, row_sources, month, disposition, alert_month, alerts, indicators in alert_rows:
+            for key in groups(row_type, row_sources, month, disposition, alert_month):
+                if by_alert:
+                    results[key].update(alerts=alerts, indicators=indicators)
+                else:
+                    results[key].update({'total_alerts': alerts, disposition: alerts})
+
+        # Age buckets sort youngest first, then the unknown age.
+        age_order = {label: bucket for bucket, label in enumerate(age_labels(self.age_buckets) + [UNKNOWN])}
+
+        def sort_key(item):
+            return tuple(age_order[value] if dimension == AGE else value for dimension, value in zip(by, item[0]))
+
+        rows = []
+        for key, counts in sorted(results.items(), key=sort_key):
+            row = dict(zip(by, key))
+            if by_alert:
+                row.update(alerts=counts['alerts'], indicators=counts['indicators'])
+            else:
+                row.update(indicators=counts['indicators'], manual_indicators=counts['manual_indicators'], no_alerts=counts['no_alerts'],
+                           total_alerts=counts['total_alerts'])
+                row.update(sorted((name, count) for name, count in counts.items() if name.isupper()))
+            rows.append(row)
+        return rows
+
+    def type_report(self):
+        """Return the indicator type report of the Analyzed indicators, built from the rollups."""
+        report = {'sip_query_filter': 'status=Analyzed',
+                  'results': {}}
+        for row in self.query(by=(TYPE,)):
+            results = {'count': row.pop('indicators')}
+            results.update(row)
+            report['results'][results.pop(TYPE)] = results
+        return report
+
+    def status(self):
+        """Return a dict describing the rollups."""
+        with self.lock:
+            indicators, months = self.db.execute("SELECT COUNT(*), COUNT(DISTINCT month) FROM indicators").fetchone()
+            rollups = sum(self.db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ['indicator_rollups', 'alert_rollups'])
+        return {'path': self.path,
+                'last_refresh': self.get_state('last_refresh'),
+                'sip_modified_time': self.get_state('sip_modified_time'),
+                'ace_alert_id': int(self.get_state('ace_alert_id', 0)),
+                'ace_disposition_time': self.get_state('ace_disposition_time'),
+                'indicators': indicators,
+                'months': months,
+                'rollups': rollups}
@@ -0,0 +1,140 @@
+"""Tune sections compiled into in-memory rules.
+
+Instead of every tune section searching SIP for its own indicators, SIP is
+searched once for the union of the sections' scopes and each indicator is
+routed to every section whose rule it matches.
+"""
+
+import datetime
+import logging
+
+LOGGER = logging.getLogger("indicator_management.rules")
+
+# Default for the [default_tune_settings] days.
+DEFAULT_TUNE_DAYS = 90
+
+
+def split_setting(tune_instructions, name):
+    """Return the comma separated values of a tune setting, or an empty list if it isn't set."""
+    return tune_instructions[name].split(',') if tune_instructions.get(name) else []
+
+
+def parse_time(value):
+    """Parse a SIP time as a naive local datetime, comparable with the tune cutoffs. A missing time is None."""
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        parsed = value
+    else:
+        try:
+            parsed = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            # dateutil is slow to import and SIP times are ISO formatted, so it's rarely needed.
+            from dateutil.parser import parse
+            parsed = parse(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+
+class TuneRule:
+    """The scope, cutoff and bad dispositions of a tune section.
+
+    An indicator matches the rule if it's in the section's scope, the same as
+    if it had been returned by the section's own SIP search.
+    """
+
+    def __init__(self, name, cutoff, bad_dispositions, types=None, sources=None, not_sources=None, good_analysts=None, good_tags=None):
+        self.name = name
+        self.cutoff = cutoff
+        self.bad_dispositions = list(bad_dispositions)
+        self.types = frozenset(types) if types else None
+        self.sources = frozenset(sources) if sources else None
+        self.not_sources = frozenset(not_sources or [])
+        self.good_analysts = frozenset(good_analysts or [])
+        self.good_tags = frozenset(good_tags or [])
+
+    def __repr__(self):
+        return f"TuneRule({self.name!r}, cutoff={self.cutoff})"
+
+    @classmethod
+    def from_config(cls, tune_instructions, default_settings, now=None):
+        """Compile a tune section. Settings it doesn't have come from the [default_tune_settings] section."""
+        now = now or datetime.datetime.now()
+        # Only consider indicators that are at least this old.
+        tuning_days = tune_instructions.getint('days') if 'days' in tune_instructions else default_settings.getint('days', DEFAULT_TUNE_DAYS)
+        # Only consider these ACE alert dispositions.
+        bad_dispositions = split_setting(tune_instructions, 'dispositions') or default_settings['dispositions'].split(',')
+        return cls(tune_instructions.name,
+                   now - datetime.timedelta(days=tuning_days),
+                   bad_dispositions,
+                   types=split_setting(tune_instructions, 'indicator_types'),
+                   sources=split_setting(tune_instructions, 'sources'),
+                   not_sources=split_setting(tune_instructions, 'not_sources'),
+                   good_analysts=split_setting(tune_instructions, 'good_analysts'),
+                   good_tags=split_setting(tune_instructions, 'good_tags'))
+
+    def matches(self, indicator, modified_time=None):
+        """Return True if the Indicator is in the rule's scope. modified_time is the parsed indicator.modified_time.
+
+        An indicator without a modified_time is treated as old enough for every cutoff.
+        """
+        if modified_time is None:
+            modified_time = parse_time(indicator.modified_time)
+        if modified_time is not None and modified_time >= self.cutoff:
+            return False
+        if self.types is not None and indicator.type not in self.types:
+            return False
+        if self.sources is not None and self.sources.isdisjoint(indicator.sources):
+            return False
+        if self.not_sources and not self.not_sources.isdisjoint(indicator.sources):
+            return False
+        if indicator.user in self.good_analysts:
+            return False
+        if self.good_tags and not self.good_tags.isdisjoint(indicator.tags):
+            return False
+        return True
+
+    def query(self, types=None):
+        """Return the SIP query for the rule's scope, of only the given indicator types if there are any."""
+        types = types or self.types
+        query = f"/api/indicators?&status=Analyzed&modified_before={self.cutoff}"
+        if types:
+            query += '&types=' + ','.join(sorted(types))
+        if self.sources:
+            query += '&sources=[OR]' + ','.join(sorted(self.sources))
+        if self.not_sources:
+            query += '&not_sources=' + ','.join(sorted(self.not_sources))
+        if self.good_analysts:
+            query += '&not_users=' + ','.join(sorted(self.good_analysts))
+        if self.good_tags:
+            query += '&not_tags=' + ','.join(sorted(self.good_tags))
+        return query
+
+
+def superset_query(rules):
+    """Return the SIP query for the union of the rules' scopes.
+
+    Filters every rule shares are left to SIP, the rest are applied by the rules.
+    """
+    query = f"/api/indicators?&status=Analyzed&modified_before={max(rule.cutoff for rule in rules)}"
+    if all(rule.types for rule in rules):
+        query += '&types=' + ','.join(sorted(frozenset().union(*(rule.types for rule in rules))))
+    if all(rule.sources for rule in rules):
+        query += '&sources=[OR]' + ','.join(sorted(frozenset().union(*(rule.sources for rule in rules))))
+    not_sources = frozenset.intersection(*(rule.not_sources for rule in rules))
+    if not_sources:
+        query += '&not_sources=' + ','.join(sorted(not_sources))
+    good_analysts = frozenset.intersection(*(rule.good_analysts for rule in rules))
+    if good_analysts:
+        query += '&not_users=' + ','.join(sorted(good_analysts))
+    good_tags = frozenset.intersection(*(rule.good_tags for rule in rules))
+    if good_tags:
+        query += '&not_tags=' + ','.join(sorted(good_tags))
+    return query
+
+
+def route(indicator, rules):
+    """Return the rules an Indicator matches."""
+    modified_time = parse_time(indicator.modified_time)
+    return [rule for rule in rules if rule.matches(indicator, modified_time)]
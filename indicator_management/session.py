@@ -0,0 +1,73 @@
+"""The SIP client IndicatorManager connects to SIP with.
+
+It's kept apart from indicator_management.sip because pysip and requests are
+slow to import: this module is only imported when SIP is first used.
+"""
+
+import json
+
+from urllib.parse import urljoin
+
+import pysip
+import requests
+
+from indicator_management.sip import DEFAULT_WORKERS
+
+
+class SessionClient(pysip.Client):
+    """A pysip.Client that sends every request through one requests.Session.
+
+    pysip opens a new HTTPS connection for every request. The session keeps up
+    to pool_size connections to SIP open and reuses them, which matters to the
+    concurrent status updates and to a long running serve daemon. Responses and
+    errors are handled the same way pysip handles them.
+    """
+
+    def __init__(self, sip_host, apikey, verify=True, pool_size=DEFAULT_WORKERS):
+        super().__init__(sip_host, apikey, verify=verify)
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Apikey {apikey}'
+        self.session.verify = verify
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(int(pool_size), 1))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def url(self, endpoint):
+        # Clean up the given endpoint, like pysip does.
+        if endpoint.startswith('/'):
+            endpoint = endpoint[1:]
+        return urljoin(self._api_url, endpoint.replace('api/', ''))
+
+    @staticmethod
+    def check(response):
+        if not str(response.status_code).startswith('2'):
+            if response.status_code == 409:
+                raise pysip.ConflictError(response.text)
+            raise pysip.RequestError(response.text)
+
+    def get(self, endpoint):
+        response = self.session.get(self.url(endpoint))
+        if not str(response.status_code).startswith('2'):
+            raise pysip.RequestError(response.text)
+        return json.loads(response.text)
+
+    def post(self, endpoint, data):
+        response = self.session.post(self.url(endpoint), json=data)
+        # pysip decodes the response before checking the status code, see is_retryable().
+        result = json.loads(response.text)
+        self.check(response)
+        return result
+
+    def put(self, endpoint, data):
+        response = self.session.put(self.url(endpoint), json=data)
+        result = json.loads(response.text)
+        self.check(response)
+        return result
+
+    def delete(self, endpoint):
+        response = self.session.delete(self.url(endpoint))
+        self.check(response)
+        return response.text
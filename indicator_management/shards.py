@@ -0,0 +1,188 @@
+"""Sharded tunes and indicator type reports.
+
+The indicator ID space is split into shards by ID modulo the shard count.
+Each shard is evaluated by its own process, with its own SIP client and ACE
+connection, either locally or on another host, and writes a shard result file.
+The shard results are merged deterministically, so the merged result is the
+same as an unsharded run's, before anything is turned off.
+"""
+
+import datetime
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+
+from collections import namedtuple
+
+LOGGER = logging.getLogger("indicator_management.shards")
+
+# Version of the shard result file format.
+SHARD_RESULT_VERSION = 1
+
+TUNE = 'tune'
+REPORT = 'report'
+
+# Report counters that aren't alert dispositions, in the order the unsharded report adds them.
+REPORT_COUNTERS = ['count', 'total_alerts', 'no_alerts', 'manual_indicators']
+
+
+class Shard(namedtuple('Shard', ['index', 'count'])):
+    """Shard index of count shards. It holds the indicator IDs where id % count == index."""
+
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, value):
+        """Parse a shard like '0/4'."""
+        try:
+            index, count = [int(part) for part in value.split('/')]
+        except ValueError:
+            raise ValueError(f"shard must look like INDEX/COUNT, like 0/4: {value}")
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"shard index must be from 0 to {count - 1}: {value}")
+        return cls(index, count)
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+    def contains(self, indicator_id):
+        return indicator_id % self.count == self.index
+
+    def filter(self, indicators):
+        """Yield the indicators in this shard."""
+        for indicator in indicators:
+            if self.contains(indicator['id']):
+                yield indicator
+
+
+def default_shard_output(kind, shard):
+    return f"{kind}_shard_{shard.index}_of_{shard.count}.json.gz"
+
+
+def write_shard_result(path, kind, shard, **data):
+    """Write the result of a shard to a compressed JSON file."""
+    result = {'version': SHARD_RESULT_VERSION,
+              'kind': kind,
+              'shard': list(shard),
+              'created': datetime.datetime.now().isoformat(' ')}
+    result.update(data)
+    if os.path.dirname(path):
+        # Shards running at the same time share the output directory.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, 'wt') as fp:
+        json.dump(result, fp)
+    LOGGER.info(f"wrote {kind} shard {shard} result to {path}")
+    return path
+
+
+def read_shard_result(path):
+    with gzip.open(path, 'rt') as fp:
+        return json.load(fp)
+
+
+def check_shard_results(results, kind):
+    """Raise a ValueError unless results are every shard of one sharded run of kind."""
+    if not results:
+        raise ValueError("no shard results to merge")
+    for result in results:
+        if result.get('version') != SHARD_RESULT_VERSION:
+            raise ValueError(f"unsupported shard result version: {result.get('version')}")
+        if result['kind'] != kind:
+            raise ValueError(f"can't merge a {result['kind']} shard result into a {kind}")
+
+    counts = {result['shard'][1] for result in results}
+    if len(counts) != 1:
+        raise ValueError(f"shard results are from runs with different shard counts: {sorted(counts)}")
+    count = counts.pop()
+    indexes = sorted(result['shard'][0] for result in results)
+    if indexes != list(range(count)):
+        missing = sorted(set(range(count)) - set(indexes))
+        duplicates = sorted({index for index in indexes if indexes.count(index) > 1})
+        raise ValueError(f"shard results must have every shard of {count} exactly once, missing {missing}, duplicated {duplicates}")
+    return sorted(results, key=lambda result: result['shard'][0])
+
+
+def merge_tune_results(results, sections=None):
+    """Merge tune shard results. Returns a dict of section name to the bad indicators it turns off, sorted by ID.
+
+    Sections are merged in the order they were evaluated. An indicator found by
+    more than one section is only kept in the first, since an unsharded run
+    turns it off there and the later sections' SIP searches no longer find it.
+
+    If sections are given, only those sections are merged, and every shard must
+    have evaluated them.
+    """
+    results = check_shard_results(results, TUNE)
+    evaluated = list(results[0]['sections'])
+    for result in results:
+        if list(result['sections']) != evaluated:
+            raise ValueError(f"shard {result['shard'][0]} evaluated different tune sections: {list(result['sections'])} != {evaluated}")
+    if sections is None:
+        sections = evaluated
+    else:
+        missing = [section for section in sections if section not in evaluated]
+        if missing:
+            raise ValueError(f"shards didn't evaluate tune sections: {', '.join(missing)}")
+        sections = [section for section in evaluated if section in sections]
+
+    merged = {}
+    seen = set()
+    for section in sections:
+        indicators = {}
+        for result in results:
+            for indicator in result['sections'][section]:
+                if indicator['id'] not in seen:
+                    indicators[indicator['id']] = indicator
+        merged[section] = [indicators[indicator_id] for indicator_id in sorted(indicators)]
+        seen.update(indicators)
+    return merged
+
+
+def merge_reports(results):
+    """Merge indicator type report shard results into one report by adding up their counters."""
+    results = check_shard_results(results, REPORT)
+    sip_query_filters = {result['report']['sip_query_filter'] for result in results}
+    if len(sip_query_filters) != 1:
+        raise ValueError(f"shard reports are for different SIP queries: {sorted(sip_query_filters)}")
+
+    totals = {}
+    for result in results:
+        for indicator_type, counters in result['report']['results'].items():
+            type_totals = totals.setdefault(indicator_type, {counter: 0 for counter in REPORT_COUNTERS})
+            for counter, value in counters.items():
+                type_totals[counter] = type_totals.get(counter, 0) + value
+
+    report = {'sip_query_filter': sip_query_filters.pop(), 'results': {}}
+    for indicator_type in sorted(totals):
+        counters = totals[indicator_type]
+        dispositions = sorted(counter for counter in counters if counter not in REPORT_COUNTERS)
+        report['results'][indicator_type] = {counter: counters[counter] for counter in REPORT_COUNTERS + dispositions}
+    return report
+
+
+def run_local_shards(run_shard, count, output_dir, kind):
+    """Run count shards in local worker processes and return the paths of their result files.
+
+    run_shard(shard, output_path) is called in each forked worker process and
+    must write the shard's result to output_path. Raises a RuntimeError if any
+    worker fails.
+    """
+    context = multiprocessing.get_context('fork')
+    workers = []
+    for index in range(count):
+        shard = Shard(index, count)
+        path = os.path.join(output_dir, default_shard_output(kind, shard))
+        process = context.Process(target=run_shard, args=(shard, path), name=f"{kind}_shard_{index}")
+        process.start()
+        workers.append((shard, path, process))
+
+    failed = []
+    for shard, path, process in workers:
+        process.join()
+        if process.exitcode != 0 or not os.path.exists(path):
+            failed.append(str(shard))
+    if failed:
+        raise RuntimeError(f"{kind} shards {', '.join(failed)} failed")
+    return [path for shard, path, process in workers]
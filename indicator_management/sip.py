@@ -0,0 +1,266 @@
+"""Paged SIP indicator searches and concurrent, rate limited SIP indicator status updates.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+LOGGER = logging.getLogger("indicator_management.sip")
+
+# Indicator statuses.
+ANALYZED = 'Analyzed'
+INFORMATIONAL = 'Informational'
+NEW = 'New'
+
+# Defaults for the [sip_read] config section.
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_PREFETCH_PAGES = 2
+
+# Defaults for the [sip_write] config section.
+DEFAULT_WORKERS = 8
+DEFAULT_REQUESTS_PER_SECOND = 20
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+
+# pysip only gives us the response text of a failed request. These show up in
+# the error pages of server errors worth retrying.
+SERVER_ERROR_MARKERS = ('Internal Server Error', 'Bad Gateway', 'Service Unavailable', 'Gateway Timeout', 'Gateway Time-out')
+
+# The outcome of setting the status of a single indicator.
+WriteResult = namedtuple('WriteResult', ['indicator_id', 'status', 'success', 'attempts', 'error'])
+
+
+def iter_indicator_pages(sip: 'pysip.Client', query, page_size=DEFAULT_PAGE_SIZE):
+    """Yield the indicators matching a SIP query one page (list of indicators) at a time.
+
+    If SIP answers with a plain list instead of a page, like it does for bulk
+    queries, the whole list is yielded as a single page.
+    """
+    separator = '&' if '?' in query else '?'
+    page = 1
+    while True:
+        result = sip.get(f"{query}{separator}page={page}&per_page={page_size}")
+        if not isinstance(result, dict) or 'items' not in result:
+            if result:
+                yield result
+            return
+
+        if result['items']:
+            yield result['items']
+        if not result['items'] or not result.get('_links', {}).get('next'):
+            return
+        page += 1
+
+
+def iter_indicators(sip: 'pysip.Client', query, page_size=DEFAULT_PAGE_SIZE, prefetch_pages=DEFAULT_PREFETCH_PAGES):
+    """Yield the indicators matching a SIP query as the pages arrive.
+
+    Up to prefetch_pages pages are fetched by a background thread while the
+    caller works on the current page, so at most prefetch_pages + 1 pages are
+    held in memory. A prefetch_pages of 0 fetches each page when it is needed.
+    """
+    if prefetch_pages <= 0:
+        for page in iter_indicator_pages(sip, query, page_size):
+            yield from page
+        return
+
+    pages = queue.Queue(maxsize=prefetch_pages)
+    stop = threading.Event()
+    done = object()
+
+    def fetch():
+        try:
+            for page in iter_indicator_pages(sip, query, page_size):
+                while not stop.is_set():
+                    try:
+                        pages.put(page, timeout=1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            pages.put(done)
+        except Exception as e:
+            pages.put(e)
+
+    fetcher = threading.Thread(target=fetch, name='sip_read', daemon=True)
+    fetcher.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is done:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield from page
+    finally:
+        stop.set()
+
+
+def is_retryable(error):
+    """Return True if a failed SIP request is worth retrying."""
+    # Imported when a request fails, they're slow to import.
+    import pysip
+    import requests
+
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+    # pysip decodes the response before checking the status code, so a proxy's
+    # HTML 502/503/504 page shows up as a JSON decode error.
+    if isinstance(error, ValueError):
+        return True
+    if isinstance(error, pysip.RequestError):
+        return any(marker in str(error) for marker in SERVER_ERROR_MARKERS)
+    return False
+
+
+class TokenBucket:
+    """Thread safe token bucket limiting how many requests per second are made.
+
+    A rate of 0 or less disables rate limiting.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(self.rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class SipWriteExecutor:
+    """Set the status of SIP indicators, or fetch them, from a pool of threads.
+
+    Requests are rate limited with a token bucket and retried with exponential
+    backoff on server errors and timeouts. Every indicator gets a WriteResult,
+    one failed indicator doesn't stop the rest.
+    """
+
+    def __init__(self, sip: 'pysip.Client', workers=DEFAULT_WORKERS, requests_per_second=DEFAULT_REQUESTS_PER_SECOND,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF):
+        self.sip = sip
+        self.workers = max(int(workers), 1)
+        self.bucket = TokenBucket(requests_per_second)
+        self.max_retries = max(int(max_retries), 0)
+        self.backoff = float(backoff)
+
+    @classmethod
+    def from_config(cls, sip: 'pysip.Client', config):
+        """Create an executor from the [sip_write] config section."""
+        return cls(sip,
+                   workers=config.getint('sip_write', 'workers', fallback=DEFAULT_WORKERS),
+                   requests_per_second=config.getfloat('sip_write', 'requests_per_second', fallback=DEFAULT_REQUESTS_PER_SECOND),
+                   max_retries=config.getint('sip_write', 'max_retries', fallback=DEFAULT_MAX_RETRIES),
+                   backoff=config.getfloat('sip_write', 'backoff', fallback=DEFAULT_BACKOFF))
+
+    def set_status(self, indicator_id, status):
+        """Set the status of one indicator, retrying transient errors. Returns a WriteResult."""
+        attempts = 0
+        while True:
+            attempts += 1
+            self.bucket.acquire()
+            try:
+                self.sip.put(f"/api/indicators/{indicator_id}", {'status': status})
+                return WriteResult(indicator_id, status, True, attempts, None)
+            except Exception as e:
+                if attempts > self.max_retries or not is_retryable(e):
+                    LOGGER.error(f"failed to set indicator {indicator_id} to {status} after {attempts} attempts: {e}")
+                    return WriteResult(indicator_id, status, False, attempts, str(e))
+                delay = self.backoff * (2 ** (attempts - 1))
+                LOGGER.warning(f"retrying indicator {indicator_id} in {delay:.1f} seconds after error: {e}")
+                time.sleep(delay)
+
+    def get_indicator(self, indicator_id):
+        """Fetch the full JSON of one indicator, retrying transient errors. Raises the error if it can't be fetched."""
+        attempts = 0
+        while True:
+            attempts += 1
+            self.bucket.acquire()
+            try:
+                return self.sip.get(f"/api/indicators/{indicator_id}")
+            except Exception as e:
+                if attempts > self.max_retries or not is_retryable(e):
+                    raise
+                delay = self.backoff * (2 ** (attempts - 1))
+                LOGGER.warning(f"retrying indicator {indicator_id} in {delay:.1f} seconds after error: {e}")
+                time.sleep(delay)
+
+    def get_indicators(self, indicator_ids):
+        """Fetch the full JSON of a batch of indicators concurrently. Returns them in the order of indicator_ids."""
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sip_read') as pool:
+            return list(pool.map(self.get_indicator, indicator_ids))
+
+    def set_statuses(self, indicator_ids, status):
+        """Set the status of many indicators concurrently.
+
+        Yields a WriteResult for each indicator as its update finishes. Only a
+        few requests per worker are in flight at once so large iterables of
+        indicator IDs aren't all queued up front.
+        """
+        max_pending = self.workers * 4
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sip_write') as pool:
+            pending = set()
+            for indicator_id in indicator_ids:
+                pending.add(pool.submit(self.set_status, indicator_id, status))
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in pending:
+                yield future.result()
+
+
+class WriteSummary:
+    """Track the throughput and failures of SIP status updates."""
+
+    def __init__(self, description):
+        self.description = description
+        self.started = time.monotonic()
+        self.finished = None
+        self.succeeded = 0
+        self.failed = []
+        self.retries = 0
+
+    def add(self, result: WriteResult):
+        self.retries += result.attempts - 1
+        if result.success:
+            self.succeeded += 1
+        else:
+            self.failed.append(result)
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    @property
+    def total(self):
+        return self.succeeded + len(self.failed)
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self):
+        return self.total / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (f"{self.description}: {self.succeeded} of {self.total} indicators updated in {self.elapsed:.1f} seconds "
+                f"({self.rate:.1f}/sec), {len(self.failed)} failed, {self.retries} retries")
@@ -0,0 +1,136 @@
+"""Fixtures running IndicatorManager against the benchmark fakes: a fake SIP and an ACE database in SQLite.
+
+The ace fixture is an empty ACE database the tests add their own alerts to,
+and hand_written Worlds serve indicators written out by the tests with them.
+Other Worlds hold a synthetic dataset, for comparing one way of running a tune
+with another.
+"""
+
+import argparse
+import math
+import os
+import sqlite3
+
+from array import array
+
+import pytest
+
+from benchmarks.fakes import FakeAceDatabase, FakeSipClient
+from benchmarks.run import build_config
+from benchmarks.synthetic import SyntheticDataset
+
+from indicator_management import IndicatorManager
+
+# Small enough to keep the tests quick, big enough that every tune section turns off indicators.
+DEFAULT_SIZE = 2000
+
+
+class World:
+    """A dataset, the fake SIP and ACE serving it and the config of managers working on them.
+
+    Without a dataset, a synthetic one and its alerts are made.
+    """
+
+    def __init__(self, directory, size=DEFAULT_SIZE, seed=5, dataset=None, ace=None):
+        self.directory = directory
+        if dataset is None:
+            self.dataset = SyntheticDataset(size, seed=seed)
+            self.ace = FakeAceDatabase(os.path.join(directory, 'ace.sqlite'))
+            self.dataset.populate_ace(self.ace)
+        else:
+            self.dataset = dataset
+            self.ace = ace
+        self.sip = FakeSipClient(self.dataset)
+        self.config = build_config(argparse.Namespace(ace_cache=False, config=None), directory)
+        self.config['metrics']['enabled'] = 'False'
+        self.config['records'] = {'directory': os.path.join(directory, 'records')}
+        self.config['incremental'] = {'path': os.path.join(directory, 'incremental.sqlite'), 'resync_window_hours': '0'}
+
+    def manager(self, **kwargs):
+        return IndicatorManager(config=self.config, sip=self.sip, ace_cursor_factory=self.ace.cursor, **kwargs)
+
+    def turned_off(self):
+        """Return the IDs of the indicators whose status changed since the dataset was made."""
+        return {index + 1 for index in range(len(self.dataset)) if self.dataset.status_column[index] != self.dataset.original_status_column[index]}
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+
+def hand_written_dataset(indicators):
+    """Return a dataset of indicators with IDs from 1.
+
+    indicators are dicts of a type, source and status, optionally tags and a
+    modified_time datetime. Indicators without a modified_time have none in SIP.
+    """
+    dataset = SyntheticDataset(len(indicators))
+    for index, indicator in enumerate(indicators):
+        dataset.type_column[index] = dataset.types.index(indicator['type'])
+        dataset.source_column[index] = dataset.sources.index(indicator['source'])
+        dataset.user_column[index] = dataset.users.index(indicator.get('user', 'analyst1'))
+        dataset.status_column[index] = dataset.statuses.index(indicator['status'])
+        dataset.tag_column[index] = sum(1 << dataset.tags.index(tag) for tag in indicator.get('tags', []))
+        dataset.modified_column[index] = indicator['modified_time'].timestamp() if indicator.get('modified_time') else math.nan
+    dataset.original_status_column = array('B', dataset.status_column)
+    return dataset
+
+
+class AceAlerts(FakeAceDatabase):
+    """A FakeAceDatabase the tests add alerts to by hand."""
+
+    def add_alert(self, indicator_ids, insert_date, disposition=None, disposition_time=None, alert_type='manual', description=None, alert_id=None):
+        """Add an alert the indicators were observed in. Returns its ID."""
+        with sqlite3.connect(self.path) as db:
+            if alert_id is None:
+                alert_id = (db.execute("SELECT MAX(id) FROM alerts").fetchone()[0] or 0) + 1
+            db.execute("INSERT INTO alerts (id, insert_date, alert_type, description, disposition, disposition_time) VALUES (?, ?, ?, ?, ?, ?)",
+                       (alert_id, insert_date, alert_type, description or f"Alert {alert_id}", disposition, disposition_time))
+            for indicator_id in indicator_ids:
+                db.execute("INSERT OR IGNORE INTO observables (id, type, value) VALUES (?, 'indicator', ?)", (indicator_id, f"sip:{indicator_id}"))
+                db.execute("INSERT INTO observable_mapping (observable_id, alert_id) VALUES (?, ?)", (indicator_id, alert_id))
+        return alert_id
+
+    def add_observable(self, indicator_id, alert_id):
+        """Observe an indicator in an existing alert, like analysis adding observables to it later."""
+        with sqlite3.connect(self.path) as db:
+            db.execute("INSERT OR IGNORE INTO observables (id, type, value) VALUES (?, 'indicator', ?)", (indicator_id, f"sip:{indicator_id}"))
+            db.execute("INSERT INTO observable_mapping (observable_id, alert_id) VALUES (?, ?)", (indicator_id, alert_id))
+
+    def set_disposition(self, alert_id, disposition, disposition_time):
+        with sqlite3.connect(self.path) as db:
+            db.execute("UPDATE alerts SET disposition = ?, disposition_time = ? WHERE id = ?", (disposition, disposition_time, alert_id))
+
+
+@pytest.fixture
+def ace(tmp_path):
+    return AceAlerts(str(tmp_path / 'ace.sqlite'))
+
+
+@pytest.fixture
+def make_world(tmp_path):
+    """Return a function making Worlds. Worlds made with the same arguments hold the same data."""
+    count = 0
+
+    def make(**kwargs):
+        nonlocal count
+        count += 1
+        directory = tmp_path / f"world{count}"
+        directory.mkdir()
+        return World(str(directory), **kwargs)
+
+    return make
+
+
+@pytest.fixture
+def hand_written(tmp_path, ace):
+    """Return a function making a World of hand_written_dataset indicators, with the alerts added to the ace fixture."""
+
+    def make(indicators):
+        return World(str(tmp_path), dataset=hand_written_dataset(indicators), ace=ace)
+
+    return make
+
+
+@pytest.fixture
+def world(make_world):
+    return make_world()
@@ -0,0 +1,80 @@
+"""ACE results are streamed a fetch_size batch at a time from parameterised queries of only the columns used."""
+
+import datetime
+from collections import Counter
+
+import pytest
+
+from indicator_management.correlation import AceAlertSource, iter_rows
+
+NOW = datetime.datetime(2022, 6, 1, 12, 0, 0)
+
+
+class StreamingCursor:
+    """Wraps a FakeAceCursor to behave like pymysql's unbuffered SSCursor and remember what was asked of it.
+
+    Like an SSCursor, every row of a query has to be read before the next query is executed.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.queries = []
+        self.fetch_sizes = []
+        self.unread = False
+
+    def execute(self, query, params=()):
+        assert not self.unread, "executed a query before the rows of the last one were read"
+        self.queries.append((query, list(params)))
+        self.cursor.execute(query, params)
+        self.unread = True
+
+    def fetchmany(self, size=1):
+        self.fetch_sizes.append(size)
+        rows = self.cursor.fetchmany(size)
+        if len(rows) < size:
+            self.unread = False
+        return rows
+
+    def fetchall(self):
+        self.unread = False
+        return self.cursor.fetchall()
+
+
+@pytest.fixture
+def cursor(ace):
+    """Indicator 1 has three alerts, one from the FA Queue, 2 has one and a faqueue alert, and 3 none."""
+    ace.add_alert([1, 2], '2022-05-01 10:00:00', 'FALSE_POSITIVE', '2022-05-01 11:00:00')
+    ace.add_alert([1], '2022-05-02 10:00:00')
+    ace.add_alert([1], '2022-05-03 10:00:00', 'DELIVERY', '2022-05-03 11:00:00', description='ACE - FA Queue - Suspect Hash')
+    ace.add_alert([2], '2022-05-04 10:00:00', 'DELIVERY', '2022-05-04 11:00:00', alert_type='faqueue')
+    return StreamingCursor(ace.cursor())
+
+
+def test_iter_rows(cursor):
+    cursor.execute("SELECT id FROM alerts ORDER BY id")
+    assert list(iter_rows(cursor, fetch_size=3)) == [(1,), (2,), (3,), (4,)]
+    # Until a batch comes back empty.
+    assert cursor.fetch_sizes == [3, 3, 3]
+
+
+@pytest.mark.parametrize('fetch_size', [1, 2, 1000])
+def test_streamed_alerts(cursor, fetch_size):
+    source = AceAlertSource(cursor, fetch_size=fetch_size)
+
+    assert source.alerts([1, 2, 3]) == {1: [(datetime.datetime(2022, 5, 1, 10), 'FALSE_POSITIVE', False),
+                                            (datetime.datetime(2022, 5, 2, 10), None, False),
+                                            (datetime.datetime(2022, 5, 3, 10), 'DELIVERY', True)],
+                                        2: [(datetime.datetime(2022, 5, 1, 10), 'FALSE_POSITIVE', False)],
+                                        3: []}
+    assert source.disposition_counts([1, 2, 3]) == {1: Counter({'FALSE_POSITIVE': 1, None: 1, 'DELIVERY': 1}),
+                                                    2: Counter({'FALSE_POSITIVE': 1}),
+                                                    3: Counter()}
+    summaries = source.summaries([1, 2, 3], [NOW - datetime.timedelta(days=90)])
+    assert [summaries[indicator_id].total_alerts for indicator_id in [1, 2, 3]] == [3, 1, 0]
+
+    assert set(cursor.fetch_sizes) == {fetch_size}
+    for query, params in cursor.queries:
+        assert 'SELECT *' not in query
+        # The observable values are parameters, so every chunk of the same size runs the same statement.
+        assert 'sip:' not in query
+        assert params[-3:] == ['sip:1', 'sip:2', 'sip:3']
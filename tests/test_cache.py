@@ -0,0 +1,83 @@
+"""The local ACE cache syncs new alerts, late observables and disposition changes from ACE."""
+
+import datetime
+import os
+
+import pytest
+
+from indicator_management.cache import AlertCache
+
+INSERTED = datetime.datetime(2022, 2, 10, 12, 0, 0)
+
+
+def at(hours):
+    """An ACE time, hours after the first alert was inserted."""
+    return (INSERTED + datetime.timedelta(hours=hours)).isoformat(' ')
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = AlertCache(os.path.join(tmp_path, 'cache.sqlite'), resync_window_hours=1)
+    yield cache
+    cache.close()
+
+
+def test_sync_new_alerts(ace, cache):
+    ace.add_alert([1, 2], at(0), 'FALSE_POSITIVE', at(1))
+    ace.add_alert([1], at(2), description='ACE - FA Queue - Suspect Hash')
+    ace.add_alert([2], at(3), 'DELIVERY', at(4), alert_type='faqueue')
+    assert cache.is_stale()
+
+    assert cache.sync(ace.cursor()) == {'alerts': 2, 'indicator_alerts': 3, 'dispositions': 0}
+    assert cache.alerts([1, 2, 3]) == {1: [(INSERTED, 'FALSE_POSITIVE', False), (INSERTED + datetime.timedelta(hours=2), None, True)],
+                                       2: [(INSERTED, 'FALSE_POSITIVE', False)],
+                                       3: []}
+    assert cache.disposition_counts([1, 2]) == {1: {'FALSE_POSITIVE': 1, None: 1}, 2: {'FALSE_POSITIVE': 1}}
+    assert not cache.is_stale()
+    assert cache.status()['max_alert_id'] == 2
+    assert cache.status()['max_disposition_time'] == at(4)
+
+    ace.add_alert([3], at(5), 'DELIVERY', at(6))
+    assert cache.sync(ace.cursor()) == {'alerts': 1, 'indicator_alerts': 1, 'dispositions': 0}
+    assert cache.alerts([3]) == {3: [(INSERTED + datetime.timedelta(hours=5), 'DELIVERY', False)]}
+
+
+def test_sync_disposition_changes(ace, cache):
+    first = ace.add_alert([1], at(0))
+    second = ace.add_alert([1], at(1), 'FALSE_POSITIVE', at(2))
+    cache.sync(ace.cursor())
+
+    ace.set_disposition(first, 'DELIVERY', at(3))
+    ace.set_disposition(second, 'RECONNAISSANCE', at(4))
+    assert cache.sync(ace.cursor())['dispositions'] == 2
+    assert cache.alerts([1])[1] == [(INSERTED, 'DELIVERY', False), (INSERTED + datetime.timedelta(hours=1), 'RECONNAISSANCE', False)]
+    assert cache.sync(ace.cursor())['dispositions'] == 0
+
+
+def test_redisposition_during_sync_with_new_alerts(ace, cache):
+    old = ace.add_alert([1], at(0), 'FALSE_POSITIVE', at(1))
+    cache.sync(ace.cursor())
+
+    # The old alert is dispositioned again before the new alert is, and both are synced together.
+    ace.set_disposition(old, 'DELIVERY', at(10))
+    ace.add_alert([2], at(9), 'FALSE_POSITIVE', at(11))
+    changes = cache.sync(ace.cursor())
+    assert changes['alerts'] == 1
+    assert changes['dispositions'] == 1
+    assert cache.alerts([1, 2]) == {1: [(INSERTED, 'DELIVERY', False)], 2: [(INSERTED + datetime.timedelta(hours=9), 'FALSE_POSITIVE', False)]}
+
+
+def test_sync_late_observables(ace, cache):
+    # Alerts inserted within the resync window are read again for observables added since.
+    recent = datetime.datetime.now().replace(microsecond=0)
+    old = ace.add_alert([1], at(0))
+    new = ace.add_alert([1], recent.isoformat(' '))
+    cache.sync(ace.cursor())
+
+    ace.add_observable(2, old)
+    ace.add_observable(3, new)
+    cache.sync(ace.cursor())
+    assert cache.alerts([2, 3]) == {2: [], 3: [(recent, None, False)]}
+
+    cache.rebuild(ace.cursor())
+    assert cache.alerts([2, 3]) == {2: [(INSERTED, None, False)], 3: [(recent, None, False)]}
@@ -0,0 +1,72 @@
+"""ACE alerts are summarized per indicator and tune cutoff, straight from ACE and from the local ACE cache."""
+
+import datetime
+import os
+
+import pytest
+
+from indicator_management.cache import AlertCache
+from indicator_management.correlation import (FP_RECON, GOOD, NO_ALERTS, NO_MATCHING_ALERTS, AceAlertSource, AlertSummary, CutoffAlerts,
+                                              classify, disposition_summary)
+
+DAY = datetime.timedelta(days=1)
+NOW = datetime.datetime(2022, 6, 1, 12, 0, 0)
+RECENT, OLD = NOW - 30 * DAY, NOW - 90 * DAY
+BAD = ['FALSE_POSITIVE', 'IGNORE']
+
+
+def at(days_ago):
+    return (NOW - days_ago * DAY).isoformat(' ')
+
+
+@pytest.fixture
+def alerts(ace):
+    """Indicator 1 alerted recently and long ago, 2 only long ago, 3 only in FA Queue and faqueue alerts and 4 never."""
+    ace.add_alert([1, 2], at(100), 'DELIVERY')
+    ace.add_alert([1], at(60), 'FALSE_POSITIVE')
+    ace.add_alert([1], at(10))
+    ace.add_alert([1], at(5), 'IGNORE')
+    ace.add_alert([1], at(1), 'DELIVERY', description='ACE - FA Queue - Suspect Hash')
+    ace.add_alert([3], at(20), 'DELIVERY', description='ACE - FA Queue - Suspect Hash')
+    ace.add_alert([3], at(2), 'DELIVERY', alert_type='faqueue')
+    return ace
+
+
+EXPECTED = {1: AlertSummary(1, 5, NOW - 1 * DAY, {OLD: CutoffAlerts(3, NOW - 60 * DAY, frozenset(['FALSE_POSITIVE', None, 'IGNORE'])),
+                                                  RECENT: CutoffAlerts(2, NOW - 10 * DAY, frozenset([None, 'IGNORE']))}),
+            2: AlertSummary(2, 1, NOW - 100 * DAY, {OLD: CutoffAlerts(0, None, frozenset()), RECENT: CutoffAlerts(0, None, frozenset())}),
+            3: AlertSummary(3, 1, NOW - 20 * DAY, {OLD: CutoffAlerts(0, None, frozenset()), RECENT: CutoffAlerts(0, None, frozenset())}),
+            4: AlertSummary(4, 0, None, {OLD: CutoffAlerts(0, None, frozenset()), RECENT: CutoffAlerts(0, None, frozenset())})}
+
+
+def test_summaries_from_ace(alerts):
+    assert AceAlertSource(alerts.cursor()).summaries([1, 2, 3, 4], [RECENT, OLD, RECENT]) == EXPECTED
+    # One row per indicator that has alerted.
+    assert alerts.stats.as_dict()['rows'] == 3
+
+
+def test_summaries_from_cache(alerts, tmp_path):
+    cache = AlertCache(os.path.join(tmp_path, 'cache.sqlite'))
+    cache.sync(alerts.cursor())
+    assert cache.summaries([1, 2, 3, 4], [RECENT, OLD]) == EXPECTED
+
+
+def test_classify():
+    assert [classify(disposition_summary(EXPECTED[1], cutoff), BAD) for cutoff in (OLD, RECENT)] == [GOOD, GOOD]
+    assert classify(disposition_summary(EXPECTED[1], RECENT), BAD + [None]) == FP_RECON
+    assert classify(disposition_summary(EXPECTED[2], OLD), BAD) == NO_MATCHING_ALERTS
+    assert classify(disposition_summary(EXPECTED[3], OLD), BAD) == NO_MATCHING_ALERTS
+    assert classify(disposition_summary(EXPECTED[4], OLD), BAD) == NO_ALERTS
+
+
+def test_fa_queue_is_case_sensitive(ace, tmp_path):
+    for description in ['ACE - FA Queue - Suspect Hash', 'ace - fa queue - suspect hash', 'ACE - FA QUEUE', 'Alert FA Queue*', 'Manual alert']:
+        ace.add_alert([1], at(1), 'FALSE_POSITIVE', description=description)
+    alerts = AceAlertSource(ace.cursor()).alerts([1])[1]
+    # Only 'ACE - FA Queue - Suspect Hash' and 'Alert FA Queue*' have FA Queue in the same case.
+    assert [fa_queue for insert_date, disposition, fa_queue in alerts] == [True, False, False, True, False]
+
+    cache = AlertCache(os.path.join(tmp_path, 'cache.sqlite'))
+    cache.sync(ace.cursor())
+    assert cache.alerts([1])[1] == alerts
+    assert AceAlertSource(ace.cursor()).summaries([1], [OLD])[1].cutoffs[OLD].alerts == 3
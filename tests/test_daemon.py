@@ -0,0 +1,107 @@
+"""The serve daemon answers scope, dry run, report and run requests on its Unix socket."""
+
+import datetime
+import json
+import os
+import threading
+
+import pytest
+
+from indicator_management.daemon import CLEANUP_RECORDS, Daemon, request
+
+NOW = datetime.datetime.now()
+DAY = datetime.timedelta(days=1)
+
+INDICATORS = [
+    # Never alerted.
+    {'type': 'Hash - MD5', 'source': 'OSINT1', 'status': 'Analyzed', 'modified_time': NOW - 60 * DAY},
+    {'type': 'URI - URL', 'source': 'OSINT1', 'status': 'Analyzed', 'modified_time': NOW - 60 * DAY},
+    # Never alerted.
+    {'type': 'URI - URL', 'source': 'Company1', 'status': 'Analyzed', 'user': 'analyst3', 'modified_time': NOW - 100 * DAY},
+    {'type': 'Address - ipv4-addr', 'source': 'vendor_feed', 'status': 'Analyzed', 'modified_time': NOW - 400 * DAY},
+    {'type': 'URI - URL', 'source': 'OSINT2', 'status': 'Informational', 'modified_time': NOW - 400 * DAY},
+]
+
+
+@pytest.fixture
+def world(hand_written, ace):
+    world = hand_written(INDICATORS)
+    ace.add_alert([2], (NOW - 10 * DAY).isoformat(' '), 'DELIVERY')
+    ace.add_alert([4], (NOW - 100 * DAY).isoformat(' '), 'DELIVERY')
+    return world
+
+
+@pytest.fixture
+def daemon(world, tmp_path):
+    """A daemon answering requests on a socket in the background. Its jobs aren't run unless requested."""
+    daemon = Daemon(world.manager(keep_connections=True), socket_path=str(tmp_path / 'im.sock'), state_path=str(tmp_path / 'serve_state.json'))
+    server = daemon.bind()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield daemon
+    server.shutdown()
+    server.server_close()
+    daemon.manager.close()
+
+
+def test_status(daemon):
+    status = request(daemon.socket_path, 'status')
+    assert status['busy'] is False
+    assert sorted(job['name'] for job in status['jobs']) == sorted([CLEANUP_RECORDS, 'tune_all_other_external_intel', 'tune_internal_intel',
+                                                                    'tune_osint'])
+    assert oct(os.stat(daemon.socket_path).st_mode & 0o777) == oct(0o600)
+
+
+def test_scope(daemon, world):
+    assert request(daemon.socket_path, 'scope')['sections'] == {'tune_osint': {'matching': 2},
+                                                                'tune_internal_intel': {'matching': 1},
+                                                                'tune_all_other_external_intel': {'matching': 1}}
+    result = request(daemon.socket_path, 'scope', sections=['tune_osint'], by_type=True)
+    assert result['sections'] == {'tune_osint': {'matching': 2}}
+    assert result['types'] == {'tune_osint': {'Hash - MD5': 1, 'URI - URL': 1}}
+    assert 'indicators_read' not in world.sip.stats.as_dict()
+
+
+def test_dry_run(daemon, world):
+    sections = request(daemon.socket_path, 'dry_run')['sections']
+    assert {section: counts.get('bad', 0) for section, counts in sections.items()} == {'tune_osint': 1, 'tune_internal_intel': 1,
+                                                                                     'tune_all_other_external_intel': 0}
+    assert not world.turned_off()
+
+
+def test_report(daemon):
+    report = request(daemon.socket_path, 'report')
+    assert {indicator_type: results['count'] for indicator_type, results in report['results'].items()} == {
+        'Address - ipv4-addr': 1, 'Hash - MD5': 1, 'URI - URL': 2}
+
+
+def test_run(daemon, world):
+    request(daemon.socket_path, 'run', job='tune_internal_intel')
+    assert world.turned_off() == {3}
+    with open(daemon.state_path) as fp:
+        assert list(json.load(fp)) == ['tune_internal_intel']
+
+    # The next daemon picks up the schedule where this one left off.
+    next_run = Daemon(daemon.manager, socket_path=daemon.socket_path, state_path=daemon.state_path).jobs['tune_internal_intel'].next_run
+    assert next_run > datetime.datetime.now() + datetime.timedelta(minutes=1400)
+
+
+def test_bad_requests(daemon):
+    with pytest.raises(RuntimeError, match="unknown command tune, one of: status, scope, dry_run, report, run"):
+        request(daemon.socket_path, 'tune')
+    with pytest.raises(RuntimeError, match="unknown job tune_missing"):
+        request(daemon.socket_path, 'run', job='tune_missing')
+    with pytest.raises(RuntimeError, match="another daemon is already listening"):
+        Daemon(daemon.manager, socket_path=daemon.socket_path, state_path=daemon.state_path).bind()
+
+
+def test_stale_socket(world, tmp_path):
+    socket_path = str(tmp_path / 'im.sock')
+    first = Daemon(world.manager(), socket_path=socket_path, state_path=str(tmp_path / 'serve_state.json'))
+    first.bind().server_close()
+    assert os.path.exists(socket_path)
+
+    # Left behind by a daemon that died, nothing is listening on it.
+    second = Daemon(world.manager(), socket_path=socket_path, state_path=str(tmp_path / 'serve_state.json'))
+    server = second.bind()
+    server.server_close()
@@ -0,0 +1,80 @@
+"""Incremental tunes only re-evaluate what changed and turn off what a full tune does."""
+
+import datetime
+import sqlite3
+
+from indicator_management.indicators import Indicator
+from indicator_management.rules import route
+
+
+def alerts_of(world, indicator_id):
+    """Return the (id, insert_date, disposition, fa_queue) of the non-faqueue alerts of an indicator."""
+    with sqlite3.connect(world.ace.path) as db:
+        rows = db.execute("""SELECT a.id, a.insert_date, a.disposition, a.description FROM observables o
+                             JOIN observable_mapping om ON o.id = om.observable_id JOIN alerts a ON a.id = om.alert_id
+                             WHERE o.type = 'indicator' AND o.value = ? AND a.alert_type != 'faqueue'""", (f"sip:{indicator_id}",)).fetchall()
+    return [(alert_id, datetime.datetime.fromisoformat(insert_date), disposition, 'FA Queue' in (description or ''))
+            for alert_id, insert_date, disposition, description in rows]
+
+
+def find_good_indicator(world, tune_rules):
+    """Return the ID of an Analyzed indicator that's in a tune section's scope and good by its alerts."""
+    for index in range(len(world.dataset)):
+        indicator = Indicator.from_json(world.dataset.indicator(index))
+        matched = route(indicator, tune_rules) if indicator.status == 'Analyzed' else []
+        if matched:
+            rule = matched[0]
+            # Good if an alert counted toward the cutoff has a disposition that isn't bad.
+            if any(insert_date >= rule.cutoff and not fa_queue and disposition not in rule.bad_dispositions
+                   for alert_id, insert_date, disposition, fa_queue in alerts_of(world, indicator.id)):
+                return indicator.id
+    raise AssertionError("no good indicator in scope")
+
+
+def disposition_alerts(world, indicator_id, disposition):
+    """Give every alert of an indicator a new disposition, like an analyst would in ACE."""
+    # The synthetic dispositions were set up to an hour after their alerts, so this is newer than any of them.
+    disposition_time = (datetime.datetime.now() + datetime.timedelta(hours=2)).replace(microsecond=0).isoformat(' ')
+    with sqlite3.connect(world.ace.path) as db:
+        for alert in alerts_of(world, indicator_id):
+            db.execute("UPDATE alerts SET disposition = ?, disposition_time = ? WHERE id = ?", (disposition, disposition_time, alert[0]))
+
+
+def full_tune(world):
+    assert world.manager().turn_off_indicators_according_to_tune_instructions(dry_run=False, record_changes=False)
+    return world.turned_off()
+
+
+def test_incremental_tune_after_disposition_change(make_world):
+    incremental, full = make_world(), make_world()
+    manager = incremental.manager(keep_connections=True)
+
+    assert manager.turn_off_indicators_incrementally(dry_run=False, record_changes=False, write_metrics=False)
+    assert incremental.turned_off() == full_tune(full)
+
+    indicator_id = find_good_indicator(incremental, manager.get_tune_rules())
+    for world in (incremental, full):
+        disposition_alerts(world, indicator_id, 'FALSE_POSITIVE')
+
+    # A dry run neither turns it off nor loses the change.
+    manager.prepare_run()
+    assert manager.turn_off_indicators_incrementally(dry_run=True, record_changes=False, write_metrics=False)
+    assert indicator_id not in incremental.turned_off()
+
+    manager.prepare_run()
+    assert manager.turn_off_indicators_incrementally(dry_run=False, record_changes=False, write_metrics=False)
+    assert manager.metrics.info['changes']['ace_changed'] >= 1
+    assert manager.metrics.info['changes']['evaluated'] < len(incremental.dataset) / 10
+    assert indicator_id in incremental.turned_off()
+    assert incremental.turned_off() == full_tune(full)
+
+
+def test_incremental_tune_without_changes(world):
+    manager = world.manager(keep_connections=True)
+    assert manager.turn_off_indicators_incrementally(dry_run=False, record_changes=False, write_metrics=False)
+    turned_off = world.turned_off()
+
+    manager.prepare_run()
+    assert manager.turn_off_indicators_incrementally(dry_run=False, record_changes=False, write_metrics=False)
+    assert manager.metrics.info['turned_off'] == 0
+    assert world.turned_off() == turned_off
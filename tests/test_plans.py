@@ -0,0 +1,79 @@
+"""Tune plans are written like a dry run, diffed, and applied later with or without the stale check."""
+
+import datetime
+import sqlite3
+
+from indicator_management.plans import TunePlan
+
+
+def change_in_sip(world, indicator_ids):
+    """Modify indicators in SIP now, which takes them out of every tune section's scope."""
+    now = datetime.datetime.now().timestamp()
+    for indicator_id in indicator_ids:
+        world.dataset.modified_column[indicator_id - 1] = now
+    world.dataset.version += 1
+
+
+def add_good_alert(world, indicator_id):
+    """Add a new DELIVERY alert for an indicator to ACE."""
+    now = datetime.datetime.now().replace(microsecond=0).isoformat(' ')
+    with sqlite3.connect(world.ace.path) as db:
+        alert_id = db.execute("SELECT MAX(id) FROM alerts").fetchone()[0] + 1
+        db.execute("INSERT INTO alerts (id, insert_date, alert_type, description, disposition, disposition_time) VALUES (?, ?, ?, ?, ?, ?)",
+                   (alert_id, now, 'manual', f"Alert {alert_id}", 'DELIVERY', now))
+        db.execute("INSERT INTO observable_mapping (observable_id, alert_id) VALUES (?, ?)", (indicator_id, alert_id))
+
+
+def apply(world, path, check_stale):
+    world.dataset.reset_statuses()
+    assert world.manager().apply_tune_plan(path, check_stale=check_stale, write_metrics=False)
+    return world.turned_off()
+
+
+def test_plan_is_the_tune(make_world):
+    world, full = make_world(), make_world()
+    plan_path = world.path('plan.json.gz')
+    assert world.manager().write_tune_plan(plan_path, write_metrics=False)
+    assert not world.turned_off()
+
+    assert full.manager().turn_off_indicators_according_to_tune_instructions(dry_run=False, record_changes=False)
+    plan = TunePlan.read(plan_path)
+    assert plan.ids() == full.turned_off()
+    assert list(plan.sections) == world.manager().get_tune_sections()
+
+    assert world.manager().apply_tune_plan(plan_path, dry_run=True, write_metrics=False)
+    assert not world.turned_off()
+    assert apply(world, plan_path, check_stale=False) == plan.ids()
+    assert apply(world, plan_path, check_stale=True) == plan.ids()
+
+
+def test_apply_changed_plan(world):
+    manager = world.manager()
+    old_path, new_path = world.path('old.json.gz'), world.path('new.json.gz')
+    assert manager.write_tune_plan(old_path, write_metrics=False)
+    plan = TunePlan.read(old_path)
+    planned = sorted(plan.ids())
+
+    changed = set(planned[:5])
+    change_in_sip(world, changed)
+    for indicator_id in planned[5:8]:
+        add_good_alert(world, indicator_id)
+        changed.add(indicator_id)
+    assert manager.find_stale_plan_ids(plan) == changed
+
+    assert apply(world, old_path, check_stale=False) == set(planned)
+    assert apply(world, old_path, check_stale=True) == set(planned) - changed
+
+    world.dataset.reset_statuses()
+    assert manager.write_tune_plan(new_path, write_metrics=False)
+    diff = manager.print_plan_diff(old_path, new_path, show_ids=True)
+    assert {indicator_id for changes in diff.values() for indicator_id in changes['removed']} == changed
+    assert not any(changes['added'] or changes['reason_changed'] for changes in diff.values())
+    assert not any(any(changes.values()) for changes in manager.print_plan_diff(old_path, old_path).values())
+
+
+def test_apply_plan_of_other_environment(world):
+    path = world.path('plan.json.gz')
+    assert world.manager().write_tune_plan(path, write_metrics=False)
+    assert world.manager(dev=True).apply_tune_plan(path, write_metrics=False) is False
+    assert not world.turned_off()
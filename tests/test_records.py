@@ -0,0 +1,64 @@
+"""Recorded tunes can be undone and redone by section, run, record directory or indicator."""
+
+import os
+
+import pytest
+
+from indicator_management.indicators import FIELDS
+
+
+@pytest.fixture
+def tuned(world):
+    """Run a recorded tune. Returns the IDs it turned off."""
+    assert world.manager().turn_off_indicators_according_to_tune_instructions(dry_run=False)
+    assert world.turned_off()
+    return world.turned_off()
+
+
+def test_records(world, tuned):
+    store = world.manager().record_store
+    runs = store.runs()
+    assert [section for date, run, section, records in runs] == sorted(world.manager().get_tune_sections())
+    assert len({run for date, run, section, records in runs}) == 1
+    assert sum(records for date, run, section, records in runs) == len(tuned)
+    assert set(store.iter_indicator_ids(run=runs[0][1])) == tuned
+
+
+def test_undo_redo(world, tuned):
+    store = world.manager().record_store
+    (date, run, section, records), *others = store.runs()
+    section_ids = set(store.iter_indicator_ids(section=section))
+    assert len(section_ids) == records
+
+    assert world.manager().set_status_for_records('Analyzed', section=section)
+    assert world.turned_off() == tuned - section_ids
+    for date, run, other, records in others:
+        assert world.manager().set_status_for_recorded_indicators(os.path.join(world.config['records']['directory'], date, other), 'Analyzed')
+    assert not world.turned_off()
+
+    assert world.manager().set_status_for_records('Informational', run=run)
+    assert world.turned_off() == tuned
+
+    indicator_id = min(section_ids)
+    assert world.manager().set_status_for_records('Analyzed', indicator_ids=[indicator_id])
+    assert world.turned_off() == tuned - {indicator_id}
+    assert world.manager().set_status_for_records('Analyzed', date=date)
+    assert not world.turned_off()
+
+
+def test_undo_everything_refused(world, tuned):
+    assert world.manager().set_status_for_records('Analyzed') is False
+    assert world.turned_off() == tuned
+
+
+@pytest.mark.parametrize('full_indicators', [None, False, True])
+def test_recorded_indicators(world, full_indicators):
+    """The full indicators are recorded unless full_indicators is off."""
+    if full_indicators is not None:
+        world.config['records']['full_indicators'] = str(full_indicators)
+    assert world.manager().turn_off_indicators_according_to_tune_instructions(dry_run=False)
+    for record in world.manager().record_store.iter_records():
+        indicator = dict(world.dataset.indicator(record['id'] - 1), status='Analyzed')
+        if full_indicators is False:
+            indicator = {field: indicator[field] for field in FIELDS}
+        assert record['indicator'] == indicator
@@ -0,0 +1,94 @@
+"""Rollup refreshes count the Analyzed indicators and their alerts, and take back out what changed."""
+
+import datetime
+
+import pytest
+
+from indicator_management.rollups import UNKNOWN, age_bucket, month_of
+
+NOW = datetime.datetime(2022, 6, 1, 12, 0, 0)
+
+INDICATORS = [
+    {'type': 'Address - ipv4-addr', 'source': 'OSINT1', 'status': 'Analyzed', 'modified_time': datetime.datetime(2022, 5, 15)},
+    {'type': 'URI - Domain Name', 'source': 'Company1', 'status': 'Analyzed', 'tags': ['manual_indicator'],
+     'modified_time': datetime.datetime(2022, 1, 10)},
+    # Indicators 3 and 4 have no modified time.
+    {'type': 'URI - Domain Name', 'source': 'OSINT1', 'status': 'Analyzed'},
+    {'type': 'Hash - MD5', 'source': 'OSINT1', 'status': 'Analyzed'},
+    {'type': 'Hash - MD5', 'source': 'OSINT1', 'status': 'Informational', 'modified_time': datetime.datetime(2022, 5, 1)},
+]
+
+
+@pytest.fixture
+def world(hand_written, ace):
+    world = hand_written(INDICATORS)
+    world.config['rollups'] = {'path': world.path('rollups.sqlite')}
+    ace.add_alert([1], '2022-05-20 10:00:00', 'FALSE_POSITIVE', '2022-05-20 11:00:00')
+    ace.add_alert([1], '2022-05-21 10:00:00', 'FALSE_POSITIVE', '2022-05-21 11:00:00')
+    ace.add_alert([1], '2022-04-02 10:00:00')
+    ace.add_alert([1], '2022-05-22 10:00:00', 'DELIVERY', '2022-05-22 11:00:00', alert_type='faqueue')
+    ace.add_alert([2], '2022-02-01 10:00:00', 'DELIVERY', '2022-02-01 11:00:00')
+    ace.add_alert([3], '2022-03-01 10:00:00', 'FALSE_POSITIVE', '2022-03-01 11:00:00')
+    ace.add_alert([5], '2022-05-02 10:00:00', 'FALSE_POSITIVE', '2022-05-02 11:00:00')
+    return world
+
+
+def test_unknown_month():
+    assert month_of('2022-05-15 08:30:00') == '2022-05'
+    assert month_of(None) == UNKNOWN
+    assert age_bucket('2022-05', NOW) == '30-90d'
+    assert age_bucket(UNKNOWN, NOW) == UNKNOWN
+
+
+def test_refresh(world):
+    manager = world.manager()
+    assert manager.refresh_rollups() == {'sip_changed': 4, 'removed': 0}
+    store = manager.rollup_store
+
+    assert store.query(by=('type',), now=NOW) == [
+        {'type': 'Address - ipv4-addr', 'indicators': 1, 'manual_indicators': 0, 'no_alerts': 0, 'total_alerts': 2, 'FALSE_POSITIVE': 2},
+        {'type': 'Hash - MD5', 'indicators': 1, 'manual_indicators': 0, 'no_alerts': 1, 'total_alerts': 0},
+        {'type': 'URI - Domain Name', 'indicators': 2, 'manual_indicators': 1, 'no_alerts': 0, 'total_alerts': 2, 'DELIVERY': 1,
+         'FALSE_POSITIVE': 1}]
+    assert store.query(by=('age',), now=NOW) == [
+        {'age': '30-90d', 'indicators': 1, 'manual_indicators': 0, 'no_alerts': 0, 'total_alerts': 2, 'FALSE_POSITIVE': 2},
+        {'age': '90-180d', 'indicators': 1, 'manual_indicators': 1, 'no_alerts': 0, 'total_alerts': 1, 'DELIVERY': 1},
+        {'age': UNKNOWN, 'indicators': 2, 'manual_indicators': 0, 'no_alerts': 1, 'total_alerts': 1, 'FALSE_POSITIVE': 1}]
+    assert store.query(by=('month',), now=NOW) == [
+        {'month': '2022-02', 'alerts': 1, 'indicators': 1},
+        {'month': '2022-03', 'alerts': 1, 'indicators': 1},
+        {'month': '2022-05', 'alerts': 2, 'indicators': 1}]
+    assert store.query(by=('source',), ages=[UNKNOWN], since='2022-04', now=NOW) == [
+        {'source': 'OSINT1', 'indicators': 2, 'manual_indicators': 0, 'no_alerts': 1, 'total_alerts': 0}]
+    assert store.status()['indicators'] == 4
+    assert store.status()['months'] == 3
+    manager.close()
+
+
+def test_refresh_changes(world, ace):
+    manager = world.manager()
+    manager.refresh_rollups()
+
+    # Indicator 2 is turned off in SIP, and indicator 3, which has no modified time, alerts again.
+    world.dataset.modified_column[1] = datetime.datetime(2022, 5, 25).timestamp()
+    world.dataset.set_status(1, 'Informational')
+    ace.add_alert([3], '2022-05-26 10:00:00', 'DELIVERY', '2022-05-26 11:00:00')
+
+    assert manager.refresh_rollups() == {'sip_changed': 1, 'removed': 1, 'ace_changed': 1}
+    expected = [
+        {'age': '30-90d', 'indicators': 1, 'manual_indicators': 0, 'no_alerts': 0, 'total_alerts': 2, 'FALSE_POSITIVE': 2},
+        {'age': UNKNOWN, 'indicators': 2, 'manual_indicators': 0, 'no_alerts': 1, 'total_alerts': 2, 'DELIVERY': 1,
+         'FALSE_POSITIVE': 1}]
+    assert manager.rollup_store.query(by=('age',), now=NOW) == expected
+
+    # Alerts dispositioned at the watermark are read again, without counting them twice.
+    assert manager.refresh_rollups() == {'ace_changed': 1}
+    assert manager.rollup_store.query(by=('age',), now=NOW) == expected
+
+    # A rebuild counts the same.
+    manager.refresh_rollups(rebuild=True)
+    assert manager.rollup_store.query(by=('type', 'month'), now=NOW) == [
+        {'type': 'Address - ipv4-addr', 'month': '2022-05', 'alerts': 2, 'indicators': 1},
+        {'type': 'URI - Domain Name', 'month': '2022-03', 'alerts': 1, 'indicators': 1},
+        {'type': 'URI - Domain Name', 'month': '2022-05', 'alerts': 1, 'indicators': 1}]
+    manager.close()
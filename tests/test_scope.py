@@ -0,0 +1,63 @@
+"""Importing and starting the tool is lazy, and scope-only runs count indicators without fetching them."""
+
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import indicator_management
+
+NOW = datetime.datetime.now()
+
+INDICATORS = [
+    {'type': 'Hash - MD5', 'source': 'OSINT1', 'status': 'Analyzed', 'modified_time': NOW - datetime.timedelta(days=60)},
+    {'type': 'URI - URL', 'source': 'OSINT1', 'status': 'Analyzed', 'modified_time': NOW - datetime.timedelta(days=40)},
+    # Modified too recently.
+    {'type': 'Hash - MD5', 'source': 'OSINT1', 'status': 'Analyzed', 'modified_time': NOW - datetime.timedelta(days=10)},
+    {'type': 'Hash - MD5', 'source': 'OSINT1', 'status': 'New', 'modified_time': NOW - datetime.timedelta(days=60)},
+    {'type': 'Hash - MD5', 'source': 'Company1', 'status': 'Analyzed', 'user': 'analyst3', 'modified_time': NOW - datetime.timedelta(days=100)},
+    # A good analyst's and a good tag's.
+    {'type': 'URI - URL', 'source': 'Company2', 'status': 'Analyzed', 'user': 'analyst1', 'modified_time': NOW - datetime.timedelta(days=100)},
+    {'type': 'URI - URL', 'source': 'Company3', 'status': 'Analyzed', 'user': 'analyst3', 'tags': ['morningplease'],
+     'modified_time': NOW - datetime.timedelta(days=100)},
+    {'type': 'Address - ipv4-addr', 'source': 'vendor_feed', 'status': 'Analyzed', 'modified_time': NOW - datetime.timedelta(days=400)},
+    {'type': 'Address - ipv4-addr', 'source': 'OSINT2', 'status': 'Analyzed', 'modified_time': NOW - datetime.timedelta(days=100)},
+]
+
+
+def test_import_is_lazy(tmp_path):
+    """Importing the package and making an IndicatorManager imports no client libraries and creates no files."""
+    shutil.copytree(os.path.dirname(indicator_management.__file__), tmp_path / 'indicator_management',
+                    ignore=shutil.ignore_patterns('__pycache__'))
+    script = ("import configparser, json, sys\n"
+              "from indicator_management import IndicatorManager\n"
+              "IndicatorManager(config=configparser.ConfigParser())\n"
+              "print(json.dumps([name for name in ['pymysql', 'pysip', 'tqdm', 'dateutil'] if name in sys.modules]))\n")
+    result = subprocess.run([sys.executable, '-B', '-c', script], cwd=tmp_path, env=dict(os.environ, PYTHONPATH=str(tmp_path)),
+                            capture_output=True, text=True, check=True)
+    assert json.loads(result.stdout) == []
+    assert sorted(os.listdir(tmp_path)) == ['indicator_management']
+
+
+def test_print_tune_scope(hand_written, capsys):
+    world = hand_written(INDICATORS)
+    manager = world.manager()
+    rules = manager.get_tune_rules()
+
+    assert manager.print_tune_scope(rules) == {'tune_osint': 2, 'tune_internal_intel': 1, 'tune_all_other_external_intel': 1}
+    assert manager.print_tune_scope(rules, by_type=True) == {'tune_osint': {'Hash - MD5': 1, 'URI - URL': 1},
+                                                             'tune_internal_intel': {'Hash - MD5': 1},
+                                                             'tune_all_other_external_intel': {'Address - ipv4-addr': 1}}
+    assert "An execution of tune_osint would have 2 indicators in scope" in capsys.readouterr().out
+    assert 'indicators_read' not in world.sip.stats.as_dict()
+
+
+def test_print_scope_only_changes_nothing(hand_written, capsys):
+    world = hand_written(INDICATORS)
+    assert world.manager().turn_off_indicators_according_to_tune_instructions(dry_run=False, print_scope_only=True, write_metrics=False)
+    assert "An execution of tune_internal_intel would have 1 indicators in scope" in capsys.readouterr().out
+    assert not world.turned_off()
+    assert 'indicators_read' not in world.sip.stats.as_dict()
+    assert 'put' not in world.sip.stats.as_dict()
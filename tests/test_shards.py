@@ -0,0 +1,48 @@
+"""Sharded tunes and type reports merge into the same result as an unsharded run."""
+
+import pytest
+
+from indicator_management.shards import REPORT, TUNE, Shard, merge_tune_results, read_shard_result
+
+
+def tune(world, **kwargs):
+    world.dataset.reset_statuses()
+    assert world.manager().turn_off_indicators_according_to_tune_instructions(dry_run=False, record_changes=False, **kwargs)
+    return world.turned_off()
+
+
+def run_shards(world, kind, count, **kwargs):
+    world.dataset.reset_statuses()
+    return [read_shard_result(world.manager().run_shard(kind, Shard(index, count), world.path(f"{kind}_{index}.json.gz"), **kwargs))
+            for index in range(count)]
+
+
+def test_three_shards_merge_to_unsharded(world):
+    unsharded = tune(world)
+    assert unsharded
+    assert tune(world, processes=3) == unsharded
+
+    results = run_shards(world, TUNE, 3)
+    assert tune(world, shard_results=results) == unsharded
+    world.dataset.reset_statuses()
+    assert world.manager().turn_off_indicators_according_to_tune_instructions(dry_run=False, shard_results=results[:2]) is False
+    assert not world.turned_off()
+
+
+def test_sharded_sections(world):
+    sections = world.manager().get_tune_sections()
+    results = run_shards(world, TUNE, 3)
+    for section in sections:
+        unsharded = tune(world, sections=[section])
+        assert tune(world, sections=[section], processes=3) == unsharded
+        assert tune(world, sections=[section], shard_results=results) == unsharded
+
+    with pytest.raises(ValueError):
+        merge_tune_results(run_shards(world, TUNE, 2, sections=sections[:1]), sections=sections[1:])
+
+
+def test_three_report_shards_merge_to_unsharded(world):
+    manager = world.manager()
+    unsharded = manager.get_indicator_type_report(print_report=False, write_report=False)
+    assert manager.get_indicator_type_report(print_report=False, write_report=False, processes=3) == unsharded
+    assert manager.get_indicator_type_report(print_report=False, write_report=False, shard_results=run_shards(world, REPORT, 3)) == unsharded
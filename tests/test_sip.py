@@ -0,0 +1,85 @@
+"""SIP status updates are made concurrently, rate limited and retried, and one failed indicator doesn't stop the rest."""
+
+import datetime
+import time
+
+import pysip
+import pytest
+import requests
+
+from benchmarks.fakes import FakeSipClient
+from indicator_management import IndicatorManager
+from indicator_management.sip import SipWriteExecutor, WriteResult, WriteSummary
+
+UNAVAILABLE = '<html><title>503 Service Unavailable</title></html>'
+NOT_FOUND = '{"message": "Indicator ID not found"}'
+
+
+class ScriptedSip:
+    """A SIP client whose status updates raise the errors scripted for each indicator, in order, before succeeding."""
+
+    def __init__(self, errors):
+        self.errors = {indicator_id: list(indicator_errors) for indicator_id, indicator_errors in errors.items()}
+        self.statuses = {}
+
+    def put(self, endpoint, data):
+        indicator_id = int(endpoint.rsplit('/', 1)[1])
+        if self.errors.get(indicator_id):
+            raise self.errors[indicator_id].pop(0)
+        self.statuses[indicator_id] = data['status']
+
+
+class FailingSip(FakeSipClient):
+    """A FakeSipClient that can't update some indicators."""
+
+    def __init__(self, dataset, failing):
+        super().__init__(dataset)
+        self.failing = failing
+
+    def put(self, endpoint, data):
+        if int(endpoint.rsplit('/', 1)[1]) in self.failing:
+            raise pysip.RequestError(NOT_FOUND)
+        return super().put(endpoint, data)
+
+
+def test_retries():
+    sip = ScriptedSip({2: [pysip.RequestError(UNAVAILABLE)],
+                       3: [requests.exceptions.Timeout('read timed out')] * 3,
+                       4: [pysip.RequestError(NOT_FOUND)],
+                       5: [ValueError('Expecting value: line 1 column 1 (char 0)')]})
+    executor = SipWriteExecutor(sip, workers=3, requests_per_second=0, max_retries=2, backoff=0)
+
+    summary = WriteSummary('test')
+    results = sorted(executor.set_statuses(range(1, 6), 'Informational'))
+    for result in results:
+        summary.add(result)
+
+    assert results == [WriteResult(1, 'Informational', True, 1, None),
+                       WriteResult(2, 'Informational', True, 2, None),
+                       WriteResult(3, 'Informational', False, 3, 'read timed out'),
+                       WriteResult(4, 'Informational', False, 1, NOT_FOUND),
+                       WriteResult(5, 'Informational', True, 2, None)]
+    assert sip.statuses == {1: 'Informational', 2: 'Informational', 5: 'Informational'}
+    assert (summary.succeeded, [result.indicator_id for result in summary.failed], summary.retries) == (3, [3, 4], 4)
+
+
+def test_rate_limit():
+    executor = SipWriteExecutor(ScriptedSip({}), workers=4, requests_per_second=50, max_retries=0)
+    started = time.monotonic()
+    assert all(result.success for result in executor.set_statuses(range(60), 'Analyzed'))
+    # The first 50 requests use up the bucket's second of tokens, the other ten wait 1/50th of a second each.
+    assert time.monotonic() - started >= 0.19
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_failed_indicator_doesnt_stop_the_tune(hand_written, workers):
+    modified_time = datetime.datetime.now() - datetime.timedelta(days=60)
+    world = hand_written([{'type': 'Hash - MD5', 'source': 'OSINT1', 'status': 'Analyzed', 'modified_time': modified_time}] * 5)
+    world.config['sip_write']['workers'] = str(workers)
+    manager = IndicatorManager(config=world.config, sip=FailingSip(world.dataset, {2, 4}), ace_cursor_factory=world.ace.cursor)
+
+    # None of them have alerted, so all five are turned off, except the two SIP fails to update.
+    assert manager.turn_off_indicators_according_to_tune_instructions(dry_run=False, record_changes=False, sections=['tune_osint'])
+    assert world.turned_off() == {1, 3, 5}
+    assert sum(summary.succeeded for summary in manager.write_summaries) == 3
+    assert sorted(result.indicator_id for summary in manager.write_summaries for result in summary.failed) == [2, 4]
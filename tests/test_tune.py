@@ -0,0 +1,102 @@
+"""A tune turns off the indicators in each tune section's scope that didn't alert with a good disposition since its cutoff."""
+
+import datetime
+
+import pytest
+
+from indicator_management.indicators import Indicator
+from indicator_management.rules import TuneRule, route
+from indicator_management.sip import ANALYZED
+
+DAY = datetime.timedelta(days=1)
+NOW = datetime.datetime.now()
+FA_QUEUE = 'ACE - FA Queue - Suspect Hash'
+
+
+def osint(indicator_type='Hash - MD5', status='Analyzed', days_ago=60):
+    return {'type': indicator_type, 'source': 'OSINT1', 'status': status, 'modified_time': NOW - days_ago * DAY}
+
+
+def internal(source='Company1', user='analyst3', tags=()):
+    return {'type': 'URI - URL', 'source': source, 'status': 'Analyzed', 'user': user, 'tags': list(tags), 'modified_time': NOW - 100 * DAY}
+
+
+def other(source='vendor_feed', days_ago=400):
+    return {'type': 'Address - ipv4-addr', 'source': source, 'status': 'Analyzed', 'modified_time': NOW - days_ago * DAY}
+
+
+# tune_osint has a 30 day cutoff, tune_internal_intel 90 days without GRAYWARE as a bad disposition and
+# tune_all_other_external_intel 360 days. Indicators are numbered from 1.
+INDICATORS = [
+    osint(), osint(), osint('URI - URL'), osint('URI - URL'), osint(),
+    osint(days_ago=10), osint(status='New'), osint(), osint(),
+    internal(), internal('Company2'), internal('Company2', user='analyst1'), internal('Company3', tags=['morningplease']), internal(),
+    other(), other('OSINT2'), other(days_ago=100),
+]
+
+EXPECTED = {'tune_osint': {1, 3, 4, 5, 9},
+            'tune_internal_intel': {11, 14},
+            'tune_all_other_external_intel': {15}}
+
+
+def at(days_ago):
+    return (NOW - days_ago * DAY).isoformat(' ')
+
+
+@pytest.fixture
+def world(hand_written, ace):
+    world = hand_written(INDICATORS)
+    # Only bad dispositions since the cutoff.
+    ace.add_alert([1], at(10), 'FALSE_POSITIVE')
+    ace.add_alert([1], at(20), 'IGNORE')
+    # A good disposition.
+    ace.add_alert([2], at(10), 'DELIVERY')
+    ace.add_alert([2], at(5), 'FALSE_POSITIVE')
+    # 3 never alerted and 4 only before the cutoff.
+    ace.add_alert([4], at(45), 'DELIVERY')
+    # FA Queue alerts don't count toward the cutoff.
+    ace.add_alert([5], at(10), 'DELIVERY', description=FA_QUEUE)
+    ace.add_alert([5], at(40), 'DELIVERY')
+    # 6 was modified too recently and 7 isn't Analyzed. 8 has an alert without a disposition yet.
+    ace.add_alert([6, 7], at(10), 'FALSE_POSITIVE')
+    ace.add_alert([8], at(5))
+    # faqueue alerts aren't alerts at all.
+    ace.add_alert([9], at(5), 'DELIVERY', alert_type='faqueue')
+    # GRAYWARE is a good disposition for tune_internal_intel.
+    ace.add_alert([10], at(50), 'GRAYWARE')
+    ace.add_alert([11], at(50), 'RECONNAISSANCE')
+    # 12 is a good analyst's and 13 has a good tag.
+    ace.add_alert([15], at(100), 'GRAYWARE')
+    ace.add_alert([16], at(100), 'DELIVERY')
+    # 17 was modified too recently.
+    return world
+
+
+def test_tune(world):
+    manager = world.manager()
+    assert manager.turn_off_indicators_according_to_tune_instructions(dry_run=False)
+    assert world.turned_off() == set().union(*EXPECTED.values())
+    assert all(world.dataset.indicator(indicator_id - 1)['status'] == 'Informational' for indicator_id in world.turned_off())
+
+    store = manager.record_store
+    assert {section: set(store.iter_indicator_ids(section=section)) for section in EXPECTED} == EXPECTED
+
+
+def test_dry_run_changes_nothing(world):
+    assert world.manager().turn_off_indicators_according_to_tune_instructions(dry_run=True, record_changes=False)
+    assert not world.turned_off()
+
+
+def test_tune_sections(world):
+    manager = world.manager()
+    assert manager.turn_off_indicators_according_to_tune_instructions(dry_run=False, record_changes=False, sections=['tune_internal_intel'])
+    assert world.turned_off() == EXPECTED['tune_internal_intel']
+    assert manager.turn_off_indicators_according_to_tune_instructions(dry_run=True, sections=['tune_missing']) is False
+
+
+def test_route_indicator_without_modified_time():
+    rule = TuneRule('tune_test', datetime.datetime.now() - datetime.timedelta(days=90), ['FALSE_POSITIVE'], types=['URI - URL'])
+    assert route(Indicator(1, 'URI - URL', 'http://example.com', status=ANALYZED), [rule]) == [rule]
+    assert route(Indicator(2, 'Hash - MD5', 'd41d8cd98f00b204e9800998ecf8427e', status=ANALYZED), [rule]) == []
+    recent = Indicator(3, 'URI - URL', 'http://example.com', status=ANALYZED, modified_time=datetime.datetime.now().isoformat(' '))
+    assert route(recent, [rule]) == []